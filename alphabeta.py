@@ -0,0 +1,1012 @@
+import sys
+import math
+import time
+import threading
+from bitboard import WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, SQUARE_NAMES
+from position import (Position, START_FEN, PIECE_SYMBOLS, PROMOTION, EN_PASSANT, CASTLING,
+                      CASTLING_ROOKS, ZOBRIST_EP, ZOBRIST_SIDE, InvalidFenError, IllegalMoveError,
+                      move_to_uci)
+
+
+NAME = "PyChess 1.0"
+AUTHOR = "the PyChess developers"
+
+MAX_PLY = 128
+INFINITE = 32001
+MATE = 32000
+MATE_BOUND = MATE - MAX_PLY
+
+BOUND_EXACT, BOUND_LOWER, BOUND_UPPER = range(3)
+
+# Rough size of one transposition table slot: the list pointer plus a tuple
+# of five small ints. Used to turn the Hash option into a slot count.
+ENTRY_BYTES = 112
+
+# Default per-move budget in milliseconds for searches limited by depth or
+# nodes rather than a clock. A pure Python search cannot reach the depths
+# callers ask Stockfish for, so without a cap "go depth 15" would not return.
+DEFAULT_MOVE_BUDGET = 1000
+
+# PeSTO's tapered evaluation (Ronald Friederich), as published on the Chess
+# Programming Wiki. Tables are laid out a8..h8 down to a1..h1, the way they
+# read from white's side of the board.
+MG_VALUE = (0, 82, 337, 365, 477, 1025, 0)
+EG_VALUE = (0, 94, 281, 297, 512, 936, 0)
+PHASE_WEIGHT = (0, 0, 1, 1, 2, 4, 0)
+MAX_PHASE = 24
+
+MG_TABLES = {
+    PAWN: (
+          0,   0,   0,   0,   0,   0,   0,   0,
+         98, 134,  61,  95,  68, 126,  34, -11,
+         -6,   7,  26,  31,  65,  56,  25, -20,
+        -14,  13,   6,  21,  23,  12,  17, -23,
+        -27,  -2,  -5,  12,  17,   6,  10, -25,
+        -26,  -4,  -4, -10,   3,   3,  33, -12,
+        -35,  -1, -20, -23, -15,  24,  38, -22,
+          0,   0,   0,   0,   0,   0,   0,   0),
+    KNIGHT: (
+        -167, -89, -34, -49,  61, -97, -15, -107,
+         -73, -41,  72,  36,  23,  62,   7,  -17,
+         -47,  60,  37,  65,  84, 129,  73,   44,
+          -9,  17,  19,  53,  37,  69,  18,   22,
+         -13,   4,  16,  13,  28,  19,  21,   -8,
+         -23,  -9,  12,  10,  19,  17,  25,  -16,
+         -29, -53, -12,  -3,  -1,  18, -14,  -19,
+        -105, -21, -58, -33, -17, -28, -19,  -23),
+    BISHOP: (
+        -29,   4, -82, -37, -25, -42,   7,  -8,
+        -26,  16, -18, -13,  30,  59,  18, -47,
+        -16,  37,  43,  40,  35,  50,  37,  -2,
+         -4,   5,  19,  50,  37,  37,   7,  -2,
+         -6,  13,  13,  26,  34,  12,  10,   4,
+          0,  15,  15,  15,  14,  27,  18,  10,
+          4,  15,  16,   0,   7,  21,  33,   1,
+        -33,  -3, -14, -21, -13, -12, -39, -21),
+    ROOK: (
+         32,  42,  32,  51,  63,   9,  31,  43,
+         27,  32,  58,  62,  80,  67,  26,  44,
+         -5,  19,  26,  36,  17,  45,  61,  16,
+        -24, -11,   7,  26,  24,  35,  -8, -20,
+        -36, -26, -12,  -1,   9,  -7,   6, -23,
+        -45, -25, -16, -17,   3,   0,  -5, -33,
+        -44, -16, -20,  -9,  -1,  11,  -6, -71,
+        -19, -13,   1,  17,  16,   7, -37, -26),
+    QUEEN: (
+        -28,   0,  29,  12,  59,  44,  43,  45,
+        -24, -39,  -5,   1, -16,  57,  28,  54,
+        -13, -17,   7,   8,  29,  56,  47,  57,
+        -27, -27, -16, -16,  -1,  17,  -2,   1,
+         -9, -26,  -9, -10,  -2,  -4,   3,  -3,
+        -14,   2, -11,  -2,  -5,   2,  14,   5,
+        -35,  -8,  11,   2,   8,  15,  -3,   1,
+         -1, -18,  -9,  10, -15, -25, -31, -50),
+    KING: (
+        -65,  23,  16, -15, -56, -34,   2,  13,
+         29,  -1, -20,  -7,  -8,  -4, -38, -29,
+         -9,  24,   2, -16, -20,   6,  22, -22,
+        -17, -20, -12, -27, -30, -25, -14, -36,
+        -49,  -1, -27, -39, -46, -44, -33, -51,
+        -14, -14, -22, -46, -44, -30, -15, -27,
+          1,   7,  -8, -64, -43, -16,   9,   8,
+        -15,  36,  12, -54,   8, -28,  24,  14)
+}
+
+EG_TABLES = {
+    PAWN: (
+          0,   0,   0,   0,   0,   0,   0,   0,
+        178, 173, 158, 134, 147, 132, 165, 187,
+         94, 100,  85,  67,  56,  53,  82,  84,
+         32,  24,  13,   5,  -2,   4,  17,  17,
+         13,   9,  -3,  -7,  -7,  -8,   3,  -1,
+          4,   7,  -6,   1,   0,  -5,  -1,  -8,
+         13,   8,   8,  10,  13,   0,   2,  -7,
+          0,   0,   0,   0,   0,   0,   0,   0),
+    KNIGHT: (
+        -58, -38, -13, -28, -31, -27, -63, -99,
+        -25,  -8, -25,  -2,  -9, -25, -24, -52,
+        -24, -20,  10,   9,  -1,  -9, -19, -41,
+        -17,   3,  22,  22,  22,  11,   8, -18,
+        -18,  -6,  16,  25,  16,  17,   4, -18,
+        -23,  -3,  -1,  15,  10,  -3, -20, -22,
+        -42, -20, -10,  -5,  -2, -20, -23, -44,
+        -29, -51, -23, -15, -22, -18, -50, -64),
+    BISHOP: (
+        -14, -21, -11,  -8,  -7,  -9, -17, -24,
+         -8,  -4,   7, -12,  -3, -13,  -4, -14,
+          2,  -8,   0,  -1,  -2,   6,   0,   4,
+         -3,   9,  12,   9,  14,  10,   3,   2,
+         -6,   3,  13,  19,   7,  10,  -3,  -9,
+        -12,  -3,   8,  10,  13,   3,  -7, -15,
+        -14, -18,  -7,  -1,   4,  -9, -15, -27,
+        -23,  -9, -23,  -5,  -9, -16,  -5, -17),
+    ROOK: (
+         13,  10,  18,  15,  12,  12,   8,   5,
+         11,  13,  13,  11,  -3,   3,   8,   3,
+          7,   7,   7,   5,   4,  -3,  -5,  -3,
+          4,   3,  13,   1,   2,   1,  -1,   2,
+          3,   5,   8,   4,  -5,  -6,  -8, -11,
+         -4,   0,  -5,  -1,  -7, -12,  -8, -16,
+         -6,  -6,   0,   2,  -9,  -9, -11,  -3,
+         -9,   2,   3,  -1,  -5, -13,   4, -20),
+    QUEEN: (
+         -9,  22,  22,  27,  27,  19,  10,  20,
+        -17,  20,  32,  41,  58,  25,  30,   0,
+        -20,   6,   9,  49,  47,  35,  19,   9,
+          3,  22,  24,  45,  57,  40,  57,  36,
+        -18,  28,  19,  47,  31,  34,  39,  23,
+        -16, -27,  15,   6,   9,  17,  10,   5,
+        -22, -23, -30, -16, -16, -23, -36, -32,
+        -33, -28, -22, -43,  -5, -32, -20, -41),
+    KING: (
+        -74, -35, -18, -18, -11,  15,   4, -17,
+        -12,  17,  14,  17,  17,  38,  23,  11,
+         10,  17,  23,  15,  20,  45,  44,  13,
+         -8,  22,  24,  27,  26,  33,  26,   3,
+        -18,  -4,  21,  24,  27,  23,   9, -11,
+        -19,  -3,  11,  21,  23,  16,   7,  -9,
+        -27, -11,   4,  13,  14,   4,  -5, -17,
+        -53, -34, -21, -11, -28, -14, -24, -43)
+}
+
+
+def _piece_square_tables(values, tables) -> list:
+    # One row per piece code, white-relative: black pieces count negative
+    # and read the table from their own side, so a row is indexed by square.
+    rows = [[0] * 64 for _ in range(16)]
+    for piece_type, table in tables.items():
+        for sq in range(64):
+            rows[(WHITE << 3) | piece_type][sq] = values[piece_type] + table[sq ^ 56]
+            rows[(BLACK << 3) | piece_type][sq] = -(values[piece_type] + table[sq])
+    return rows
+
+
+MG_PSQ = _piece_square_tables(MG_VALUE, MG_TABLES)
+EG_PSQ = _piece_square_tables(EG_VALUE, EG_TABLES)
+
+# Move ordering bands: the hash move, then captures and queen promotions by
+# MVV-LVA, then the two killers, then quiet moves by history score.
+ORDER_HASH = 1 << 30
+ORDER_CAPTURE = 1 << 28
+ORDER_KILLER = 1 << 26
+HISTORY_LIMIT = 1 << 20
+
+_PROMOTION_MASK = 3 << 14
+_QUEEN_PROMOTION = PROMOTION | ((QUEEN - KNIGHT) << 12)
+
+
+class SearchStopped(Exception):
+    pass
+
+
+def evaluate_terms(pos: Position) -> tuple:
+    mg = eg = phase = 0
+    board = pos.board
+    occupied = pos.by_type[0]
+    while occupied:
+        sq = (occupied & -occupied).bit_length() - 1
+        occupied &= occupied - 1
+        piece = board[sq]
+        mg += MG_PSQ[piece][sq]
+        eg += EG_PSQ[piece][sq]
+        phase += PHASE_WEIGHT[piece & 7]
+    return mg, eg, phase
+
+
+def evaluate(pos: Position) -> int:
+    """Static evaluation in centipawns from the side to move's point of view."""
+    return _blend(*evaluate_terms(pos), pos.side_to_move)
+
+
+def _blend(mg: int, eg: int, phase: int, us: int) -> int:
+    phase = min(phase, MAX_PHASE)
+    score = (mg * phase + eg * (MAX_PHASE - phase)) // MAX_PHASE
+    return score if us == WHITE else -score
+
+
+def score_to_uci(score: int) -> dict:
+    if score >= MATE_BOUND:
+        return {"type": "mate", "value": (MATE - score + 1) // 2}
+    if score <= -MATE_BOUND:
+        return {"type": "mate", "value": -((MATE + score) // 2)}
+    return {"type": "cp", "value": score}
+
+
+class TimeManager:
+    """A port of Stockfish's TimeManagement::init (src/timeman.cpp).
+
+    optimum and maximum are milliseconds from start, or None when the
+    search has no clock. The "nodes as time" mode is not supported.
+    """
+
+    def __init__(self):
+        self.original_time_adjust = -1.0
+        self.start = time.perf_counter()
+        self.optimum = None
+        self.maximum = None
+
+    def clear(self):
+        self.original_time_adjust = -1.0
+
+    def init(self, limits: dict, us: int, ply: int, move_overhead: int = 10, ponder: bool = False):
+        self.start = limits.get("start", time.perf_counter())
+        self.optimum = self.maximum = None
+
+        my_time = limits.get("wtime" if us == WHITE else "btime")
+        if not my_time:
+            return
+        inc = limits.get("winc" if us == WHITE else "binc") or 0
+        movestogo = limits.get("movestogo") or 0
+
+        # Maximum move horizon of 50 moves; under a second left it is
+        # gradually reduced.
+        mtg = min(movestogo, 50) if movestogo else 50
+        if my_time < 1000 and (not inc or mtg / inc > 0.05):
+            mtg = max(1, int(my_time * 0.05))
+
+        # timeLeft is kept above zero since it is used as a divisor.
+        time_left = max(1, my_time + inc * (mtg - 1) - move_overhead * (2 + mtg))
+
+        if not movestogo:
+            # x basetime (+ z increment): with a healthy increment timeLeft
+            # can exceed the game time, so the scale is also capped by it.
+            if self.original_time_adjust < 0:
+                self.original_time_adjust = 0.3285 * math.log10(time_left) - 0.4830
+            log_time_in_sec = math.log10(my_time / 1000.0)
+            opt_constant = min(0.00308 + 0.000319 * log_time_in_sec, 0.00506)
+            max_constant = max(3.39 + 3.01 * log_time_in_sec, 2.93)
+            opt_scale = min(0.0122 + (ply + 2.95) ** 0.462 * opt_constant,
+                            0.213 * my_time / time_left) * self.original_time_adjust
+            max_scale = min(6.64, max_constant + ply / 12.0)
+        else:
+            # x moves in y seconds (+ z increment)
+            opt_scale = min((0.88 + ply / 116.4) / mtg, 0.88 * my_time / time_left)
+            max_scale = min(6.3, 1.5 + 0.11 * mtg)
+
+        self.optimum = max(1, int(opt_scale * time_left))
+        self.maximum = max(1, int(min(0.825 * my_time - move_overhead, max_scale * self.optimum)) - 10)
+        if ponder:
+            self.optimum += self.optimum // 4
+
+    def elapsed(self) -> int:
+        return int((time.perf_counter() - self.start) * 1000)
+
+
+class Search:
+    def __init__(self, hash_mb: int = 16):
+        self.time = TimeManager()
+        self.stop_event = threading.Event()
+        self.pondering = False
+        self.move_overhead = 10
+        self.ponder = False
+        self.move_budget = 0
+        self.resize(hash_mb)
+        self.clear()
+
+    def resize(self, hash_mb: int):
+        slots = max(1, hash_mb * 1024 * 1024 // ENTRY_BYTES)
+        # A power of two, so the slot is the low bits of the key.
+        slots = 1 << (slots.bit_length() - 1)
+        self._mask = slots - 1
+        self._table = [None] * slots
+
+    def clear(self):
+        self._table = [None] * len(self._table)
+        self.history = [0] * (2 << 12)
+        self.killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self.time.clear()
+
+    def hashfull(self) -> int:
+        sample = self._table[:1000]
+        return sum(1 for entry in sample if entry is not None) * 1000 // max(1, len(sample))
+
+    def run(self, pos: Position, limits: dict = None, on_iteration=None) -> dict:
+        """Iterative deepening search of pos under UCI-style limits.
+
+        limits takes depth, nodes, movetime, wtime/btime/winc/binc,
+        movestogo, infinite and searchmoves (a list of moves). on_iteration
+        is called with an info dict after every completed depth. The result
+        holds the best move, the ponder move and the last info.
+        """
+        limits = dict(limits or {})
+        limits.setdefault("start", time.perf_counter())
+        self.pos = pos
+        self.nodes = 0
+        self.seldepth = 0
+        self.root_ply = len(pos.stack)
+        self.stop_event.clear()
+        self.pondering = bool(limits.get("ponder"))
+
+        game_ply = 2 * (pos.fullmove_number - 1) + (pos.side_to_move == BLACK)
+        self.time.init(limits, pos.side_to_move, game_ply, self.move_overhead, self.ponder)
+        self.movetime = limits.get("movetime")
+        self.node_limit = limits.get("nodes")
+        self.infinite = bool(limits.get("infinite"))
+        if (self.move_budget and not self.infinite and not self.movetime
+                and self.time.maximum is None):
+            self.movetime = self.move_budget
+        self.deadline = self.__deadline()
+
+        root_moves = pos.generate_legal()
+        if limits.get("searchmoves"):
+            root_moves = [move for move in root_moves if move in limits["searchmoves"]]
+        self.root_moves = root_moves
+        for i in range(len(self.history)):
+            self.history[i] >>= 1
+
+        result = {"bestmove": root_moves[0] if root_moves else None, "ponder": None,
+                  "info": None, "nodes": 0, "time": 0}
+        if not root_moves:
+            score = -MATE if pos.in_check() else 0
+            result["info"] = self.__info(0, score, [])
+            return result
+
+        max_depth = min(limits.get("depth") or MAX_PLY, MAX_PLY)
+        terms = evaluate_terms(pos)
+        in_check = pos.in_check()
+        best_move_changes = 0.0
+        previous_best = None
+        for depth in range(1, max_depth + 1):
+            self.pv = [[] for _ in range(MAX_PLY + 1)]
+            self.root_best = None
+            try:
+                score = self.__negamax(depth, -INFINITE, INFINITE, 0, *terms, in_check)
+            except SearchStopped:
+                while len(pos.stack) > self.root_ply:
+                    pos.pop()
+                # The first root move searched is the previous best, so a move
+                # that replaced it in the unfinished iteration is better.
+                if self.root_best is not None and self.root_best[0] != result["bestmove"]:
+                    result["bestmove"], score, pv = self.root_best
+                    result["ponder"] = pv[1] if len(pv) > 1 else None
+                    result["info"] = self.__info(depth, score, pv)
+                    if on_iteration is not None:
+                        on_iteration(result["info"])
+                break
+
+            pv = self.pv[0]
+            result["bestmove"] = pv[0]
+            result["ponder"] = pv[1] if len(pv) > 1 else None
+            result["info"] = self.__info(depth, score, pv)
+            if on_iteration is not None:
+                on_iteration(result["info"])
+            # The best move searched first next time.
+            self.root_moves.remove(pv[0])
+            self.root_moves.insert(0, pv[0])
+
+            best_move_changes = best_move_changes / 2 + (previous_best not in (None, pv[0]))
+            previous_best = pv[0]
+            if self.__should_stop_iterating(best_move_changes):
+                break
+
+        # A ponder search only reports once the opponent has moved or the
+        # GUI stops it, even when it finishes early.
+        while self.pondering and not self.stop_event.is_set():
+            self.stop_event.wait(0.01)
+        result["nodes"] = self.nodes
+        result["time"] = self.time.elapsed()
+        return result
+
+    def stop(self):
+        self.stop_event.set()
+
+    def ponderhit(self):
+        # Time management continues from the moment "go ponder" was sent,
+        # like Stockfish.
+        self.pondering = False
+        self.deadline = self.__deadline()
+
+    def __deadline(self):
+        limit = self.movetime or self.time.maximum
+        return None if limit is None else self.time.start + limit / 1000
+
+    def __should_stop_iterating(self, best_move_changes: float) -> bool:
+        if self.pondering or self.infinite or self.time.optimum is None:
+            return False
+        if len(self.root_moves) == 1:
+            return True
+        # An unstable best move earns more time, as in Stockfish. Each
+        # iteration costs several times the one before, so a new one is only
+        # started while less than half of the allotment is used.
+        total = min(self.time.maximum, self.time.optimum * (0.9929 + 1.8519 * best_move_changes))
+        return self.time.elapsed() > total / 2
+
+    def __check_limits(self):
+        if self.stop_event.is_set():
+            raise SearchStopped
+        if self.node_limit and self.nodes >= self.node_limit:
+            raise SearchStopped
+        if self.deadline is not None and not self.pondering and time.perf_counter() >= self.deadline:
+            raise SearchStopped
+
+    def __info(self, depth: int, score: int, pv: list) -> dict:
+        elapsed = max(1, self.time.elapsed())
+        return {
+            "depth": depth,
+            "seldepth": max(depth, self.seldepth),
+            "score": score_to_uci(score),
+            "nodes": self.nodes,
+            "nps": self.nodes * 1000 // elapsed,
+            "time": elapsed,
+            "hashfull": self.hashfull(),
+            "pv": [move_to_uci(move) for move in pv]
+        }
+
+    def __is_draw(self, pos: Position) -> bool:
+        if pos.halfmove_clock >= 100:
+            return True
+        # Stack entries hold the key before each move; same side to move
+        # positions are every second one back, up to the last capture or
+        # pawn move.
+        stack = pos.stack
+        key = pos.key
+        for i in range(4, min(pos.halfmove_clock, len(stack)) + 1, 2):
+            if stack[-i][5] == key:
+                return True
+        return False
+
+    def __probe(self, key: int):
+        entry = self._table[key & self._mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def __store(self, key: int, depth: int, bound: int, score: int, move: int, ply: int):
+        # Mate scores are stored relative to this node, not the root.
+        if score >= MATE_BOUND:
+            score += ply
+        elif score <= -MATE_BOUND:
+            score -= ply
+        index = key & self._mask
+        entry = self._table[index]
+        if entry is None or entry[0] != key or depth >= entry[1] or bound == BOUND_EXACT:
+            self._table[index] = (key, depth, bound, score, move)
+
+    def __order(self, moves: list, tt_move: int, ply: int, us: int) -> list:
+        board = self.pos.board
+        killer1, killer2 = self.killers[ply]
+        history = self.history
+        base = us << 12
+        scored = []
+        for move in moves:
+            if move == tt_move:
+                score = ORDER_HASH
+            else:
+                victim = board[move & 63]
+                flag = move & _PROMOTION_MASK
+                if victim or flag == EN_PASSANT:
+                    # Most valuable victim, then least valuable attacker.
+                    score = ORDER_CAPTURE + ((victim & 7) or PAWN) * 16 - (board[(move >> 6) & 63] & 7)
+                    if flag == PROMOTION:
+                        score += ((move >> 12) & 3) * 16
+                elif flag == PROMOTION:
+                    score = ORDER_CAPTURE + ((move >> 12) & 3) * 16 - 64
+                elif move == killer1:
+                    score = ORDER_KILLER + 1
+                elif move == killer2:
+                    score = ORDER_KILLER
+                else:
+                    score = history[base | (move & 4095)]
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return scored
+
+    def __negamax(self, depth: int, alpha: int, beta: int, ply: int,
+                  mg: int, eg: int, phase: int, in_check: bool) -> int:
+        pos = self.pos
+        pv_node = beta - alpha > 1
+        self.pv[ply] = []
+
+        if ply:
+            if self.__is_draw(pos):
+                return 0
+            # Mate distance pruning.
+            alpha = max(alpha, -MATE + ply)
+            beta = min(beta, MATE - ply - 1)
+            if alpha >= beta:
+                return alpha
+            if ply >= MAX_PLY:
+                return _blend(mg, eg, phase, pos.side_to_move)
+
+        if in_check:
+            depth += 1
+        if depth <= 0:
+            return self.__quiescence(alpha, beta, ply, mg, eg, phase, in_check)
+
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.__check_limits()
+
+        key = pos.key
+        tt_move = 0
+        entry = self.__probe(key)
+        if entry is not None:
+            tt_move = entry[4]
+            if ply and not pv_node and entry[1] >= depth:
+                score = entry[3]
+                if score >= MATE_BOUND:
+                    score -= ply
+                elif score <= -MATE_BOUND:
+                    score += ply
+                bound = entry[2]
+                if (bound == BOUND_EXACT or (bound == BOUND_LOWER and score >= beta)
+                        or (bound == BOUND_UPPER and score <= alpha)):
+                    return score
+
+        us = pos.side_to_move
+        by_type = pos.by_type
+
+        # Null move pruning: if passing still fails high, a real move will.
+        # Not tried in check or with only pawns left, where zugzwang is common.
+        if (not pv_node and not in_check and depth >= 3 and ply
+                and pos.by_color[us] & ~(by_type[PAWN] | by_type[KING])
+                and _blend(mg, eg, phase, us) >= beta):
+            reduction = 2 + depth // 4
+            saved = (pos.ep_square, pos.halfmove_clock, pos.key)
+            null_key = pos.key ^ ZOBRIST_SIDE
+            if pos.ep_square is not None:
+                null_key ^= ZOBRIST_EP[pos.ep_square & 7]
+            pos.ep_square = None
+            pos.halfmove_clock = 0
+            pos.side_to_move = us ^ 1
+            pos.key = null_key
+            stack_size = len(pos.stack)
+            try:
+                score = -self.__negamax(depth - 1 - reduction, -beta, -beta + 1, ply + 1,
+                                        mg, eg, phase, False)
+            except SearchStopped:
+                # Unwind the moves made below the null move before undoing it.
+                while len(pos.stack) > stack_size:
+                    pos.pop()
+                raise
+            finally:
+                pos.ep_square, pos.halfmove_clock, pos.key = saved
+                pos.side_to_move = us
+            if score >= beta:
+                return beta if score >= MATE_BOUND else score
+
+        moves = self.root_moves if ply == 0 else pos.generate_legal()
+        if not moves:
+            return -MATE + ply if in_check else 0
+
+        board = pos.board
+        history = self.history
+        best_score = -INFINITE
+        best_move = 0
+        original_alpha = alpha
+        searched = 0
+        for _, move in self.__order(moves, tt_move, ply, us):
+            to = move & 63
+            frm = (move >> 6) & 63
+            captured = board[to]
+            flag = move & _PROMOTION_MASK
+            quiet = not captured and flag in (0, CASTLING)
+
+            child_mg, child_eg, child_phase = self.__update_terms(
+                move, board[frm], captured, flag, us, mg, eg, phase)
+            pos.push(move)
+            gives_check = pos.in_check()
+
+            new_depth = depth - 1
+            if searched == 0:
+                score = -self.__negamax(new_depth, -beta, -alpha, ply + 1,
+                                        child_mg, child_eg, child_phase, gives_check)
+            else:
+                # Late quiet moves are searched shallower first and only
+                # re-searched at full depth when they beat alpha.
+                reduction = 1 if (searched >= 3 and depth >= 3 and quiet and not in_check
+                                  and not gives_check) else 0
+                score = -self.__negamax(new_depth - reduction, -alpha - 1, -alpha, ply + 1,
+                                        child_mg, child_eg, child_phase, gives_check)
+                if score > alpha and (reduction or score < beta):
+                    score = -self.__negamax(new_depth, -beta, -alpha, ply + 1,
+                                            child_mg, child_eg, child_phase, gives_check)
+            pos.pop()
+            searched += 1
+
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    best_move = move
+                    alpha = score
+                    self.pv[ply] = [move] + self.pv[ply + 1]
+                    if ply == 0:
+                        self.root_best = (move, score, self.pv[0])
+                    if score >= beta:
+                        if quiet:
+                            killers = self.killers[ply]
+                            if killers[0] != move:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            index = (us << 12) | (move & 4095)
+                            history[index] += depth * depth
+                            if history[index] > HISTORY_LIMIT:
+                                for i in range(len(history)):
+                                    history[i] >>= 1
+                        break
+
+        if best_score >= beta:
+            bound = BOUND_LOWER
+        elif best_score > original_alpha:
+            bound = BOUND_EXACT
+        else:
+            bound = BOUND_UPPER
+        self.__store(key, depth, bound, best_score, best_move or tt_move, ply)
+        return best_score
+
+    def __quiescence(self, alpha: int, beta: int, ply: int,
+                     mg: int, eg: int, phase: int, in_check: bool) -> int:
+        pos = self.pos
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.__check_limits()
+        if ply > self.seldepth:
+            self.seldepth = ply
+
+        us = pos.side_to_move
+        if ply >= MAX_PLY:
+            return _blend(mg, eg, phase, us)
+
+        moves = pos.generate_legal()
+        if not moves:
+            return -MATE + ply if in_check else 0
+
+        # Standing pat: the side to move is assumed to have a quiet move at
+        # least as good as the static evaluation, unless in check.
+        if in_check:
+            best_score = -INFINITE
+        else:
+            best_score = _blend(mg, eg, phase, us)
+            if best_score >= beta:
+                return best_score
+            if best_score > alpha:
+                alpha = best_score
+
+        board = pos.board
+        if not in_check:
+            moves = [move for move in moves
+                     if board[move & 63] or move & _PROMOTION_MASK == EN_PASSANT
+                     or move & (_PROMOTION_MASK | 0x3000) == _QUEEN_PROMOTION]
+
+        for _, move in self.__order(moves, 0, ply, us):
+            to = move & 63
+            captured = board[to]
+            flag = move & _PROMOTION_MASK
+            # Delta pruning: even winning the piece cannot lift alpha.
+            if (not in_check and flag != PROMOTION
+                    and best_score + MG_VALUE[(captured & 7) or PAWN] + 200 <= alpha):
+                continue
+            child_mg, child_eg, child_phase = self.__update_terms(
+                move, board[(move >> 6) & 63], captured, flag, us, mg, eg, phase)
+            pos.push(move)
+            score = -self.__quiescence(-beta, -alpha, ply + 1,
+                                       child_mg, child_eg, child_phase, pos.in_check())
+            pos.pop()
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        return best_score
+
+    @staticmethod
+    def __update_terms(move: int, piece: int, captured: int, flag: int, us: int,
+                       mg: int, eg: int, phase: int) -> tuple:
+        # The evaluation is updated from the move instead of being recounted
+        # at every node.
+        frm = (move >> 6) & 63
+        to = move & 63
+        moved = piece
+        if flag == PROMOTION:
+            moved = (us << 3) | (((move >> 12) & 3) + KNIGHT)
+            phase += PHASE_WEIGHT[moved & 7]
+        mg += MG_PSQ[moved][to] - MG_PSQ[piece][frm]
+        eg += EG_PSQ[moved][to] - EG_PSQ[piece][frm]
+        if captured:
+            mg -= MG_PSQ[captured][to]
+            eg -= EG_PSQ[captured][to]
+            phase -= PHASE_WEIGHT[captured & 7]
+        elif flag == EN_PASSANT:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            pawn = ((us ^ 1) << 3) | PAWN
+            mg -= MG_PSQ[pawn][cap_sq]
+            eg -= EG_PSQ[pawn][cap_sq]
+        elif flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOKS[to]
+            rook = (us << 3) | ROOK
+            mg += MG_PSQ[rook][rook_to] - MG_PSQ[rook][rook_from]
+            eg += EG_PSQ[rook][rook_to] - EG_PSQ[rook][rook_from]
+        return mg, eg, phase
+
+
+def bench(fens: list = None, movetime: int = 1000, depth: int = None, hash_mb: int = 16,
+          on_result=None) -> dict:
+    """Search each position from a fresh table and report speed and depth."""
+    if fens is None:
+        from perft import PERFT_SUITE
+        fens = [entry["fen"] for entry in PERFT_SUITE.values()]
+
+    results = []
+    for fen in fens:
+        search = Search(hash_mb)
+        limits = {"depth": depth} if depth else {"movetime": movetime}
+        result = search.run(Position(fen), limits)
+        # No iteration may finish in a very short movetime; the position
+        # still counts, at depth 0 and without a score.
+        info = result["info"] or {"depth": 0, "seldepth": 0, "score": None}
+        entry = {
+            "fen": fen,
+            "bestmove": move_to_uci(result["bestmove"]) if result["bestmove"] else None,
+            "depth": info["depth"],
+            "seldepth": info["seldepth"],
+            "score": info["score"],
+            "nodes": result["nodes"],
+            "time": result["time"],
+            "nps": result["nodes"] * 1000 // max(1, result["time"])
+        }
+        results.append(entry)
+        if on_result is not None:
+            on_result(entry)
+
+    nodes = sum(entry["nodes"] for entry in results)
+    elapsed = sum(entry["time"] for entry in results)
+    return {
+        "positions": results,
+        "nodes": nodes,
+        "time": elapsed,
+        "nps": nodes * 1000 // max(1, elapsed),
+        "mean_depth": sum(entry["depth"] for entry in results) / max(1, len(results))
+    }
+
+
+def format_info(info: dict) -> str:
+    score = info["score"]
+    return (f"info depth {info['depth']} seldepth {info['seldepth']} "
+            f"score {score['type']} {score['value']} nodes {info['nodes']} nps {info['nps']} "
+            f"hashfull {info['hashfull']} time {info['time']} pv {' '.join(info['pv'])}").rstrip()
+
+
+class UciEngine:
+    """The UCI front end engine.py launches when no Stockfish binary exists.
+
+    It speaks the subset of the protocol the stockfish wrapper and the rest
+    of PyChess use, including Stockfish's "d" and "go perft" extensions.
+    """
+
+    def __init__(self, output=None):
+        self.output = output or sys.stdout
+        self.search = Search()
+        self.pos = Position()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def send(self, line: str):
+        with self._lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def loop(self, lines) -> int:
+        self.send(f"{NAME} by {AUTHOR}")
+        for line in lines:
+            if not self.command(line.strip()):
+                break
+        self.__stop()
+        return 0
+
+    def command(self, line: str) -> bool:
+        name, _, rest = line.partition(" ")
+        if name == "quit":
+            return False
+        if name == "uci":
+            self.send(f"id name {NAME}")
+            self.send(f"id author {AUTHOR}")
+            self.send("")
+            self.send("option name Hash type spin default 16 min 1 max 1024")
+            self.send("option name Clear Hash type button")
+            self.send("option name Ponder type check default false")
+            self.send("option name Move Overhead type spin default 10 min 0 max 5000")
+            self.send("option name Move Budget type spin default 0 min 0 max 3600000")
+            self.send("uciok")
+        elif name == "isready":
+            self.send("readyok")
+        elif name == "setoption":
+            self.__set_option(rest)
+        elif name == "ucinewgame":
+            self.__stop()
+            self.search.clear()
+        elif name == "position":
+            self.__stop()
+            self.__set_position(rest)
+        elif name == "go":
+            self.__go(rest.split())
+        elif name == "stop":
+            self.__stop()
+        elif name == "ponderhit":
+            self.search.ponderhit()
+        elif name == "d":
+            self.__display()
+        elif name == "bench":
+            self.__bench(rest.split())
+        elif name:
+            self.send(f"Unknown command: '{line}'. Type help for more information.")
+        return True
+
+    def __bench(self, tokens: list):
+        # Takes Stockfish's arguments, hash threads limit fenfile limittype,
+        # so the same command line benchmarks either engine. Threads is
+        # accepted and ignored; fenfile "default" is the perft suite.
+        try:
+            hash_mb = int(tokens[0]) if len(tokens) > 0 else 16
+            limit = int(tokens[2]) if len(tokens) > 2 else DEFAULT_MOVE_BUDGET
+        except ValueError:
+            self.send(f"info string Invalid bench arguments {' '.join(tokens)!r}")
+            return
+        if len(tokens) < 4 or tokens[3] == "default":
+            from perft import PERFT_SUITE
+            fens = [entry["fen"] for entry in PERFT_SUITE.values()]
+        else:
+            try:
+                with open(tokens[3]) as f:
+                    fens = [line.strip() for line in f if line.strip()]
+            except OSError as exc:
+                self.send(f"info string {exc}")
+                return
+        limit_type = tokens[4] if len(tokens) > 4 else "movetime"
+        if limit_type not in ("depth", "movetime"):
+            self.send(f"info string Unsupported bench limit type {limit_type!r}")
+            return
+
+        index = [0]
+
+        def show(entry):
+            index[0] += 1
+            self.send(f"Position: {index[0]}/{len(fens)} ({entry['fen']})")
+            self.send(f"info depth {entry['depth']} nodes {entry['nodes']} time {entry['time']}")
+
+        result = bench(fens, limit, limit if limit_type == "depth" else None, hash_mb, show)
+        self.send("")
+        self.send("===========================")
+        self.send(f"Total time (ms) : {result['time']}")
+        self.send(f"Nodes searched  : {result['nodes']}")
+        self.send(f"Nodes/second    : {result['nps']}")
+
+    def __set_option(self, text: str):
+        name, _, value = text.partition(" value ")
+        name = name.replace("name", "", 1).strip().lower()
+        value = value.strip()
+        try:
+            if name == "hash":
+                self.search.resize(max(1, int(value)))
+            elif name == "clear hash":
+                self.search.clear()
+            elif name == "ponder":
+                self.search.ponder = value.lower() == "true"
+            elif name == "move overhead":
+                self.search.move_overhead = max(0, int(value))
+            elif name == "move budget":
+                self.search.move_budget = max(0, int(value))
+            # Stockfish-only options the wrapper always sets are ignored.
+        except ValueError:
+            self.send(f"info string Invalid value {value!r} for option {name}")
+
+    def __set_position(self, text: str):
+        tokens = text.split()
+        moves = []
+        if "moves" in tokens:
+            moves = tokens[tokens.index("moves") + 1:]
+            tokens = tokens[:tokens.index("moves")]
+        try:
+            pos = Position(START_FEN if tokens[:1] == ["startpos"] else " ".join(tokens[1:]))
+            for move in moves:
+                pos.push(pos.parse_uci(move))
+        except (InvalidFenError, IllegalMoveError, IndexError, ValueError) as exc:
+            self.send(f"info string {exc}")
+            return
+        self.pos = pos
+
+    def __go(self, tokens: list):
+        self.__stop()
+        limits = {"start": time.perf_counter()}
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token in ("infinite", "ponder"):
+                limits[token] = True
+                i += 1
+            elif token == "searchmoves":
+                limits["searchmoves"] = []
+                for uci in tokens[i + 1:]:
+                    try:
+                        limits["searchmoves"].append(self.pos.parse_uci(uci))
+                    except IllegalMoveError:
+                        pass
+                break
+            elif token == "perft" and i + 1 < len(tokens):
+                self.__perft(int(tokens[i + 1]))
+                return
+            elif i + 1 < len(tokens):
+                try:
+                    limits[token] = int(tokens[i + 1])
+                except ValueError:
+                    pass
+                i += 2
+            else:
+                i += 1
+
+        # A searchmoves list that names no legal move leaves nothing to
+        # search, which is how the wrapper's is_move_correct asks.
+        if "searchmoves" in limits and not limits["searchmoves"]:
+            self.send("bestmove (none)")
+            return
+        self._thread = threading.Thread(target=self.__search, args=(self.pos.copy(), limits),
+                                        name="search", daemon=True)
+        self._thread.start()
+
+    def __search(self, pos: Position, limits: dict):
+        result = self.search.run(pos, limits, lambda info: self.send(format_info(info)))
+        if result["info"] is not None and not result["info"]["pv"]:
+            self.send(format_info(result["info"]))
+        if result["bestmove"] is None:
+            self.send("bestmove (none)")
+        elif result["ponder"] is not None:
+            self.send(f"bestmove {move_to_uci(result['bestmove'])} ponder {move_to_uci(result['ponder'])}")
+        else:
+            self.send(f"bestmove {move_to_uci(result['bestmove'])}")
+
+    def __stop(self):
+        if self._thread is not None:
+            self.search.stop()
+            self._thread.join()
+            self._thread = None
+
+    def __perft(self, depth: int):
+        from perft import divide
+
+        counts = divide(self.pos.fen(), depth)
+        for move, count in counts.items():
+            self.send(f"{move}: {count}")
+        self.send("")
+        self.send(f"Nodes searched: {sum(counts.values())}")
+
+    def __display(self):
+        separator = " +---+---+---+---+---+---+---+---+"
+        self.send("")
+        self.send(separator)
+        for rank in range(7, -1, -1):
+            cells = " | ".join(PIECE_SYMBOLS[self.pos.board[rank * 8 + file]] for file in range(8))
+            self.send(f" | {cells} | {rank + 1}")
+            self.send(separator)
+        self.send("   a   b   c   d   e   f   g   h")
+        self.send("")
+        self.send(f"Fen: {self.pos.fen()}")
+        self.send(f"Key: {self.pos.key:016X}")
+        checkers = self.pos.checkers()
+        self.send("Checkers: " + " ".join(SQUARE_NAMES[sq] for sq in range(64) if checkers >> sq & 1))
+
+
+def add_arguments(parser):
+    parser.add_argument("--fen", action="append",
+                        help="position to search, may be repeated (default: the perft suite)")
+    parser.add_argument("--movetime", type=int, default=DEFAULT_MOVE_BUDGET,
+                        help=f"milliseconds per position (default: {DEFAULT_MOVE_BUDGET})")
+    parser.add_argument("--depth", type=int, help="search to a fixed depth instead of a time budget")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table megabytes (default: 16)")
+
+
+def run(args) -> int:
+    def show(entry):
+        score = entry["score"]
+        score_text = f"{score['type']} {score['value']}" if score else "-"
+        print(f"depth {entry['depth']:>2}/{entry['seldepth']:<2} {entry['nodes']:>9} nodes "
+              f"{entry['nps']:>7} nps {entry['time']:>6} ms  {entry['bestmove'] or '(none)':6} "
+              f"{score_text:>9}  {entry['fen']}")
+
+    result = bench(args.fen, args.movetime, args.depth, args.hash, show)
+    print(f"\nTotal: {result['nodes']} nodes in {result['time']} ms, {result['nps']} nps, "
+          f"mean depth {result['mean_depth']:.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(UciEngine().loop(sys.stdin))
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from engine import EnginePool, find_engine
+from position import Position, InvalidFenError, move_to_uci
+from bitboard import BLACK
+from syzygy import Tablebase, TB_DEPTH
+from tune import get_profile
+
+
+# How far past the next position to write, in input order, new positions
+# may be started. A slow position holds back at most this many results.
+ORDER_WINDOW = 256
+
+
+def read_positions(path: os.PathLike):
+    with open(path) as f:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            yield index, *parse_epd(line)
+            index += 1
+
+
+def parse_epd(line: str) -> tuple:
+    fields = line.split(None, 4)
+    fen = " ".join(fields[:4])
+    rest = fields[4] if len(fields) > 4 else ""
+
+    # A plain FEN carries the move counters where EPD carries opcodes.
+    counters = rest.split()
+    if len(counters) >= 2 and counters[0].isdigit() and counters[1].isdigit():
+        return f"{fen} {counters[0]} {counters[1]}", {}
+
+    opcodes = {}
+    for operation in rest.split(";"):
+        operation = operation.strip()
+        if operation:
+            opcode, _, operand = operation.partition(" ")
+            opcodes[opcode] = operand.strip().strip('"')
+    return f"{fen} 0 1", opcodes
+
+
+def analyse_position(pool: EnginePool, index: int, fen: str, opcodes: dict, depth: int,
+                     tablebase: Tablebase = None) -> dict:
+    record = {"index": index, "fen": fen}
+    if "id" in opcodes:
+        record["id"] = opcodes["id"]
+
+    try:
+        pos = Position(fen)
+    except InvalidFenError as exc:
+        record["error"] = str(exc)
+        return record
+
+    start = time.perf_counter()
+    if tablebase is not None and tablebase.covers(pos):
+        ranked = tablebase.root_moves(pos)
+        score = tablebase.score(pos)
+        if ranked and score is not None:
+            # Like analyse(), the score is from white's point of view.
+            if pos.side_to_move == BLACK:
+                score["value"] = -score["value"]
+            bestmove = move_to_uci(ranked[0][0])
+            record.update(depth=TB_DEPTH, score=score, pv=[bestmove], bestmove=bestmove,
+                          nodes=0, tablebase=True)
+            record["time_ms"] = round((time.perf_counter() - start) * 1000)
+            return record
+
+    with pool.engine() as engine:
+        result = engine.analyse(fen, depth)
+    record.update(result)
+    record["time_ms"] = round((time.perf_counter() - start) * 1000)
+    return record
+
+
+def completed_indices(path: os.PathLike) -> set:
+    done = set()
+    try:
+        with open(path, "rb+") as f:
+            # A run that was killed mid-write leaves a partial last line. Cut
+            # it off so appended records start on a fresh line; that position
+            # is simply analysed again.
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                f.truncate(end)
+            for line in data[:end].splitlines():
+                try:
+                    done.add(json.loads(line)["index"])
+                except (ValueError, KeyError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def add_arguments(parser):
+    parser.add_argument("input", help="FEN or EPD file, one position per line")
+    parser.add_argument("--workers", type=int,
+                        help="number of engine processes (default: the tuned profile, else CPU count)")
+    parser.add_argument("--depth", type=int, default=15,
+                        help="search depth per position (default: 15)")
+    parser.add_argument("--threads", type=int,
+                        help="Threads option for every engine (default: the tuned profile, else 1)")
+    parser.add_argument("--hash", type=int,
+                        help="Hash option in MB for every engine (default: the tuned profile, else 16)")
+    parser.add_argument("--engine",
+                        help="path to the UCI engine binary (default: auto-detected)")
+    parser.add_argument("--syzygy", default=os.environ.get("PYCHESS_SYZYGY"),
+                        help="answer positions found in these Syzygy tablebase directories "
+                             "without an engine (default: $PYCHESS_SYZYGY)")
+    parser.add_argument("--no-eval-cache", action="store_true",
+                        help="always search instead of reusing evaluations stored by earlier runs")
+    parser.add_argument("--output", "-o",
+                        help="JSONL output file, also used as checkpoint (default: stdout)")
+    parser.add_argument("--order", choices=("input", "completion"), default="input",
+                        help="write results in input order or as they finish")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip positions already present in --output")
+    parser.add_argument("--progress", type=float, default=10.0,
+                        help="seconds between progress reports on stderr (0 disables)")
+
+
+def run(args) -> int:
+    done = set()
+    if args.resume:
+        if not args.output:
+            print("--resume needs --output", file=sys.stderr)
+            return 2
+        done = completed_indices(args.output)
+
+    out = open(args.output, "a" if args.resume else "w") if args.output else sys.stdout
+
+    if args.workers is None:
+        profile = get_profile(args.engine or find_engine())
+        args.workers = profile["workers"] if profile else os.cpu_count() or 1
+    parameters = {name: value for name, value in (("Threads", args.threads), ("Hash", args.hash))
+                  if value is not None}
+    pool = EnginePool(size=args.workers, path=args.engine, depth=args.depth, parameters=parameters,
+                      cache=False if args.no_eval_cache else None)
+    tablebase = Tablebase(args.syzygy) if args.syzygy else None
+    analysed = 0
+    start = time.perf_counter()
+    last_report = start
+
+    try:
+        pool.warm_up()
+        positions = ((i, fen, ops) for i, fen, ops in read_positions(args.input)
+                     if i not in done)
+
+        # Results that finished ahead of an earlier position wait here when
+        # writing in input order; indices that were already done are skipped.
+        waiting = {}
+        next_index = 0
+        last_submitted = -1
+        window = max(ORDER_WINDOW, 2 * args.workers)
+
+        def write(record: dict):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            pending = set()
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < 2 * args.workers:
+                    if args.order == "input" and last_submitted - next_index >= window:
+                        break
+                    try:
+                        i, fen, opcodes = next(positions)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(
+                        analyse_position, pool, i, fen, opcodes, args.depth, tablebase))
+                    last_submitted = i
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    analysed += 1
+                    if args.order == "completion":
+                        write(record)
+                    else:
+                        waiting[record["index"]] = record
+
+                while args.order == "input":
+                    if next_index in done:
+                        next_index += 1
+                    elif next_index in waiting:
+                        write(waiting.pop(next_index))
+                        next_index += 1
+                    else:
+                        break
+
+                now = time.perf_counter()
+                if args.progress and now - last_report >= args.progress:
+                    last_report = now
+                    print(f"{analysed} positions, {analysed / (now - start):.1f} positions/s",
+                          file=sys.stderr)
+    finally:
+        pool.close()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Analysed {analysed} positions in {elapsed:.1f} s "
+          f"({analysed / elapsed if elapsed > 0 else 0:.1f} positions/s) "
+          f"with {args.workers} engines", file=sys.stderr)
+    return 0
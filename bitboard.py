@@ -0,0 +1,180 @@
+from itertools import product
+
+
+WHITE, BLACK = 0, 1
+
+ALL_PIECES, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(7)
+
+FULL = 0xFFFFFFFFFFFFFFFF
+
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_2 = RANK_1 << 8
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_7 = RANK_1 << 48
+RANK_8 = RANK_1 << 56
+
+FILE_NAMES = "abcdefgh"
+RANK_NAMES = "12345678"
+
+SQUARE_NAMES = [f + r for r, f in product(RANK_NAMES, FILE_NAMES)]
+
+# Squares are numbered like in Stockfish: A1 = 0, H1 = 7, A8 = 56, H8 = 63.
+A1, C1, D1, E1, F1, G1, H1 = 0, 2, 3, 4, 5, 6, 7
+A8, C8, D8, E8, F8, G8, H8 = 56, 58, 59, 60, 61, 62, 63
+
+ROOK_DIRECTIONS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+PAWN_ATTACKS = [[0] * 64, [0] * 64]
+KNIGHT_ATTACKS = [0] * 64
+KING_ATTACKS = [0] * 64
+
+ROOK_MASKS = [0] * 64
+BISHOP_MASKS = [0] * 64
+ROOK_TABLE = [None] * 64
+BISHOP_TABLE = [None] * 64
+ROOK_PSEUDO = [0] * 64
+BISHOP_PSEUDO = [0] * 64
+
+BETWEEN = [[0] * 64 for _ in range(64)]
+LINE = [[0] * 64 for _ in range(64)]
+
+_initialized = False
+
+
+def square(name: str) -> int:
+    return SQUARE_NAMES.index(name.lower())
+
+
+def square_name(sq: int) -> str:
+    return SQUARE_NAMES[sq]
+
+
+def file_of(sq: int) -> int:
+    return sq & 7
+
+
+def rank_of(sq: int) -> int:
+    return sq >> 3
+
+
+def lsb(b: int) -> int:
+    return (b & -b).bit_length() - 1
+
+
+def msb(b: int) -> int:
+    return b.bit_length() - 1
+
+
+def popcount(b: int) -> int:
+    return b.bit_count()
+
+
+def more_than_one(b: int) -> bool:
+    return b & (b - 1) != 0
+
+
+def squares(b: int):
+    while b:
+        yield (b & -b).bit_length() - 1
+        b &= b - 1
+
+
+def rook_attacks(sq: int, occupied: int) -> int:
+    return ROOK_TABLE[sq][occupied & ROOK_MASKS[sq]]
+
+
+def bishop_attacks(sq: int, occupied: int) -> int:
+    return BISHOP_TABLE[sq][occupied & BISHOP_MASKS[sq]]
+
+
+def queen_attacks(sq: int, occupied: int) -> int:
+    return ROOK_TABLE[sq][occupied & ROOK_MASKS[sq]] | BISHOP_TABLE[sq][occupied & BISHOP_MASKS[sq]]
+
+
+def _ray(sq: int, df: int, dr: int) -> list:
+    ray = []
+    f, r = file_of(sq) + df, rank_of(sq) + dr
+    while 0 <= f < 8 and 0 <= r < 8:
+        ray.append(r * 8 + f)
+        f, r = f + df, r + dr
+    return ray
+
+
+def _step_attacks(sq: int, steps) -> int:
+    b = 0
+    for df, dr in steps:
+        f, r = file_of(sq) + df, rank_of(sq) + dr
+        if 0 <= f < 8 and 0 <= r < 8:
+            b |= 1 << (r * 8 + f)
+    return b
+
+
+def _sliding_table(sq: int, directions) -> tuple:
+    # Stockfish indexes its attack tables with a magic multiply of the masked
+    # occupancy. Python ints hash cheaply, so the masked occupancy itself is
+    # the key. Each direction only contributes 2^k subsets, and the full table
+    # is their cartesian product, which keeps start-up well below a second.
+    mask = 0
+    table = {0: 0}
+    for df, dr in directions:
+        ray = _ray(sq, df, dr)
+        relevant = ray[:-1]
+        prefix = []
+        b = 0
+        for s in ray:
+            b |= 1 << s
+            prefix.append(b)
+
+        pairs = []
+        for n in range(1 << len(relevant)):
+            occ = 0
+            for i, s in enumerate(relevant):
+                if n >> i & 1:
+                    occ |= 1 << s
+            attack = prefix[(n & -n).bit_length() - 1] if n else (prefix[-1] if prefix else 0)
+            pairs.append((occ, attack))
+
+        for s in relevant:
+            mask |= 1 << s
+        table = {o1 | o2: a1 | a2 for o1, a1 in table.items() for o2, a2 in pairs}
+    return mask, table
+
+
+def init():
+    global _initialized
+    if _initialized:
+        return
+
+    knight_steps = ((1, 2), (2, 1), (2, -1), (1, -2),
+                    (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+    king_steps = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+
+    for sq in range(64):
+        KNIGHT_ATTACKS[sq] = _step_attacks(sq, knight_steps)
+        KING_ATTACKS[sq] = _step_attacks(sq, king_steps)
+        PAWN_ATTACKS[WHITE][sq] = _step_attacks(sq, ((-1, 1), (1, 1)))
+        PAWN_ATTACKS[BLACK][sq] = _step_attacks(sq, ((-1, -1), (1, -1)))
+
+        ROOK_MASKS[sq], ROOK_TABLE[sq] = _sliding_table(sq, ROOK_DIRECTIONS)
+        BISHOP_MASKS[sq], BISHOP_TABLE[sq] = _sliding_table(
+            sq, BISHOP_DIRECTIONS)
+        ROOK_PSEUDO[sq] = ROOK_TABLE[sq][0]
+        BISHOP_PSEUDO[sq] = BISHOP_TABLE[sq][0]
+
+        for df, dr in king_steps:
+            ray = _ray(sq, df, dr)
+            between = 0
+            for s in ray:
+                BETWEEN[sq][s] = between
+                between |= 1 << s
+            line = between | (1 << sq)
+            for s in _ray(sq, -df, -dr):
+                line |= 1 << s
+            for s in ray:
+                LINE[sq][s] = line
+
+    _initialized = True
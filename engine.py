@@ -0,0 +1,590 @@
+import os
+import sys
+import glob
+import queue
+import atexit
+import shutil
+import threading
+import subprocess
+import stockfish
+import metrics
+from contextlib import contextmanager
+from alphabeta import DEFAULT_MOVE_BUDGET
+from evalcache import EvalCache, get_eval_cache
+from position import Position, move_to_uci
+from tune import get_profile
+
+
+engine_dir = os.path.join(os.path.dirname(__file__), "stockfish")
+stockfish_path = os.path.join(
+    engine_dir, "stockfish.exe" if sys.platform == "win32" else "stockfish")
+
+# Passing this as the engine path, or setting PYCHESS_ENGINE to it, runs the
+# pure Python engine in alphabeta.py. It is also what find_engine falls back
+# to when there is no Stockfish binary.
+BUILTIN_ENGINE = "builtin"
+builtin_command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "alphabeta.py")]
+
+# Places package managers put Stockfish that are often missing from PATH.
+KNOWN_LOCATIONS = {
+    "linux": ("/usr/games/stockfish", "/usr/local/bin/stockfish", "/snap/bin/stockfish"),
+    "darwin": ("/opt/homebrew/bin/stockfish", "/usr/local/bin/stockfish"),
+    "win32": ()
+}
+
+
+class EngineUnavailableError(Exception):
+    pass
+
+
+INFO_INT_FIELDS = ("depth", "seldepth", "multipv", "nodes",
+                   "nps", "time", "hashfull", "tbhits", "currmovenumber")
+
+
+def parse_info(line: str) -> dict:
+    tokens = line.split()
+    info = {}
+    i = 1
+    while i < len(tokens):
+        token = tokens[i]
+        if token in INFO_INT_FIELDS and i + 1 < len(tokens):
+            info[token] = int(tokens[i + 1])
+            i += 2
+        elif token == "score" and i + 2 < len(tokens):
+            info["score"] = {"type": tokens[i + 1], "value": int(tokens[i + 2])}
+            i += 3
+            if i < len(tokens) and tokens[i] in ("lowerbound", "upperbound"):
+                info["score"]["bound"] = tokens[i]
+                i += 1
+        elif token == "wdl" and i + 3 < len(tokens):
+            info["wdl"] = [int(x) for x in tokens[i + 1:i + 4]]
+            i += 4
+        elif token == "currmove" and i + 1 < len(tokens):
+            info["currmove"] = tokens[i + 1]
+            i += 2
+        elif token == "pv":
+            info["pv"] = tokens[i + 1:]
+            break
+        elif token == "string":
+            info["string"] = " ".join(tokens[i + 1:])
+            break
+        else:
+            i += 1
+    return info
+
+
+_found_engine = None
+
+
+def find_engine(refresh: bool = False) -> str:
+    # Looks for a binary in PYCHESS_ENGINE, then the bundled stockfish/
+    # directory (including release names like stockfish-ubuntu-x86-64-avx2),
+    # then PATH and the platform's usual install locations. The answer is
+    # cached for the process. When nothing is found the built-in engine is
+    # used, so moves can still be suggested without Stockfish.
+    global _found_engine
+    if _found_engine is not None and not refresh:
+        return _found_engine
+    if os.environ.get("PYCHESS_ENGINE") == BUILTIN_ENGINE:
+        _found_engine = BUILTIN_ENGINE
+        return _found_engine
+
+    windows = sys.platform == "win32"
+    candidates = [os.environ.get("PYCHESS_ENGINE"), stockfish_path]
+    candidates += sorted(glob.glob(os.path.join(engine_dir, "stockfish*.exe" if windows else "stockfish*")))
+    candidates.append(shutil.which("stockfish"))
+    candidates += KNOWN_LOCATIONS.get(sys.platform, KNOWN_LOCATIONS["linux"])
+
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate) and (windows or os.access(candidate, os.X_OK)):
+            _found_engine = candidate
+            return candidate
+    _found_engine = BUILTIN_ENGINE
+    return _found_engine
+
+
+def engine_command(path: os.PathLike):
+    return builtin_command if path == BUILTIN_ENGINE else path
+
+
+class ChessEngine(stockfish.Stockfish):
+    @metrics.timed("engine.spawn")
+    def __init__(self, path: os.PathLike = None, depth: int = 15, parameters: dict = None, book=None,
+                 cache: EvalCache = None):
+        # cache None means the shared evaluation cache, False none at all.
+        self.book = book
+        self.cache = get_eval_cache() if cache is None else cache or None
+        self.engine_id = None
+        self._launch_path = path or find_engine()
+        self._launch_depth = depth
+        # Options tuned for this host come first, so any given here win.
+        profile = get_profile(self._launch_path)
+        self._launch_parameters = dict(profile["parameters"] if profile else {}, **(parameters or {}))
+        self.restarts = 0
+        self.__launch()
+        metrics.count("engines_spawned")
+
+    @property
+    def builtin(self) -> bool:
+        return self._launch_path == BUILTIN_ENGINE
+
+    def __launch(self):
+        super().__init__(path=engine_command(self._launch_path), depth=self._launch_depth,
+                         parameters=self._launch_parameters)
+        if self.builtin:
+            # Depth limits meant for Stockfish are far out of reach of a
+            # Python search, so they are capped by a per-move time budget.
+            budget = os.environ.get("PYCHESS_MOVE_BUDGET", str(DEFAULT_MOVE_BUDGET))
+            self._set_option("Move Budget", int(budget), False)
+        self.engine_id = self.__identify()
+
+    def __identify(self) -> str:
+        # Cached evaluations are only reused by the engine that made them.
+        self._put("uci")
+        name = None
+        while True:
+            line = self._read_line()
+            if line.startswith("id name "):
+                name = line[len("id name "):]
+            elif line == "uciok":
+                return name or os.path.basename(str(self._launch_path))
+
+    def __uses_cache(self) -> bool:
+        # A deliberately weakened engine's scores are not worth keeping.
+        parameters = self.get_parameters()
+        return (self.cache is not None
+                and str(parameters.get("UCI_LimitStrength", "false")).lower() != "true"
+                and int(parameters.get("Skill Level", 20)) >= 20)
+
+    def is_alive(self) -> bool:
+        return self._stockfish.poll() is None and not self._has_quit_command_been_sent
+
+    def is_healthy(self) -> bool:
+        if not self.is_alive():
+            return False
+        try:
+            self._is_ready()
+        except (stockfish.StockfishException, BrokenPipeError, OSError):
+            return False
+        return True
+
+    @metrics.timed("engine.restart")
+    def restart(self):
+        self.close()
+        self.restarts += 1
+        self.__launch()
+        metrics.count("engines_restarted")
+
+    def send(self, command: str):
+        self._put(command)
+
+    def read_line(self) -> str:
+        return self._read_line()
+
+    @metrics.timed("engine.analyse")
+    def analyse(self, fen: str = None, depth: int = None) -> dict:
+        if fen is not None:
+            self.set_fen_position(fen, False)
+        else:
+            fen = self.get_fen_position()
+        depth = depth or int(self.depth)
+        # Like get_evaluation, report scores from white's point of view.
+        sign = 1 if fen.split()[1] == "w" else -1
+
+        key = None
+        if self.__uses_cache():
+            key = Position(fen).key
+            cached = self.cache.probe(key, self.engine_id, depth)
+            if cached is not None:
+                cached["cached"] = True
+                return cached
+
+        self._put(f"go depth {depth}")
+        last = {}
+        while True:
+            line = self._read_line()
+            if line.startswith("bestmove"):
+                bestmove = line.split()[1]
+                score = dict(last.get("score", {"type": "cp", "value": 0}))
+                score["value"] *= sign
+                metrics.count("nodes_searched", last.get("nodes", 0))
+                result = {
+                    "depth": last.get("depth", 0),
+                    "score": score,
+                    "pv": last.get("pv", []),
+                    "bestmove": None if bestmove == "(none)" else bestmove,
+                    "nodes": last.get("nodes", 0)
+                }
+                if key is not None:
+                    self.cache.store(key, self.engine_id, result)
+                return result
+            if line.startswith("info"):
+                info = parse_info(line)
+                if "score" in info and info.get("multipv", 1) == 1 and "bound" not in info["score"]:
+                    last = info
+
+    @metrics.timed("engine.new_game")
+    def new_game(self):
+        self._put("ucinewgame")
+        self._is_ready()
+
+    @metrics.timed("engine.go")
+    def go(self, fen: str, moves=(), on_info=None, **limits) -> dict:
+        # Searches fen plus moves under UCI limits such as depth, movetime,
+        # nodes or wtime/btime/winc/binc. Unlike analyse, the score is from
+        # the side to move's point of view, the way engines report it.
+        # on_info gets every parsed info line while the search runs, and
+        # another thread may send "stop" to end it early.
+        # A book move is returned straight away without asking the engine.
+        if self.book is not None:
+            pos = Position(fen)
+            for move in moves:
+                pos.push(pos.parse_uci(move))
+            move = self.book.move(pos)
+            if move is not None:
+                metrics.count("book_hits")
+                uci = move_to_uci(move)
+                return {"bestmove": uci, "ponder": None, "score": None, "depth": 0,
+                        "nodes": 0, "time": 0, "pv": [uci], "book": True}
+
+        # A plain depth search of a position without history is the same
+        # question analyse() answers, so it can be served from the cache.
+        key = None
+        if not moves and [name for name, value in limits.items() if value is not None] == ["depth"] \
+                and self.__uses_cache():
+            key = Position(fen).key
+            sign = 1 if fen.split()[1] == "w" else -1
+            cached = self.cache.probe(key, self.engine_id, limits["depth"])
+            if cached is not None:
+                score = dict(cached["score"], value=cached["score"]["value"] * sign)
+                pv = cached["pv"]
+                return {"bestmove": cached["bestmove"], "ponder": pv[1] if len(pv) > 1 else None,
+                        "score": score, "depth": cached["depth"], "nodes": cached["nodes"],
+                        "time": 0, "pv": pv, "cached": True}
+
+        position = f"position fen {fen}"
+        if moves:
+            position += " moves " + " ".join(moves)
+        self._put(position)
+
+        go = " ".join(f"{name} {value}" for name, value in limits.items() if value is not None)
+        self._put(f"go {go or f'depth {self.depth}'}")
+        last = {}
+        while True:
+            line = self._read_line()
+            if line.startswith("bestmove"):
+                parts = line.split()
+                metrics.count("nodes_searched", last.get("nodes", 0))
+                result = {
+                    "bestmove": None if parts[1] == "(none)" else parts[1],
+                    "ponder": parts[3] if len(parts) > 3 else None,
+                    "score": last.get("score"),
+                    "depth": last.get("depth", 0),
+                    "nodes": last.get("nodes", 0),
+                    "time": last.get("time", 0),
+                    "pv": last.get("pv", [])
+                }
+                if key is not None and result["score"] is not None:
+                    score = dict(result["score"], value=result["score"]["value"] * sign)
+                    self.cache.store(key, self.engine_id, dict(result, score=score))
+                return result
+            if line.startswith("info"):
+                info = parse_info(line)
+                if on_info is not None and ("score" in info or "pv" in info):
+                    on_info(info)
+                if "score" in info and info.get("multipv", 1) == 1 and "bound" not in info["score"]:
+                    last = info
+                elif "nodes" in info and last:
+                    last["nodes"] = info["nodes"]
+                    last["time"] = info.get("time", last.get("time", 0))
+
+    @metrics.timed("engine.perft")
+    def perft(self, depth: int, fen: str = None) -> dict:
+        if fen is not None:
+            self.set_fen_position(fen, False)
+        self._put(f"go perft {depth}")
+        counts = {}
+        while True:
+            line = self._read_line()
+            if line.startswith("Nodes searched"):
+                return counts
+            move, sep, count = line.partition(": ")
+            if sep and count.isdigit() and not line.startswith("info"):
+                counts[move] = int(count)
+
+    def close(self, timeout: float = 2.0):
+        if self._stockfish.poll() is None:
+            try:
+                self._put("quit")
+                self._stockfish.wait(timeout)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self._stockfish.kill()
+                self._stockfish.wait()
+        for stream in (self._stockfish.stdin, self._stockfish.stdout):
+            if stream is not None and not stream.closed:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+
+    def __del__(self):
+        if hasattr(self, "_stockfish"):
+            self.close()
+
+
+# Round trips the stockfish wrapper makes on its own.
+metrics.instrument(ChessEngine, "_put", "engine.send")
+metrics.instrument(ChessEngine, "_is_ready", "engine.isready")
+metrics.instrument(ChessEngine, "_set_option", "engine.setoption")
+metrics.instrument(ChessEngine, "is_move_correct", "engine.is_move_correct")
+metrics.instrument(ChessEngine, "get_evaluation", "engine.get_evaluation")
+metrics.instrument(ChessEngine, "get_best_move", "engine.get_best_move")
+
+
+class EnginePool:
+    def __init__(
+        self,
+        size: int = 1,
+        path: os.PathLike = None,
+        depth: int = 15,
+        parameters: dict = None,
+        prewarm: bool = False,
+        book=None,
+        cache: EvalCache = None
+    ):
+        if size < 1:
+            raise ValueError("An engine pool needs at least one engine")
+
+        self.size = size
+        self.path = path or find_engine()
+        self.depth = depth
+        self.parameters = dict(parameters or {})
+        self.book = book
+        self.cache = cache
+
+        self.spawned = 0
+        self.restarted = 0
+
+        self._idle = queue.LifoQueue()
+        self._engines = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+        if prewarm:
+            self.warm_up()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def warm_up(self, count: int = None):
+        count = self.size if count is None else min(count, self.size)
+        engines = []
+        while len(self._engines) + len(engines) < count:
+            engine = self.__spawn()
+            if engine is None:
+                break
+            engines.append(engine)
+        for engine in engines:
+            self._idle.put(engine)
+
+    def acquire(self, timeout: float = None) -> ChessEngine:
+        if self._closed:
+            raise EngineUnavailableError("The engine pool has been closed")
+
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            engine = self.__spawn()
+            if engine is None:
+                try:
+                    engine = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise EngineUnavailableError(
+                        f"No engine became available within {timeout} seconds")
+
+        if not engine.is_healthy():
+            self.__revive(engine)
+        return engine
+
+    def release(self, engine: ChessEngine, broken: bool = False):
+        if engine not in self._engines:
+            raise ValueError("This engine does not belong to the pool")
+
+        if self._closed:
+            self.__retire(engine)
+            return
+
+        if broken or not engine.is_alive():
+            self.__revive(engine)
+        self._idle.put(engine)
+
+    @contextmanager
+    def engine(self, timeout: float = None):
+        engine = self.acquire(timeout)
+        broken = False
+        try:
+            yield engine
+        except (stockfish.StockfishException, BrokenPipeError):
+            broken = True
+            raise
+        finally:
+            self.release(engine, broken)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        while True:
+            try:
+                self.__retire(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "running": len(self._engines),
+            "idle": self._idle.qsize(),
+            "spawned": self.spawned,
+            "restarted": self.restarted
+        }
+
+    def __spawn(self):
+        with self._lock:
+            if len(self._engines) >= self.size:
+                return None
+            self._engines.append(None)
+        try:
+            engine = ChessEngine(self.path, self.depth, self.parameters, self.book, self.cache)
+        except Exception:
+            with self._lock:
+                self._engines.remove(None)
+            raise
+        with self._lock:
+            self._engines[self._engines.index(None)] = engine
+            self.spawned += 1
+        return engine
+
+    def __revive(self, engine: ChessEngine):
+        try:
+            engine.restart()
+        except Exception:
+            self.__retire(engine)
+            raise
+        self.restarted += 1
+
+    def __retire(self, engine: ChessEngine):
+        with self._lock:
+            if engine in self._engines:
+                self._engines.remove(engine)
+        engine.close()
+
+
+class AnalysisDriver:
+    def __init__(self, pool: EnginePool = None):
+        self.pool = pool if pool is not None else get_engine_pool()
+        # Messages are (search id, kind, payload) tuples where kind is
+        # "info", "bestmove" or "error". Consumers drop ids they no longer
+        # care about, so a superseded search never has to be waited for.
+        self.results = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._stopped_id = 0
+        self._engine = None
+        self._engine_id = None
+
+    def start(self, fen: str, depth: int = None, movetime: int = None, infinite: bool = False) -> int:
+        if infinite:
+            command = "go infinite"
+        elif movetime is not None:
+            command = f"go movetime {movetime}"
+        else:
+            command = f"go depth {depth or self.pool.depth}"
+
+        with self._lock:
+            self.__stop_locked()
+            self._last_id += 1
+            search_id = self._last_id
+
+        threading.Thread(target=self.__search, args=(search_id, fen, command),
+                         name=f"analysis-{search_id}", daemon=True).start()
+        return search_id
+
+    def stop(self):
+        with self._lock:
+            self.__stop_locked()
+
+    def is_searching(self) -> bool:
+        return self._engine is not None
+
+    def __stop_locked(self):
+        self._stopped_id = self._last_id
+        if self._engine is not None:
+            self._engine.send("stop")
+
+    def __search(self, search_id: int, fen: str, command: str):
+        try:
+            with self.pool.engine() as engine:
+                with self._lock:
+                    if search_id <= self._stopped_id:
+                        return
+                    engine.set_fen_position(fen, False)
+                    engine.send(command)
+                    self._engine = engine
+                    self._engine_id = search_id
+                try:
+                    self.__stream(search_id, engine)
+                finally:
+                    with self._lock:
+                        if self._engine_id == search_id:
+                            self._engine = None
+                            self._engine_id = None
+        except Exception as exc:
+            self.results.put((search_id, "error", exc))
+
+    def __stream(self, search_id: int, engine: ChessEngine):
+        while True:
+            line = engine.read_line()
+            if line.startswith("info"):
+                info = parse_info(line)
+                if "score" in info or "pv" in info:
+                    self.results.put((search_id, "info", info))
+            elif line.startswith("bestmove"):
+                parts = line.split()
+                self.results.put((search_id, "bestmove", {
+                    "bestmove": None if parts[1] == "(none)" else parts[1],
+                    "ponder": parts[3] if len(parts) > 3 else None
+                }))
+                return
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_engine_pool(size: int = None) -> EnginePool:
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None or _default_pool._closed:
+            if size is None:
+                profile = get_profile(find_engine())
+                size = int(os.environ.get("PYCHESS_ENGINES", profile["workers"] if profile else 1))
+            _default_pool = EnginePool(size=size)
+            metrics.register_source("engine_pool", _default_pool.stats)
+        return _default_pool
+
+
+def shutdown_engine_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+            _default_pool = None
+
+
+atexit.register(shutdown_engine_pool)
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import metrics
+
+
+cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "evals.sqlite")
+
+DEFAULT_SIZE_MB = 64
+# Share of the entries, least recently used first, dropped when the file
+# outgrows its budget. Freed pages are reused, so the file stays near it.
+EVICT_FRACTION = 0.1
+# The size is only checked every so many stores.
+EVICT_CHECK_INTERVAL = 256
+# Hits refresh an entry's last use at most this often, in seconds, so that
+# readers rarely have to write.
+TOUCH_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evals (
+    key INTEGER NOT NULL,
+    engine TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    score_type TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    bestmove TEXT,
+    pv TEXT NOT NULL,
+    nodes INTEGER NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (key, engine)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS evals_used ON evals (used);
+"""
+
+
+class EvalCacheError(ValueError):
+    pass
+
+
+def _signed(key: int) -> int:
+    # Zobrist keys are unsigned 64-bit, SQLite integers are signed.
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+class EvalCache:
+    """Engine evaluations kept in SQLite across sessions and processes.
+
+    Entries are keyed by Zobrist key and engine identity and hold the
+    deepest result seen. The database runs in WAL mode, so any number of
+    processes can read while one writes; every thread gets its own
+    connection.
+    """
+
+    def __init__(self, path: os.PathLike = cache_path, size_mb: int = DEFAULT_SIZE_MB,
+                 timeout: float = 10.0):
+        self.path = path
+        self.size_mb = size_mb
+        self.timeout = timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._stores_since_check = 0
+
+        try:
+            with self.__connection() as db:
+                db.executescript(SCHEMA)
+        except sqlite3.DatabaseError as exc:
+            raise EvalCacheError(f"{path} is not an evaluation cache: {exc}") from None
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def probe(self, key: int, engine: str, min_depth: int = 0):
+        """The stored result for key if it is at least min_depth deep.
+
+        Results look like ChessEngine.analyse() output: the score is from
+        white's point of view.
+        """
+        db = self.__connection()
+        try:
+            row = db.execute(
+                "SELECT depth, score_type, score, bestmove, pv, nodes, used FROM evals "
+                "WHERE key = ? AND engine = ? AND depth >= ?",
+                (_signed(key), engine, min_depth)).fetchone()
+        except sqlite3.OperationalError:
+            # A writer holding the lock past the timeout is just a miss.
+            row = None
+        if row is None:
+            self.misses += 1
+            metrics.count("eval_cache_misses")
+            return None
+
+        depth, score_type, score, bestmove, pv, nodes, used = row
+        now = int(time.time())
+        if now - used >= TOUCH_INTERVAL:
+            try:
+                with db:
+                    db.execute("UPDATE evals SET used = ? WHERE key = ? AND engine = ?",
+                               (now, _signed(key), engine))
+            except sqlite3.OperationalError:
+                pass
+        self.hits += 1
+        metrics.count("eval_cache_hits")
+        return {
+            "depth": depth,
+            "score": {"type": score_type, "value": score},
+            "pv": json.loads(pv),
+            "bestmove": bestmove,
+            "nodes": nodes
+        }
+
+    def store(self, key: int, engine: str, result: dict):
+        # A shallower result never replaces a deeper one.
+        score = result.get("score") or {"type": "cp", "value": 0}
+        db = self.__connection()
+        try:
+            with db:
+                db.execute(
+                    "INSERT INTO evals (key, engine, depth, score_type, score, bestmove, pv, nodes, used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key, engine) DO UPDATE SET depth = excluded.depth, "
+                    "score_type = excluded.score_type, score = excluded.score, "
+                    "bestmove = excluded.bestmove, pv = excluded.pv, nodes = excluded.nodes, "
+                    "used = excluded.used WHERE excluded.depth >= evals.depth",
+                    (_signed(key), engine, result.get("depth", 0), score["type"], score["value"],
+                     result.get("bestmove"), json.dumps(list(result.get("pv", []))),
+                     result.get("nodes", 0), int(time.time())))
+        except sqlite3.OperationalError as exc:
+            print(f"Cannot write to the evaluation cache {self.path}: {exc}", file=sys.stderr)
+            return
+        self.stores += 1
+
+        with self._lock:
+            self._stores_since_check += 1
+            check = self._stores_since_check >= EVICT_CHECK_INTERVAL
+            if check:
+                self._stores_since_check = 0
+        if check:
+            self.evict()
+
+    def evict(self) -> int:
+        db = self.__connection()
+        if self.__used_bytes(db) <= self.size_mb * 1024 * 1024:
+            return 0
+        try:
+            with db:
+                count = db.execute("SELECT COUNT(*) FROM evals").fetchone()[0]
+                drop = max(1, int(count * EVICT_FRACTION))
+                db.execute(
+                    "DELETE FROM evals WHERE (key, engine) IN "
+                    "(SELECT key, engine FROM evals ORDER BY used LIMIT ?)", (drop,))
+        except sqlite3.OperationalError:
+            return 0
+        self.evicted += drop
+        metrics.count("eval_cache_evicted", drop)
+        return drop
+
+    def clear(self):
+        with self.__connection() as db:
+            db.execute("DELETE FROM evals")
+
+    def __len__(self) -> int:
+        return self.__connection().execute("SELECT COUNT(*) FROM evals").fetchone()[0]
+
+    def stats(self) -> dict:
+        probes = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / probes if probes else 0.0,
+            "stores": self.stores,
+            "evicted": self.evicted,
+            "size_mb": self.size_mb,
+            "used_bytes": self.__used_bytes(self.__connection())
+        }
+
+    def __used_bytes(self, db) -> int:
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        pages = db.execute("PRAGMA page_count").fetchone()[0]
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def __connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+            # WAL only needs a sync at checkpoints to stay consistent.
+            db.execute("PRAGMA synchronous = NORMAL")
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+
+_default_cache = None
+_default_cache_failed = False
+_default_cache_lock = threading.Lock()
+
+
+def get_eval_cache() -> EvalCache:
+    # The shared cache lives at PYCHESS_EVAL_CACHE, or next to the program
+    # by default; setting the variable to an empty string turns it off.
+    global _default_cache, _default_cache_failed
+    with _default_cache_lock:
+        if _default_cache is None:
+            path = os.environ.get("PYCHESS_EVAL_CACHE", cache_path)
+            if not path or _default_cache_failed:
+                return None
+            size_mb = int(os.environ.get("PYCHESS_EVAL_CACHE_MB", str(DEFAULT_SIZE_MB)))
+            try:
+                _default_cache = EvalCache(path, size_mb)
+            except (EvalCacheError, sqlite3.Error, OSError) as exc:
+                # Analysis still works without the cache, just more slowly.
+                print(f"Evaluation cache disabled: {exc}", file=sys.stderr)
+                _default_cache_failed = True
+                return None
+            metrics.register_source("eval_cache", _default_cache.stats)
+        return _default_cache
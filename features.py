@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import numpy as np
+from bitboard import PAWN, KING
+from position import Position
+
+
+PIECE_PLANES = 12
+BOARD_SHAPE = (8, 8)
+MOVE_SLOTS = 64 * 64
+DEFAULT_BATCH_SIZE = 4096
+RESULT_VALUES = {"1-0": 1, "0-1": -1, "1/2-1/2": 0}
+
+# Raw columns gathered per position: the six piece-type bitboards, the two
+# colour bitboards, then side to move, castling rights, en passant square
+# (64 for none) and the halfmove clock.
+_BITBOARD_COLUMNS = 8
+_STATE_COLUMNS = 4
+_NO_SQUARE = 64
+
+# Legal move lists of positions seen recently, by Zobrist key. Openings
+# repeat across games, so this spares a good share of move generation.
+_LEGAL_CACHE_SIZE = 65536
+
+
+class PositionBatch:
+    """Raw position data collected one position at a time, encoded at once.
+
+    add() copies a handful of ints out of a Position, which is all the
+    per-position Python work there is; encode() turns the lot into arrays
+    with a few vectorized NumPy operations.
+    """
+
+    def __init__(self, legal_moves: bool = False):
+        self.legal_moves = legal_moves
+        self._legal_cache = {}
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._states) // _STATE_COLUMNS
+
+    def clear(self):
+        self._bitboards = []
+        self._states = []
+        self._moves = []
+        self._results = []
+        self._legal_rows = []
+        self._legal_moves = []
+
+    def add(self, pos: Position, move: int = None, result: int = 0):
+        by_type = pos.by_type
+        self._bitboards += by_type[PAWN:KING + 1]
+        self._bitboards += pos.by_color
+        ep = pos.ep_square
+        self._states += (pos.side_to_move, pos.castling_rights,
+                         _NO_SQUARE if ep is None else ep, pos.halfmove_clock)
+        self._moves.append(-1 if move is None else move & 4095)
+        self._results.append(result)
+
+        if self.legal_moves:
+            moves = self._legal_cache.get(pos.key)
+            if moves is None:
+                # Promotions to different pieces share one from-to slot.
+                moves = list({legal & 4095 for legal in pos.generate_legal()})
+                if len(self._legal_cache) >= _LEGAL_CACHE_SIZE:
+                    self._legal_cache.clear()
+                self._legal_cache[pos.key] = moves
+            self._legal_rows += [len(self._moves) - 1] * len(moves)
+            self._legal_moves += moves
+
+    def encode(self) -> dict:
+        """Arrays for every position added, indexed by position.
+
+        planes       (N, 12, 8, 8) uint8, white P N B R Q K then black,
+                     indexed [rank][file] with a1 at [0][0]
+        side_to_move (N,) uint8, 0 for white and 1 for black
+        castling     (N, 4) uint8, rights K Q k q
+        en_passant   (N, 8, 8) uint8, the en passant target square
+        halfmove     (N,) uint16, the fifty-move rule clock
+        move         (N,) int16, from * 64 + to of the move played, -1 if none
+        result       (N,) int8, the game result for white: 1, 0 or -1
+        legal        (N, 4096) bool, from * 64 + to of every legal move,
+                     only when the batch collects legal moves
+        """
+        count = len(self)
+        bitboards = np.array(self._bitboards, dtype=np.uint64).reshape(count, _BITBOARD_COLUMNS)
+        states = np.array(self._states, dtype=np.int32).reshape(count, _STATE_COLUMNS)
+
+        # Colour by type gives the twelve piece bitboards, whose bits are
+        # then unpacked least significant first so bit n lands on square n.
+        pieces = (bitboards[:, 6:8, None] & bitboards[:, None, :6]).reshape(count, PIECE_PLANES)
+        bits = np.unpackbits(pieces.astype("<u8").view(np.uint8), axis=1, bitorder="little")
+        planes = bits.reshape(count, PIECE_PLANES, *BOARD_SHAPE)
+
+        en_passant = np.zeros((count, 65), dtype=np.uint8)
+        en_passant[np.arange(count), states[:, 2]] = 1
+        castling = ((states[:, 1, None] >> np.arange(4)) & 1).astype(np.uint8)
+
+        encoded = {
+            "planes": planes,
+            "side_to_move": states[:, 0].astype(np.uint8),
+            "castling": castling,
+            "en_passant": en_passant[:, :64].reshape(count, *BOARD_SHAPE),
+            "halfmove": states[:, 3].astype(np.uint16),
+            "move": np.array(self._moves, dtype=np.int16),
+            "result": np.array(self._results, dtype=np.int8)
+        }
+        if self.legal_moves:
+            legal = np.zeros((count, MOVE_SLOTS), dtype=bool)
+            legal[np.array(self._legal_rows, dtype=np.intp), np.array(self._legal_moves, dtype=np.intp)] = True
+            encoded["legal"] = legal
+        return encoded
+
+
+def encode_positions(positions, legal_moves: bool = False) -> dict:
+    batch = PositionBatch(legal_moves)
+    for pos in positions:
+        batch.add(pos)
+    return batch.encode()
+
+
+def iter_batches(games, batch_size: int = DEFAULT_BATCH_SIZE, legal_moves: bool = False,
+                 include_unfinished: bool = False):
+    """Encode the positions of games, batch_size positions at a time.
+
+    Every position before a move is included along with the move played
+    from it and the game's result. Only one batch is held in memory, so any
+    number of games can be streamed; games may span batches.
+    """
+    if batch_size < 1:
+        raise ValueError("A batch needs at least one position")
+    batch = PositionBatch(legal_moves)
+    add = batch.add
+    pending = 0
+    # Most games start from the initial position, and copying it is much
+    # cheaper than parsing its FEN again.
+    start_positions = {}
+    for game in games:
+        result = RESULT_VALUES.get(game.result)
+        if result is None and not include_unfinished:
+            continue
+        fen = game.start_fen
+        start = start_positions.get(fen)
+        if start is None:
+            start = start_positions[fen] = Position(fen)
+            if len(start_positions) > 64:
+                start_positions.clear()
+        pos = start.copy()
+        push = pos.push
+        result = result or 0
+        for move in game.moves:
+            add(pos, move, result)
+            push(move)
+            pending += 1
+            if pending == batch_size:
+                yield batch.encode()
+                batch.clear()
+                pending = 0
+    if pending:
+        yield batch.encode()
+
+
+def iter_file_batches(paths: list, batch_size: int = DEFAULT_BATCH_SIZE, legal_moves: bool = False,
+                      include_unfinished: bool = False):
+    from gamestore import iter_games
+
+    return iter_batches(iter_games(paths), batch_size, legal_moves, include_unfinished)
+
+
+def add_arguments(parser):
+    parser.add_argument("sources", nargs="+", help="PGN/.pcg files or directories to read games from")
+    parser.add_argument("--output", "-o", help="directory to write batch-NNNNNN.npz files to "
+                                               "(default: only measure the encoding speed)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"positions per batch (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--legal", action="store_true", help="include legal move masks")
+    parser.add_argument("--include-unfinished", action="store_true",
+                        help="also encode games without a result")
+    parser.add_argument("--compress", action="store_true", help="write compressed .npz files")
+
+
+def run(args) -> int:
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    save = np.savez_compressed if args.compress else np.savez
+
+    positions = 0
+    batches = 0
+    start = time.perf_counter()
+    for encoded in iter_file_batches(args.sources, args.batch_size, args.legal, args.include_unfinished):
+        if args.output:
+            save(os.path.join(args.output, f"batch-{batches:06}.npz"), **encoded)
+        positions += len(encoded["move"])
+        batches += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"Encoded {positions} positions in {batches} batches in {elapsed:.2f} s, "
+          f"{int(positions / elapsed) if elapsed > 0 else 0} positions/s", file=sys.stderr)
+    return 0
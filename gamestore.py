@@ -0,0 +1,291 @@
+import os
+import sys
+import mmap
+import struct
+import time
+from pgn import Game, RESULTS, read_games, PgnError
+from position import START_FEN
+
+
+STORE_MAGIC = b"PYCHGAME"
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct("<8sII")
+INDEX_MAGIC = b"PYCHGIDX"
+INDEX_HEADER = struct.Struct("<8sQ")
+INDEX_ENTRY = struct.Struct("<Q")
+
+# Per-game record: ply count, result code, reserved byte, length of the tag
+# block. The tag block is padded to an even length so the moves that follow
+# it are an aligned array of 16-bit move codes.
+RECORD_HEADER = struct.Struct("<HBBH")
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+class GameStoreError(ValueError):
+    pass
+
+
+def encode_game(game: Game) -> bytes:
+    if len(game.moves) > 0xFFFF:
+        raise GameStoreError(f"Game has {len(game.moves)} plies, at most 65535 fit")
+
+    # Result is stored as a code and unset roster tags ("?") are dropped.
+    tags = b"".join(
+        f"{tag}\0{value}\0".encode("utf-8") for tag, value in game.headers.items()
+        if tag != "Result" and value != "?")
+    if len(tags) & 1:
+        tags += b"\0"
+    if len(tags) > 0xFFFF:
+        raise GameStoreError("Game tags take more than 64 KiB")
+
+    result = RESULTS.index(game.result) if game.result in RESULTS else RESULTS.index("*")
+    return (RECORD_HEADER.pack(len(game.moves), result, 0, len(tags))
+            + tags + struct.pack(f"<{len(game.moves)}H", *game.moves))
+
+
+def _decode_tags(data) -> dict:
+    fields = bytes(data).rstrip(b"\0").split(b"\0")
+    return {fields[i].decode("utf-8"): fields[i + 1].decode("utf-8")
+            for i in range(0, len(fields) - 1, 2)}
+
+
+class GameStore:
+    def __init__(self, path: os.PathLike, index_path: os.PathLike = None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx"
+        self._data = None
+        self._view = None
+        self._offsets = None
+        self.refresh()
+
+    def refresh(self):
+        # (Re)map the data file and the offset table. Records are
+        # self-describing, so if the table is missing or behind the data file
+        # (another writer, a crash between the two writes) the gap is rebuilt
+        # by walking the records.
+        self.__unmap()
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as f:
+                f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0))
+
+        with open(self.path, "rb") as f:
+            magic, version, _ = STORE_HEADER.unpack(
+                f.read(STORE_HEADER.size).ljust(STORE_HEADER.size, b"\0"))
+        if magic != STORE_MAGIC:
+            raise GameStoreError(f"{self.path} is not a game store")
+        if version != STORE_VERSION:
+            raise GameStoreError(f"{self.path} has unsupported version {version}")
+
+        size = os.path.getsize(self.path)
+        covered = STORE_HEADER.size
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                magic, covered = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size).ljust(INDEX_HEADER.size, b"\0"))
+            if magic != INDEX_MAGIC or not STORE_HEADER.size <= covered <= size:
+                covered = STORE_HEADER.size
+                os.remove(self.index_path)
+        if not os.path.exists(self.index_path):
+            with open(self.index_path, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, covered))
+
+        if size > covered:
+            offsets = []
+            with open(self.path, "rb") as f:
+                f.seek(covered)
+                while covered + RECORD_HEADER.size <= size:
+                    plies, _, _, tags_len = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                    end = covered + RECORD_HEADER.size + tags_len + 2 * plies
+                    if end > size:
+                        break
+                    offsets.append(covered)
+                    f.seek(end)
+                    covered = end
+            self.__extend_index(offsets, covered)
+
+        self.__map()
+
+    def close(self):
+        self.__unmap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._offsets) if self._offsets is not None else 0
+
+    def __getitem__(self, n: int) -> Game:
+        game = Game(self.headers(n), self.moves(n))
+        game.offset = self.__offset(n)
+        return game
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def moves(self, n: int):
+        # A zero-copy view into the mapped file. It stays valid until the
+        # store is refreshed or closed.
+        offset = self.__offset(n)
+        plies, _, _, tags_len = RECORD_HEADER.unpack_from(self._view, offset)
+        start = offset + RECORD_HEADER.size + tags_len
+        moves = self._view[start:start + 2 * plies]
+        if _LITTLE_ENDIAN:
+            return moves.cast("H")
+        return struct.unpack(f"<{plies}H", moves)
+
+    def headers(self, n: int) -> dict:
+        offset = self.__offset(n)
+        _, result, _, tags_len = RECORD_HEADER.unpack_from(self._view, offset)
+        start = offset + RECORD_HEADER.size
+        headers = _decode_tags(self._view[start:start + tags_len])
+        headers["Result"] = RESULTS[result] if result < len(RESULTS) else "*"
+        return headers
+
+    def plies(self, n: int) -> int:
+        return RECORD_HEADER.unpack_from(self._view, self.__offset(n))[0]
+
+    def replay(self, n: int, board, ply: int = None):
+        # The board plays the moves straight from the mapped file, without
+        # the copy a Game would make of them.
+        moves = self.moves(n)
+        try:
+            board.load_moves(self.headers(n).get("FEN", START_FEN), moves, ply)
+        finally:
+            if isinstance(moves, memoryview):
+                moves.release()
+
+    def append(self, game: Game) -> int:
+        return self.extend([game])[0]
+
+    def extend(self, games) -> range:
+        first = len(self)
+        self.__unmap()
+        offsets = []
+        with open(self.path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            covered = f.tell()
+            for game in games:
+                record = encode_game(game)
+                f.write(record)
+                offsets.append(covered)
+                covered += len(record)
+        self.__extend_index(offsets, covered)
+        self.__map()
+        return range(first, first + len(offsets))
+
+    def __offset(self, n: int) -> int:
+        count = len(self)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError(f"game {n} out of range, the store has {count} games")
+        return self._offsets[n]
+
+    def __extend_index(self, offsets: list, covered: int):
+        with open(self.index_path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, covered))
+
+    def __map(self):
+        with open(self.path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.index_path, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._data)
+        index = memoryview(self._index)[INDEX_HEADER.size:]
+        index = index[:len(index) - len(index) % INDEX_ENTRY.size]
+        self._offsets = index.cast("Q") if _LITTLE_ENDIAN else [
+            offset for offset, in INDEX_ENTRY.iter_unpack(index)]
+
+    def __unmap(self):
+        # Views handed out by moves() must be released by their holders
+        # before the maps can close; if one is still alive the map is left
+        # for the garbage collector instead.
+        for name in ("_offsets", "_view"):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+            setattr(self, name, None)
+        for name in ("_data", "_index"):
+            mapped = getattr(self, name, None)
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+            setattr(self, name, None)
+
+
+def pgn_to_store(pgn_path: os.PathLike, store_path: os.PathLike, batch: int = 1000) -> int:
+    store = GameStore(store_path)
+    count = 0
+    games = read_games(pgn_path)
+    try:
+        while True:
+            chunk = [game for _, game in zip(range(batch), games)]
+            if not chunk:
+                return count
+            store.extend(chunk)
+            count += len(chunk)
+    finally:
+        store.close()
+
+
+def store_to_pgn(store_path: os.PathLike, pgn_path: os.PathLike) -> int:
+    with GameStore(store_path) as store, open(pgn_path, "a", encoding="utf-8") as out:
+        for n in range(len(store)):
+            if n or out.tell():
+                out.write("\n")
+            out.write(store[n].to_pgn())
+        return len(store)
+
+
+def iter_games(paths: list):
+    # Games from PGN files, game stores and directories of either, one at a
+    # time. Store games get their moves copied out of the mapped file, since
+    # the store is closed once its games are exhausted.
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.lower().endswith((".pgn", ".pcg")))
+        for file in files:
+            if file.lower().endswith(".pcg"):
+                with GameStore(file) as store:
+                    for n in range(len(store)):
+                        game = store[n]
+                        game.moves = list(game.moves)
+                        yield game
+            else:
+                yield from read_games(file)
+
+
+def add_arguments(parser):
+    parser.add_argument("source", help="PGN file or game store (.pcg) to convert")
+    parser.add_argument("destination", help="game store (.pcg) or PGN file to append to")
+
+
+def run(args) -> int:
+    to_store = args.destination.lower().endswith(".pcg")
+    start = time.perf_counter()
+    try:
+        if to_store:
+            count = pgn_to_store(args.source, args.destination)
+        else:
+            count = store_to_pgn(args.source, args.destination)
+    except (OSError, PgnError, GameStoreError) as exc:
+        print(exc, file=sys.stderr)
+        return 1
+
+    elapsed = time.perf_counter() - start
+    print(f"Converted {count} games in {elapsed:.1f} s: "
+          f"{os.path.getsize(args.source)} -> {os.path.getsize(args.destination)} bytes",
+          file=sys.stderr)
+    return 0
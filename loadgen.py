@@ -0,0 +1,216 @@
+import sys
+import json
+import time
+import random
+import threading
+import http.client
+from position import Position, START_FEN
+from server import DEFAULT_PORT, QUERY_TYPES
+
+
+DEFAULT_MIX = "legal=6,evaluate=3,bestmove=1"
+
+
+def random_positions(count: int, seed: int = None, max_plies: int = 40) -> list:
+    # Positions a few random moves into a game: varied enough that most
+    # requests miss every cache, yet all reachable and legal.
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < count:
+        pos = Position(START_FEN)
+        for _ in range(rng.randrange(max_plies)):
+            moves = pos.legal_moves()
+            if not moves:
+                break
+            pos.push(rng.choice(moves))
+        if pos.legal_moves():
+            fens.append(pos.fen())
+    return fens
+
+
+def parse_mix(text: str) -> tuple:
+    kinds, weights = [], []
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in QUERY_TYPES:
+            raise ValueError(f"Unknown query type {kind!r} in the mix, use {', '.join(QUERY_TYPES)}")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadGenerator:
+    """Clients sending a mix of queries to a server as fast as it answers.
+
+    Each client keeps one connection open for all its requests, the way a
+    tool talking to the server would.
+    """
+
+    def __init__(self, host: str, port: int, fens: list, kinds: list, weights: list,
+                 depth: int = None, movetime: int = None, batch: int = 1, seed: int = None):
+        self.host = host
+        self.port = port
+        self.fens = fens
+        self.kinds = kinds
+        self.weights = weights
+        self.depth = depth
+        self.movetime = movetime
+        self.batch = batch
+        self.seed = seed
+
+        self.latencies = {kind: [] for kind in (*QUERY_TYPES, "batch")}
+        self.rejected = 0
+        self.failed = 0
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def run(self, clients: int, duration: float = None, requests: int = None) -> float:
+        """Run until duration seconds pass or requests are sent; returns the time taken."""
+        remaining = [requests]
+        deadline = None if duration is None else time.perf_counter() + duration
+        threads = [threading.Thread(target=self.__client, args=(i, deadline, remaining), daemon=True)
+                   for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        samples = [value for values in self.latencies.values() for value in values]
+        per_kind = {kind: {"count": len(values),
+                           "p50_ms": 1000 * percentile(values, 0.5),
+                           "p99_ms": 1000 * percentile(values, 0.99)}
+                    for kind, values in self.latencies.items() if values}
+        return {
+            "requests": len(samples),
+            "queries": self.queries,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "seconds": elapsed,
+            "requests_per_second": len(samples) / elapsed if elapsed > 0 else 0.0,
+            "queries_per_second": self.queries / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": 1000 * percentile(samples, 0.5),
+            "p99_ms": 1000 * percentile(samples, 0.99),
+            "kinds": per_kind
+        }
+
+    def __query(self, rng: random.Random) -> dict:
+        kind = rng.choices(self.kinds, self.weights)[0]
+        query = {"type": kind, "fen": rng.choice(self.fens)}
+        if kind != "legal":
+            if self.movetime and kind == "bestmove":
+                query["movetime"] = self.movetime
+            elif self.depth:
+                query["depth"] = self.depth
+        return query
+
+    def __claim(self, deadline: float, remaining: list) -> bool:
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        with self._lock:
+            if remaining[0] is None:
+                return True
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def __client(self, index: int, deadline: float, remaining: list):
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            while self.__claim(deadline, remaining):
+                if self.batch > 1:
+                    kind = "batch"
+                    body = [self.__query(rng) for _ in range(self.batch)]
+                else:
+                    body = self.__query(rng)
+                    kind = body.pop("type")
+                start = time.perf_counter()
+                try:
+                    connection.request("POST", f"/{kind}", json.dumps(body),
+                                       {"Content-Type": "application/json"})
+                    response = connection.getresponse()
+                    data = response.read()
+                except (OSError, http.client.HTTPException):
+                    # The server dropped the connection; open a new one.
+                    connection.close()
+                    with self._lock:
+                        self.failed += 1
+                    time.sleep(0.1)
+                    continue
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    if response.status == 503:
+                        self.rejected += 1
+                    elif response.status != 200:
+                        self.failed += 1
+                    else:
+                        self.latencies[kind].append(elapsed)
+                        self.queries += len(json.loads(data)) if kind == "batch" else 1
+                if response.status == 503:
+                    time.sleep(float(response.getheader("Retry-After", "1")) / 10)
+        finally:
+            connection.close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1", help="server address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"server port (default: {DEFAULT_PORT})")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent connections (default: 8)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run for (default: 10)")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"query types and their weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--depth", type=int, default=8, help="depth of evaluate and bestmove queries (default: 8)")
+    parser.add_argument("--movetime", type=int, help="use movetime instead of depth for bestmove queries")
+    parser.add_argument("--batch", type=int, default=1, help="queries sent per request (default: 1)")
+    parser.add_argument("--positions", type=int, default=200,
+                        help="distinct random positions to query; fewer means more repeats (default: 200)")
+    parser.add_argument("--fens", help="file with one FEN per line to query instead of random positions")
+    parser.add_argument("--seed", type=int, help="seed for positions and query choice")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+
+def run(args) -> int:
+    from analyze import read_positions
+
+    if args.fens:
+        fens = [fen for _, fen, _ in read_positions(args.fens)]
+    else:
+        fens = random_positions(args.positions, args.seed)
+    try:
+        kinds, weights = parse_mix(args.mix)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+
+    generator = LoadGenerator(args.host, args.port, fens, kinds, weights, args.depth,
+                              args.movetime, args.batch, args.seed)
+    elapsed = generator.run(args.clients, None if args.requests else args.duration, args.requests)
+    report = generator.report(elapsed)
+    if not report["requests"] and report["failed"]:
+        print(f"No answers from {args.host}:{args.port}; is the server running?", file=sys.stderr)
+        return 1
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    for kind, summary in report["kinds"].items():
+        print(f"{kind:<9} {summary['count']:>7} requests  p50 {summary['p50_ms']:8.1f} ms  "
+              f"p99 {summary['p99_ms']:8.1f} ms")
+    print(f"\n{report['requests']} requests ({report['queries']} queries) in {elapsed:.1f} s "
+          f"from {args.clients} clients: {report['requests_per_second']:.1f} requests/s, "
+          f"p50 {report['p50_ms']:.1f} ms, p99 {report['p99_ms']:.1f} ms, "
+          f"{report['rejected']} rejected as busy, {report['failed']} failed")
+    return 0
@@ -0,0 +1,441 @@
+import os
+import sys
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from engine import EnginePool
+from position import Position, START_FEN, IllegalMoveError, move_to_uci
+from bitboard import WHITE, BLACK, KNIGHT, BISHOP, popcount
+from pgn import Game, PgnDatabase, read_games
+from analyze import read_positions
+from book import PolyglotBook
+from syzygy import Tablebase, WDL_WIN, WDL_LOSS
+
+
+MATE_SCORE = 100000
+
+# Keys of an engine spec that configure the match rather than the engine's
+# UCI options.
+LIMIT_KEYS = ("depth", "movetime", "nodes", "tc")
+
+
+class EngineSpec:
+    def __init__(self, spec: list, default_name: str):
+        self.path = None
+        self.name = default_name
+        self.limits = {}
+        self.base = None
+        self.increment = 0.0
+        self.book_path = None
+        self.book_depth = 16
+        self.options = {}
+
+        for item in spec or []:
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise ValueError(f"Engine setting {item!r} is not KEY=VALUE")
+            if key == "path":
+                self.path = value
+            elif key == "name":
+                self.name = value
+            elif key == "tc":
+                base, _, increment = value.partition("+")
+                self.base = float(base)
+                self.increment = float(increment or 0)
+            elif key == "book":
+                self.book_path = value
+            elif key == "bookdepth":
+                self.book_depth = int(value)
+            elif key in LIMIT_KEYS:
+                self.limits[key] = int(value)
+            else:
+                self.options[key] = _option_value(value)
+
+        if self.base is None and not self.limits:
+            self.limits["depth"] = 10
+
+    @property
+    def threads(self) -> int:
+        return int(self.options.get("Threads", 1))
+
+    def describe(self) -> str:
+        settings = [f"tc={self.base:g}+{self.increment:g}"] if self.base is not None else []
+        settings += [f"{key}={value}" for key, value in self.limits.items()]
+        if self.book_path:
+            settings.append(f"book={os.path.basename(self.book_path)}:{self.book_depth}")
+        settings += [f"{key}={value}" for key, value in self.options.items()]
+        return f"{self.name} ({', '.join(settings)})"
+
+
+def _option_value(value: str):
+    if value.lstrip("-").isdigit():
+        return int(value)
+    if value.lower() in ("true", "false"):
+        return value.lower()
+    return value
+
+
+def elo_difference(wins: int, losses: int, draws: int) -> tuple:
+    # Elo from the score fraction with a 95% interval from the per-game score
+    # variance, the way cutechess-cli reports it.
+    games = wins + losses + draws
+    if games == 0:
+        return 0.0, float("inf")
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = 1.959964 * math.sqrt(variance / games)
+
+    def elo(s: float) -> float:
+        if s <= 0:
+            return -float("inf")
+        if s >= 1:
+            return float("inf")
+        return -400 * math.log10(1 / s - 1)
+
+    return elo(score), (elo(score + margin) - elo(score - margin)) / 2
+
+
+def _score_value(score: dict) -> int:
+    if score is None:
+        return None
+    if score["type"] == "mate":
+        return MATE_SCORE - abs(score["value"]) if score["value"] > 0 else -MATE_SCORE + abs(score["value"])
+    return score["value"]
+
+
+def _is_repetition(pos: Position, count: int = 3) -> bool:
+    # Each undo record holds the key from before its move, so the history of
+    # keys is the stack plus the current key. Only positions inside the
+    # halfmove clock window, with the same side to move, can repeat.
+    seen = 1
+    history = pos.stack
+    for back in range(2, min(pos.halfmove_clock, len(history)) + 1, 2):
+        if history[-back][5] == pos.key:
+            seen += 1
+            if seen >= count:
+                return True
+    return False
+
+
+def _insufficient_material(pos: Position) -> bool:
+    occupied = pos.by_color[0] | pos.by_color[1]
+    minors = pos.by_type[KNIGHT] | pos.by_type[BISHOP]
+    return popcount(occupied) - popcount(minors) == 2 and popcount(minors) <= 1
+
+
+def game_over(pos: Position) -> tuple:
+    if not pos.legal_moves():
+        if pos.in_check():
+            winner = "0-1" if pos.side_to_move == WHITE else "1-0"
+            return winner, "checkmate"
+        return "1/2-1/2", "stalemate"
+    if pos.halfmove_clock >= 100:
+        return "1/2-1/2", "fifty-move rule"
+    if _is_repetition(pos):
+        return "1/2-1/2", "threefold repetition"
+    if _insufficient_material(pos):
+        return "1/2-1/2", "insufficient material"
+    return None
+
+
+def load_openings(path: os.PathLike, plies: int) -> list:
+    if path is None:
+        return [(START_FEN, [])]
+    if path.lower().endswith(".pgn"):
+        return [(game.start_fen, game.moves[:plies]) for game in read_games(path)]
+    return [(fen, []) for _, fen, _ in read_positions(path)]
+
+
+class MatchRunner:
+    def __init__(
+        self,
+        first: EngineSpec,
+        second: EngineSpec,
+        games: int,
+        openings: list,
+        concurrency: int = None,
+        pgn_path: os.PathLike = None,
+        resign_score: int = None,
+        resign_moves: int = 3,
+        draw_score: int = None,
+        draw_moves: int = 8,
+        draw_after: int = 40,
+        max_moves: int = 300,
+        time_margin: float = 0.05,
+        tablebase: Tablebase = None,
+        on_game=None
+    ):
+        self.specs = (first, second)
+        self.games = games
+        self.openings = openings
+        self.pgn_path = pgn_path
+        self.resign_score = resign_score
+        self.resign_moves = resign_moves
+        self.draw_score = draw_score
+        self.draw_moves = draw_moves
+        self.draw_after = draw_after
+        self.max_moves = max_moves
+        self.time_margin = time_margin
+        self.tablebase = tablebase
+        self.on_game = on_game
+
+        # Only one engine of a game searches at a time, so a game occupies
+        # the larger of the two Threads settings. Never run more games than
+        # the cores can hold.
+        cores = os.cpu_count() or 1
+        limit = max(1, cores // max(first.threads, second.threads))
+        self.concurrency = min(concurrency or limit, limit, games)
+
+        self.wins = 0
+        self.losses = 0
+        self.draws = 0
+        self.records = []
+        self._lock = threading.Lock()
+        self._pgn = PgnDatabase(pgn_path) if pgn_path else None
+
+    def run(self) -> list:
+        books = [PolyglotBook(spec.book_path, spec.book_depth) if spec.book_path else None
+                 for spec in self.specs]
+        pools = [EnginePool(size=self.concurrency, path=spec.path, parameters=spec.options, book=book)
+                 for spec, book in zip(self.specs, books)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for future in [executor.submit(self.play, n, pools) for n in range(self.games)]:
+                    future.result()
+        finally:
+            for pool in pools:
+                pool.close()
+            for book in books:
+                if book is not None:
+                    book.close()
+        return self.records
+
+    def play(self, n: int, pools: list) -> dict:
+        # Each opening is played twice in a row with colors swapped, so the
+        # openings cancel out over the match.
+        fen, opening = self.openings[(n // 2) % len(self.openings)]
+        first_is_white = n % 2 == 0
+        order = (0, 1) if first_is_white else (1, 0)
+
+        with pools[order[0]].engine() as white, pools[order[1]].engine() as black:
+            record = self.__play_game(fen, opening, (white, black),
+                                      [self.specs[i] for i in order])
+
+        record["round"] = n + 1
+        record["first_is_white"] = first_is_white
+        record["white"] = self.specs[order[0]].name
+        record["black"] = self.specs[order[1]].name
+        first_points = {"1-0": 1, "0-1": 0}.get(record["result"], 0.5)
+        if not first_is_white:
+            first_points = 1 - first_points
+
+        with self._lock:
+            if first_points == 1:
+                self.wins += 1
+            elif first_points == 0:
+                self.losses += 1
+            else:
+                self.draws += 1
+            self.records.append(record)
+            if self._pgn is not None:
+                self._pgn.append(self.__pgn_game(record))
+            if self.on_game is not None:
+                self.on_game(self, record)
+        return record
+
+    def __play_game(self, fen: str, opening: list, engines: tuple, specs: list) -> dict:
+        pos = Position(fen)
+        for move in opening:
+            pos.push(move)
+        played = [move_to_uci(move) for move in opening]
+
+        for engine in engines:
+            engine.new_game()
+        clocks = [spec.base for spec in specs]
+        nodes = [0, 0]
+        think = [0.0, 0.0]
+        scores = []
+        result = None
+        start = time.perf_counter()
+
+        while result is None:
+            over = game_over(pos)
+            if over is not None:
+                result, termination = over
+                break
+            if len(played) >= 2 * self.max_moves:
+                result, termination = "1/2-1/2", "move limit"
+                break
+            if self.tablebase is not None:
+                over = self.__adjudicate_tablebase(pos)
+                if over is not None:
+                    result, termination = over
+                    break
+
+            side = pos.side_to_move
+            spec = specs[side]
+            limits = dict(spec.limits)
+            if spec.base is not None:
+                # An opponent limited by depth or nodes has no clock to
+                # report, so only the sides that have one are sent.
+                for color, prefix in ((WHITE, "w"), (BLACK, "b")):
+                    if specs[color].base is not None:
+                        limits[f"{prefix}time"] = round(max(0, clocks[color]) * 1000)
+                        limits[f"{prefix}inc"] = round(specs[color].increment * 1000)
+
+            move_start = time.perf_counter()
+            reply = engines[side].go(fen, played, **limits)
+            elapsed = time.perf_counter() - move_start
+            think[side] += elapsed
+            nodes[side] += reply["nodes"]
+
+            if spec.base is not None:
+                clocks[side] -= elapsed
+                if clocks[side] < -self.time_margin:
+                    result, termination = ("0-1" if side == WHITE else "1-0"), "time forfeit"
+                    break
+                clocks[side] += spec.increment
+
+            try:
+                pos.push(pos.parse_uci(reply["bestmove"] or ""))
+            except IllegalMoveError:
+                result, termination = ("0-1" if side == WHITE else "1-0"), "illegal move"
+                break
+            played.append(reply["bestmove"])
+
+            value = _score_value(reply["score"])
+            scores.append(None if value is None else value if side == WHITE else -value)
+            result, termination = self.__adjudicate(scores, len(played))
+
+        return {
+            "fen": fen,
+            "moves": [entry[0] for entry in pos.stack],
+            "result": result,
+            "termination": termination,
+            "plies": len(played),
+            "wall_time": time.perf_counter() - start,
+            "nps": [round(nodes[i] / think[i]) if think[i] else 0 for i in range(2)],
+            "nodes": nodes
+        }
+
+    def __adjudicate(self, scores: list, plies: int) -> tuple:
+        # Scores are white-relative, one per ply, so the last 2n entries are
+        # n moves of both engines agreeing on the outcome.
+        if self.resign_score is not None and len(scores) >= 2 * self.resign_moves:
+            recent = scores[-2 * self.resign_moves:]
+            if None not in recent:
+                if all(score >= self.resign_score for score in recent):
+                    return "1-0", "adjudication"
+                if all(score <= -self.resign_score for score in recent):
+                    return "0-1", "adjudication"
+        if self.draw_score is not None and plies >= 2 * self.draw_after and len(scores) >= 2 * self.draw_moves:
+            recent = scores[-2 * self.draw_moves:]
+            if None not in recent and all(abs(score) <= self.draw_score for score in recent):
+                return "1/2-1/2", "adjudication"
+        return None, None
+
+    def __adjudicate_tablebase(self, pos: Position) -> tuple:
+        # Cursed wins and blessed losses are draws under the fifty move rule.
+        wdl = self.tablebase.probe_wdl(pos)
+        if wdl is None:
+            return None
+        if wdl in (WDL_WIN, WDL_LOSS):
+            white_wins = (wdl == WDL_WIN) == (pos.side_to_move == WHITE)
+            return ("1-0" if white_wins else "0-1"), "tablebase"
+        return "1/2-1/2", "tablebase"
+
+    def __pgn_game(self, record: dict) -> Game:
+        headers = {
+            "Event": "PyChess match",
+            "Site": "?",
+            "Round": str(record["round"]),
+            "White": record["white"],
+            "Black": record["black"],
+            "Result": record["result"],
+            "Termination": record["termination"],
+            "PlyCount": str(len(record["moves"])),
+            "GameDuration": f"{record['wall_time']:.2f}",
+            "WhiteNps": str(record["nps"][0]),
+            "BlackNps": str(record["nps"][1])
+        }
+        if record["fen"] != START_FEN:
+            headers.update({"SetUp": "1", "FEN": record["fen"]})
+        return Game(headers, record["moves"])
+
+
+def add_arguments(parser):
+    parser.add_argument("--first", nargs="*", metavar="KEY=VALUE",
+                        help="first engine: path=, name=, depth=, movetime=, nodes=, tc=BASE+INC "
+                             "(seconds), book=FILE.bin, bookdepth=PLIES; anything else is a UCI option, e.g. Threads=2 'Skill Level=10'")
+    parser.add_argument("--second", nargs="*", metavar="KEY=VALUE",
+                        help="second engine, same keys as --first")
+    parser.add_argument("--games", type=int, default=100, help="number of games (default: 100)")
+    parser.add_argument("--concurrency", type=int,
+                        help="games played at once (default and cap: cores / engine threads)")
+    parser.add_argument("--openings", help="PGN, FEN or EPD file of opening positions")
+    parser.add_argument("--opening-plies", type=int, default=8,
+                        help="plies taken from each PGN opening (default: 8)")
+    parser.add_argument("--pgn", help="PGN file every finished game is appended to")
+    parser.add_argument("--resign-score", type=int, help="adjudicate a win past this many centipawns")
+    parser.add_argument("--resign-moves", type=int, default=3,
+                        help="moves both engines must agree for a win adjudication (default: 3)")
+    parser.add_argument("--draw-score", type=int, help="adjudicate a draw within this many centipawns")
+    parser.add_argument("--draw-moves", type=int, default=8,
+                        help="moves both engines must agree for a draw adjudication (default: 8)")
+    parser.add_argument("--draw-after", type=int, default=40,
+                        help="earliest move number for draw adjudication (default: 40)")
+    parser.add_argument("--syzygy", default=os.environ.get("PYCHESS_SYZYGY"),
+                        help="adjudicate positions found in these Syzygy tablebase directories "
+                             "(default: $PYCHESS_SYZYGY)")
+    parser.add_argument("--max-moves", type=int, default=300,
+                        help="declare a draw after this many moves (default: 300)")
+
+
+def run(args) -> int:
+    try:
+        first = EngineSpec(args.first, "first")
+        second = EngineSpec(args.second, "second")
+        openings = load_openings(args.openings, args.opening_plies)
+    except (OSError, ValueError) as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    if not openings:
+        print(f"No openings in {args.openings}", file=sys.stderr)
+        return 1
+    if first.name == second.name:
+        first.name, second.name = f"{first.name}-1", f"{second.name}-2"
+
+    def report(runner: MatchRunner, record: dict):
+        played = runner.wins + runner.losses + runner.draws
+        print(f"Game {record['round']} {record['white']} vs {record['black']}: "
+              f"{record['result']} ({record['termination']}, {record['plies']} plies, "
+              f"{record['wall_time']:.1f} s, nps {record['nps'][0]}/{record['nps'][1]})",
+              file=sys.stderr)
+        print(f"Score of {first.name} vs {second.name}: "
+              f"{runner.wins} - {runner.losses} - {runner.draws} [{played}]", file=sys.stderr)
+
+    runner = MatchRunner(first, second, args.games, openings,
+                         concurrency=args.concurrency, pgn_path=args.pgn,
+                         resign_score=args.resign_score, resign_moves=args.resign_moves,
+                         draw_score=args.draw_score, draw_moves=args.draw_moves,
+                         draw_after=args.draw_after, max_moves=args.max_moves,
+                         tablebase=Tablebase(args.syzygy) if args.syzygy else None,
+                         on_game=report)
+    print(f"{first.describe()} vs {second.describe()}, {args.games} games, "
+          f"{runner.concurrency} at a time", file=sys.stderr)
+
+    start = time.perf_counter()
+    records = runner.run()
+    elapsed = time.perf_counter() - start
+
+    elo, error = elo_difference(runner.wins, runner.losses, runner.draws)
+    print(f"Score of {first.name} vs {second.name}: {runner.wins} - {runner.losses} - {runner.draws}")
+    print(f"Elo difference: {elo:+.1f} +/- {error:.1f}")
+    if records:
+        wall = sum(record["wall_time"] for record in records) / len(records)
+        nps = [sum(record["nps"][0 if record["first_is_white"] == (i == 0) else 1]
+                   for record in records) / len(records) for i in range(2)]
+        print(f"{len(records)} games in {elapsed:.1f} s, {wall:.1f} s per game wall clock")
+        print(f"Average nps {first.name} {nps[0]:.0f}, {second.name} {nps[1]:.0f}")
+    return 0
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+
+# Upper bounds in seconds of the latency histogram buckets; the last bucket
+# is unbounded.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FORMATS = ("json", "prometheus")
+PREFIX = "pychess_"
+
+# Nothing is timed or counted until enable() is called: hooked methods stay
+# the plain functions and count()/observe() are no-ops, so instrumentation
+# costs nothing when it is off.
+enabled = False
+
+_hooks = []
+_sources = {}
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+_started = time.time()
+_exporter = None
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation, the same
+        # estimate Prometheus' histogram_quantile() starts from.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        cumulative = []
+        seen = 0
+        for n in self.buckets:
+            seen += n
+            cumulative.append(seen)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([*map(str, BUCKETS), "+Inf"], cumulative))
+        }
+
+
+def count(name: str, value: int = 1):
+    pass
+
+
+def observe(name: str, seconds: float):
+    pass
+
+
+def _count(name: str, value: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _observe(name: str, seconds: float):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def _wrap(func, name: str):
+    clock = time.perf_counter
+
+    @wraps(func)
+    def timed_call(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _observe(name, clock() - start)
+    timed_call.__wrapped_metric__ = name
+    return timed_call
+
+
+def timed(name: str):
+    """Time every call of the decorated method under name once enabled."""
+    def decorate(func):
+        if enabled:
+            return _wrap(func, name)
+        _hooks.append((func, None, None, name))
+        return func
+    return decorate
+
+
+def instrument(owner, attr: str, name: str):
+    # For methods a class inherits and so cannot decorate, like the UCI
+    # helpers of the stockfish wrapper.
+    if enabled:
+        _patch(owner, attr, name)
+    else:
+        _hooks.append((None, owner, attr, name))
+
+
+def register_source(name: str, stats):
+    """Include stats(), a dict of numbers, in every snapshot."""
+    _sources[name] = stats
+
+
+def _patch(owner, attr: str, name: str):
+    func = getattr(owner, attr, None)
+    if func is not None and not hasattr(func, "__wrapped_metric__"):
+        setattr(owner, attr, _wrap(func, name))
+
+
+def _patch_function(func, name: str):
+    # Decorated methods are found again through their qualified name.
+    # Private methods are stored under their mangled attribute name.
+    owner = sys.modules.get(func.__module__)
+    *path, attr = func.__qualname__.split(".")
+    for part in path:
+        owner = getattr(owner, part, None)
+        if owner is None:
+            return
+    if attr.startswith("__") and not attr.endswith("__"):
+        attr = f"_{path[-1].lstrip('_')}{attr}" if path else attr
+    if getattr(owner, attr, None) is func:
+        setattr(owner, attr, _wrap(func, name))
+
+
+def enable(target: str = None, interval: float = 10.0, fmt: str = None):
+    """Turn instrumentation on and optionally export snapshots to target.
+
+    target is a file, rewritten every interval seconds and at exit, or
+    host:port to serve /metrics (Prometheus text) and /metrics.json.
+    """
+    global enabled, count, observe, _exporter
+    with _lock:
+        if not enabled:
+            enabled = True
+            count = _count
+            observe = _observe
+            hooks = _hooks[:]
+            _hooks.clear()
+        else:
+            hooks = []
+    for func, owner, attr, name in hooks:
+        if func is not None:
+            _patch_function(func, name)
+        else:
+            _patch(owner, attr, name)
+
+    if target and _exporter is None:
+        _exporter = Exporter(target, interval, fmt)
+        _exporter.start()
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        latency = {name: histogram.summary() for name, histogram in _histograms.items()}
+    sources = {}
+    for name, stats in list(_sources.items()):
+        try:
+            sources[name] = {key: value for key, value in stats().items()
+                             if isinstance(value, (int, float))}
+        except Exception as exc:
+            sources[name] = {"error": str(exc)}
+    return {
+        "time": time.time(),
+        "uptime": time.time() - _started,
+        "pid": os.getpid(),
+        "counters": counters,
+        "latency": latency,
+        "sources": sources
+    }
+
+
+def _metric_name(name: str) -> str:
+    return PREFIX + "".join(char if char.isalnum() else "_" for char in name)
+
+
+def to_json(data: dict = None) -> str:
+    return json.dumps(data or snapshot(), indent=2, sort_keys=True)
+
+
+def to_prometheus(data: dict = None) -> str:
+    data = data or snapshot()
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        metric = _metric_name(name) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    for name, summary in sorted(data["latency"].items()):
+        metric = _metric_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for bound, n in summary["buckets"].items():
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {n}')
+        lines += [f"{metric}_sum {summary['sum']:.9f}", f"{metric}_count {summary['count']}"]
+    for source, stats in sorted(data["sources"].items()):
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)):
+                metric = _metric_name(f"{source}_{key}")
+                lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def _is_address(target: str) -> bool:
+    if target.startswith("http://"):
+        return True
+    host, _, port = target.rpartition(":")
+    return port.isdigit() and os.sep not in host
+
+
+class Exporter:
+    def __init__(self, target: str, interval: float = 10.0, fmt: str = None):
+        if fmt is not None and fmt not in FORMATS:
+            raise ValueError(f"Unknown metrics format {fmt!r}, use one of {', '.join(FORMATS)}")
+        self.target = target
+        self.interval = interval
+        self.fmt = fmt or ("json" if target.lower().endswith(".json") else "prometheus")
+        self.server = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if _is_address(self.target):
+            self.__serve()
+        else:
+            self._thread = threading.Thread(target=self.__run, daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        elif self._thread is not None:
+            self._thread = None
+            self.write()
+
+    def write(self):
+        text = to_json() if self.fmt == "json" else to_prometheus()
+        tmp_path = f"{self.target}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, self.target)
+
+    def __run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as exc:
+                print(f"Cannot write metrics to {self.target}: {exc}", file=sys.stderr)
+
+    def __serve(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") == "/metrics.json":
+                    body, kind = to_json(), "application/json"
+                elif self.path.rstrip("/") in ("", "/metrics"):
+                    body, kind = to_prometheus(), "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        address = self.target[len("http://"):] if self.target.startswith("http://") else self.target
+        host, _, port = address.rstrip("/").rpartition(":")
+        self.server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+if os.environ.get("PYCHESS_METRICS"):
+    enable(os.environ["PYCHESS_METRICS"], float(os.environ.get("PYCHESS_METRICS_INTERVAL", "10")))
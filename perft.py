@@ -0,0 +1,227 @@
+import os
+import json
+import sys
+import time
+import argparse
+from position import Position, START_FEN, move_to_uci
+
+
+# Speeds from an earlier --suite run on this machine. They mean nothing on
+# another one, so the file is saved locally and never committed; the node
+# counts it is checked against are in PERFT_SUITE.
+baseline_path = os.path.join(os.path.dirname(__file__), "perft_baseline.json")
+
+# Reference node counts from the Chess Programming Wiki perft results page.
+# "depth" is the depth run by the regression suite; deeper counts are kept
+# for manual runs.
+PERFT_SUITE = {
+    "startpos": {
+        "fen": START_FEN,
+        "depth": 4,
+        "nodes": [20, 400, 8902, 197281, 4865609]
+    },
+    "kiwipete": {
+        "fen": "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        "depth": 3,
+        "nodes": [48, 2039, 97862, 4085603]
+    },
+    "position3": {
+        "fen": "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        "depth": 5,
+        "nodes": [14, 191, 2812, 43238, 674624]
+    },
+    "position4": {
+        "fen": "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        "depth": 3,
+        "nodes": [6, 264, 9467, 422333]
+    },
+    "position4_mirrored": {
+        "fen": "r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+        "depth": 3,
+        "nodes": [6, 264, 9467, 422333]
+    },
+    "position5": {
+        "fen": "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        "depth": 3,
+        "nodes": [44, 1486, 62379, 2103487]
+    },
+    "position6": {
+        "fen": "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        "depth": 3,
+        "nodes": [46, 2079, 89890, 3894594]
+    }
+}
+
+
+def _perft(pos: Position, depth: int) -> int:
+    moves = pos.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        pos.push(move)
+        nodes += _perft(pos, depth - 1)
+        pos.pop()
+    return nodes
+
+
+def perft(fen: str = START_FEN, depth: int = 1) -> int:
+    if depth < 1:
+        return 1
+    return _perft(Position(fen), depth)
+
+
+def divide(fen: str = START_FEN, depth: int = 1) -> dict:
+    pos = Position(fen)
+    counts = {}
+    for move in pos.legal_moves():
+        if depth <= 1:
+            counts[move_to_uci(move)] = 1
+            continue
+        pos.push(move)
+        counts[move_to_uci(move)] = _perft(pos, depth - 1)
+        pos.pop()
+    return counts
+
+
+def compare_divide(ours: dict, theirs: dict) -> dict:
+    return {move: (ours.get(move), theirs.get(move))
+            for move in sorted(set(ours) | set(theirs))
+            if ours.get(move) != theirs.get(move)}
+
+
+def engine_divide(fen: str, depth: int, pool=None) -> dict:
+    from engine import get_engine_pool
+
+    if pool is None:
+        pool = get_engine_pool()
+    with pool.engine() as engine:
+        return engine.perft(depth, fen)
+
+
+def run_suite(depth: int = None, names: list = None) -> list:
+    results = []
+    for name, entry in PERFT_SUITE.items():
+        if names and name not in names:
+            continue
+        d = min(depth if depth is not None else entry["depth"], len(entry["nodes"]))
+        start = time.perf_counter()
+        nodes = perft(entry["fen"], d)
+        elapsed = time.perf_counter() - start
+        results.append({
+            "name": name,
+            "depth": d,
+            "nodes": nodes,
+            "expected": entry["nodes"][d - 1] if d else 1,
+            "seconds": elapsed,
+            "nps": int(nodes / elapsed) if elapsed > 0 else 0
+        })
+    return results
+
+
+def _depth(text: str) -> int:
+    try:
+        depth = int(text)
+    except ValueError:
+        depth = -1
+    if depth < 0:
+        raise argparse.ArgumentTypeError(f"depth must be a whole number of at least 0, got {text!r}")
+    return depth
+
+
+def add_arguments(parser):
+    parser.add_argument("--fen", default=START_FEN,
+                        help="position to count (default: start position)")
+    parser.add_argument("--depth", type=_depth, default=None,
+                        help="search depth (default: 4, or each suite entry's own depth)")
+    parser.add_argument("--divide", action="store_true",
+                        help="print per-move node counts")
+    parser.add_argument("--compare", action="store_true",
+                        help="check the divide output against Stockfish's go perft")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the standard perft positions as a regression benchmark")
+    parser.add_argument("--baseline", metavar="FILE", default=baseline_path,
+                        help="JSON file with nodes per second from an earlier --suite run on this "
+                             "machine, written by --save-baseline (default: perft_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write this --suite run to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline (default: 0.2)")
+
+
+def run(args) -> int:
+    if args.suite:
+        return _run_suite(args)
+
+    depth = args.depth if args.depth is not None else 4
+    if args.compare and depth < 1:
+        print("--compare needs a depth of at least 1", file=sys.stderr)
+        return 2
+    start = time.perf_counter()
+    # At depth 0 there are no moves to divide by, only the position itself.
+    if (args.divide or args.compare) and depth > 0:
+        counts = divide(args.fen, depth)
+        nodes = sum(counts.values())
+    else:
+        counts = {}
+        nodes = perft(args.fen, depth)
+    elapsed = time.perf_counter() - start
+
+    for move, count in counts.items():
+        print(f"{move}: {count}")
+    if counts:
+        print()
+    print(f"Nodes searched: {nodes}")
+    print(f"Time (s): {elapsed:.3f}")
+    print(f"Nodes/second: {int(nodes / elapsed) if elapsed > 0 else 0}")
+
+    if args.compare:
+        mismatches = compare_divide(counts, engine_divide(args.fen, depth))
+        if mismatches:
+            print("\nMismatches against Stockfish (ours, stockfish):")
+            for move, (ours, theirs) in mismatches.items():
+                print(f"{move}: {ours}, {theirs}")
+            return 1
+        print("\nDivide matches Stockfish")
+    return 0
+
+
+def _run_suite(args) -> int:
+    baseline = {}
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"No baseline at {args.baseline}, so speed is not compared; "
+                  f"--save-baseline records one for this machine\n")
+
+    failed = 0
+    results = run_suite(args.depth)
+    total_nodes = sum(r["nodes"] for r in results)
+    total_time = sum(r["seconds"] for r in results)
+
+    for r in results:
+        status = "ok" if r["nodes"] == r["expected"] else "WRONG"
+        line = f"{r['name']:<20} depth {r['depth']}  {r['nodes']:>10} nodes  {r['nps']:>9} nps  {status}"
+        if r["name"] in baseline:
+            previous = baseline[r["name"]]["nps"]
+            change = r["nps"] / previous - 1 if previous else 0.0
+            line += f"  {change:+.1%} vs baseline"
+            if change < -args.tolerance:
+                line += " SLOWER"
+                failed += 1
+        if status != "ok":
+            failed += 1
+        print(line)
+
+    print(f"\nTotal: {total_nodes} nodes in {total_time:.3f} s, "
+          f"{int(total_nodes / total_time) if total_time > 0 else 0} nps")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({r["name"]: {"depth": r["depth"], "nps": r["nps"]}
+                       for r in results}, f, indent=4)
+        print(f"Baseline written to {args.baseline}")
+
+    return 1 if failed else 0
@@ -0,0 +1,311 @@
+import io
+import os
+import re
+import struct
+import sys
+from position import Position, START_FEN, IllegalMoveError, move_to_uci
+
+
+SEVEN_TAG_ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+INDEX_MAGIC = b"PYCHPGNI"
+INDEX_HEADER = struct.Struct("<8sQ")
+INDEX_ENTRY = struct.Struct("<Q")
+
+_TAG_PATTERN = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]\s*$')
+_TOKEN_PATTERN = re.compile(
+    r"\{[^}]*\}|;[^\n]*|\$\d+|\(|\)|\d+\.+|[^\s(){};]+")
+
+
+class PgnError(ValueError):
+    pass
+
+
+class Game:
+    def __init__(self, headers: dict = None, moves: list = None):
+        self.headers = dict(headers or {})
+        for tag in SEVEN_TAG_ROSTER:
+            self.headers.setdefault(tag, "*" if tag == "Result" else "?")
+        self.moves = list(moves or [])
+        self.offset = None
+
+    @property
+    def result(self) -> str:
+        return self.headers.get("Result", "*")
+
+    @property
+    def start_fen(self) -> str:
+        return self.headers.get("FEN", START_FEN)
+
+    def uci_moves(self) -> list:
+        return [move_to_uci(move) for move in self.moves]
+
+    def positions(self):
+        pos = Position(self.start_fen)
+        yield pos
+        for move in self.moves:
+            pos.push(move)
+            yield pos
+
+    def end_position(self) -> Position:
+        pos = Position(self.start_fen)
+        for move in self.moves:
+            pos.push(move)
+        return pos
+
+    def to_pgn(self, width: int = 79) -> str:
+        lines = [f'[{tag} "{_escape(value)}"]' for tag, value in self.__ordered_headers()]
+        lines.append("")
+
+        pos = Position(self.start_fen)
+        tokens = []
+        for i, move in enumerate(self.moves):
+            if pos.side_to_move == 0:
+                tokens.append(f"{pos.fullmove_number}.")
+            elif i == 0:
+                tokens.append(f"{pos.fullmove_number}...")
+            tokens.append(pos.san(move))
+            pos.push(move)
+        tokens.append(self.result)
+
+        line = ""
+        for token in tokens:
+            if line and len(line) + 1 + len(token) > width:
+                lines.append(line)
+                line = token
+            else:
+                line = f"{line} {token}" if line else token
+        lines.append(line)
+        return "\n".join(lines) + "\n\n"
+
+    def __ordered_headers(self):
+        for tag in SEVEN_TAG_ROSTER:
+            yield tag, self.headers[tag]
+        for tag, value in self.headers.items():
+            if tag not in SEVEN_TAG_ROSTER:
+                yield tag, value
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _unescape(value: str) -> str:
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def _open_binary(source):
+    if isinstance(source, (str, bytes, os.PathLike)):
+        return open(source, "rb"), True
+    if isinstance(source, io.TextIOBase):
+        return source.buffer, False
+    return source, False
+
+
+def iter_raw_games(source):
+    # Yields (byte offset, header lines, movetext lines) for every game while
+    # reading the file line by line, so memory use is bounded by one game.
+    f, owned = _open_binary(source)
+    try:
+        offset = f.tell()
+        start = None
+        headers = []
+        movetext = []
+        in_movetext = False
+        for raw in f:
+            line = raw.decode("utf-8", "replace").strip()
+            if line.startswith("[") and (in_movetext or start is None):
+                if start is not None:
+                    yield start, headers, movetext
+                start = offset
+                headers = []
+                movetext = []
+                in_movetext = False
+            if line.startswith("[") and not in_movetext:
+                headers.append(line)
+            elif line and not line.startswith("%"):
+                if start is None:
+                    start = offset
+                in_movetext = True
+                movetext.append(line)
+            offset += len(raw)
+        if start is not None:
+            yield start, headers, movetext
+    finally:
+        if owned:
+            f.close()
+
+
+def parse_headers(lines: list) -> dict:
+    headers = {}
+    for line in lines:
+        match = _TAG_PATTERN.match(line)
+        if match:
+            headers[match.group(1)] = _unescape(match.group(2))
+    return headers
+
+
+def parse_movetext(text: str, start_fen: str = START_FEN) -> tuple:
+    # Only the main line is kept: comments, NAGs, move numbers and nested
+    # variations are skipped.
+    pos = Position(start_fen)
+    moves = []
+    result = "*"
+    depth = 0
+    for token in _TOKEN_PATTERN.findall(text):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(0, depth - 1)
+        elif depth or token[0] in "{;$" or token[0].isdigit() and token.endswith("."):
+            continue
+        elif token in RESULTS:
+            result = token
+        else:
+            try:
+                move = pos.parse_san(token)
+            except IllegalMoveError as exc:
+                raise PgnError(f"{exc} (move {len(moves) // 2 + 1})") from None
+            pos.push(move)
+            moves.append(move)
+    return moves, result
+
+
+def read_games(source, headers_only: bool = False):
+    for offset, header_lines, movetext in iter_raw_games(source):
+        headers = parse_headers(header_lines)
+        game = Game(headers)
+        game.offset = offset
+        if not headers_only:
+            # Lines stay apart: a ; comment ends at its line break.
+            game.moves, result = parse_movetext(
+                "\n".join(movetext), game.start_fen)
+            if "Result" not in headers:
+                game.headers["Result"] = result
+        yield game
+
+
+def read_game(source, offset: int = 0) -> Game:
+    f, owned = _open_binary(source)
+    try:
+        f.seek(offset)
+        for game in read_games(f):
+            return game
+        return None
+    finally:
+        if owned:
+            f.close()
+
+
+def write_game(game: Game, out):
+    out.write(game.to_pgn())
+
+
+def append_game(path: os.PathLike, game: Game) -> int:
+    text = game.to_pgn().encode("utf-8")
+    with open(path, "ab") as f:
+        # Position before writing is the new game's offset; opening in append
+        # mode never rewrites what is already on disk.
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        if offset:
+            f.write(b"\n")
+            offset += 1
+        f.write(text)
+    game.offset = offset
+    return offset
+
+
+class PgnDatabase:
+    def __init__(self, path: os.PathLike, index_path: os.PathLike = None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx"
+        self.refresh()
+
+    def refresh(self):
+        # The index is a small header (magic, bytes of PGN covered) followed
+        # by one fixed-width offset per game, so game N is a single seek away.
+        # Anything appended to the PGN since the last run is indexed now.
+        covered = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                magic, covered = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size) or bytes(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC or covered > self.__pgn_size():
+                covered = 0
+        if covered == 0:
+            with open(self.index_path, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, 0))
+
+        size = self.__pgn_size()
+        if size > covered:
+            with open(self.path, "rb") as pgn:
+                pgn.seek(covered)
+                offsets = [offset for offset, _, _ in iter_raw_games(pgn)]
+            self.__extend_index(offsets, size)
+
+    def __len__(self) -> int:
+        return (os.path.getsize(self.index_path) - INDEX_HEADER.size) // INDEX_ENTRY.size
+
+    def __getitem__(self, n: int) -> Game:
+        return read_game(self.path, self.offset(n))
+
+    def __iter__(self):
+        return read_games(self.path)
+
+    def offset(self, n: int) -> int:
+        count = len(self)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError(f"game {n} out of range, the database has {count} games")
+        with open(self.index_path, "rb") as f:
+            f.seek(INDEX_HEADER.size + n * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+
+    def append(self, game: Game) -> int:
+        offset = append_game(self.path, game)
+        self.__extend_index([offset], self.__pgn_size())
+        return len(self) - 1
+
+    def __pgn_size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def __extend_index(self, offsets: list, covered: int):
+        with open(self.index_path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, covered))
+
+
+def add_arguments(parser):
+    parser.add_argument("file", help="PGN file, indexed next to it as <file>.idx")
+    parser.add_argument("--game", type=int, action="append",
+                        help="print game N (0-based, negative counts from the end); repeatable")
+    parser.add_argument("--uci", action="store_true",
+                        help="print the moves of --game as UCI instead of PGN")
+
+
+def run(args) -> int:
+    if not os.path.isfile(args.file):
+        print(f"No such file: {args.file}", file=sys.stderr)
+        return 1
+    db = PgnDatabase(args.file)
+
+    if not args.game:
+        print(f"{len(db)} games in {args.file}")
+        return 0
+
+    for n in args.game:
+        try:
+            game = db[n]
+        except (IndexError, PgnError) as exc:
+            print(f"Game {n}: {exc}", file=sys.stderr)
+            return 1
+        if args.uci:
+            print(" ".join(game.uci_moves()))
+        else:
+            sys.stdout.write(game.to_pgn())
+    return 0
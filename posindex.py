@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import mmap
+import heapq
+import struct
+import time
+from bisect import bisect_left, bisect_right
+from bitboard import WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, popcount, squares
+from position import Position, ZOBRIST_PSQ, InvalidFenError
+from gamestore import GameStore
+
+
+# One entry per distinct key per game: the key, the game id and the first
+# ply at which the game had that key.
+ENTRY = struct.Struct("<QIH2x")
+KINDS = ("position", "material", "pawns")
+MAX_SEGMENTS = 8
+# Bumped whenever the keys change. Version 2 keys games that start from a
+# FEN naming an en passant square no pawn can take like any other game.
+INDEX_VERSION = 2
+
+_MATERIAL_TYPES = (PAWN, KNIGHT, BISHOP, ROOK, QUEEN)
+_MATERIAL_SYMBOLS = "PNBRQ"
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+class SignatureError(ValueError):
+    pass
+
+
+def material_key(pos: Position) -> int:
+    # Piece counts packed four bits each, white P N B R Q then black.
+    key = 0
+    for color in (WHITE, BLACK):
+        pieces = pos.by_color[color]
+        for piece_type in _MATERIAL_TYPES:
+            key = key << 4 | min(15, popcount(pieces & pos.by_type[piece_type]))
+    return key
+
+
+def pawn_key(pos: Position) -> int:
+    # Same idea as Stockfish's pawn key: the Zobrist keys of every pawn.
+    key = 0
+    for color in (WHITE, BLACK):
+        psq = ZOBRIST_PSQ[color << 3 | PAWN]
+        for sq in squares(pos.by_color[color] & pos.by_type[PAWN]):
+            key ^= psq[sq]
+    return key
+
+
+def parse_material(signature: str) -> int:
+    # "KRPvKR" style, white first. Kings are optional.
+    sides = signature.upper().replace("VS", "V").split("V")
+    if len(sides) != 2:
+        raise SignatureError(f"Material signature {signature!r} needs the form KRPvKR")
+    key = 0
+    for side in sides:
+        side = side.replace("K", "")
+        if any(symbol not in _MATERIAL_SYMBOLS for symbol in side):
+            raise SignatureError(f"Unknown piece in material signature {signature!r}")
+        for symbol in _MATERIAL_SYMBOLS:
+            count = side.count(symbol)
+            # Each count has four bits, as in material_key; no position
+            # has more than 15 of a piece anyway.
+            if count > 15:
+                raise SignatureError(f"Material signature {signature!r} has more than 15 of {symbol}")
+            key = key << 4 | count
+    return key
+
+
+class _Segment:
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else None
+        self.count = os.path.getsize(path) // ENTRY.size
+        if self._map is None:
+            self._keys = ()
+        elif _LITTLE_ENDIAN:
+            # Entries are two 64-bit words wide, so every other word is a key.
+            self._keys = memoryview(self._map).cast("Q")[::2]
+        else:
+            self._keys = [key for key, _, _ in ENTRY.iter_unpack(self._map)]
+
+    def find(self, key: int) -> list:
+        start = bisect_left(self._keys, key)
+        end = bisect_right(self._keys, key, start)
+        return [ENTRY.unpack_from(self._map, i * ENTRY.size)[1:] for i in range(start, end)]
+
+    def __iter__(self):
+        if self._map is not None:
+            yield from ENTRY.iter_unpack(self._map)
+
+    def close(self):
+        if isinstance(self._keys, memoryview):
+            self._keys.release()
+        if self._map is not None:
+            self._map.close()
+
+
+class PositionIndex:
+    def __init__(self, store_path: os.PathLike, index_dir: os.PathLike = None):
+        self.store_path = store_path
+        self.index_dir = index_dir or f"{store_path}.pidx"
+        self.manifest_path = os.path.join(self.index_dir, "manifest.json")
+        self.games = 0
+        self.segments = []
+        self._segments = {kind: [] for kind in KINDS}
+        self.__load()
+
+    def update(self, progress=None, chunk: int = 50000) -> int:
+        # Index only the games appended to the store since the last update.
+        # Every chunk of games becomes one new sorted segment per kind and is
+        # committed on its own; once there are too many segments they are
+        # merged so a lookup stays a handful of binary searches.
+        first = self.games
+        with GameStore(self.store_path) as store:
+            total = len(store)
+            while self.games < total:
+                end = min(total, self.games + chunk)
+                entries = {kind: [] for kind in KINDS}
+                for game_id in range(self.games, end):
+                    self.__index_game(game_id, store.headers(game_id).get("FEN"),
+                                      store.moves(game_id), entries)
+                    if progress is not None:
+                        progress(game_id + 1 - first, total - first)
+
+                number = max(self.segments, default=0) + 1
+                os.makedirs(self.index_dir, exist_ok=True)
+                for kind, items in entries.items():
+                    items.sort()
+                    self.__write_segment(self.__segment_path(number, kind), items)
+                self.__save(end, self.segments + [number])
+
+        if len(self.segments) > MAX_SEGMENTS:
+            self.compact()
+        return self.games - first
+
+    def compact(self):
+        if len(self.segments) <= 1:
+            return
+        number = max(self.segments) + 1
+        for kind in KINDS:
+            self.__write_segment(self.__segment_path(number, kind),
+                                 heapq.merge(*self._segments[kind]))
+        old = self.segments
+        self.__save(self.games, [number])
+        for old_number in old:
+            for kind in KINDS:
+                os.remove(self.__segment_path(old_number, kind))
+
+    def find_position(self, position, limit: int = None) -> list:
+        pos = self.__position(position)
+        return self.__find("position", pos.key, limit)
+
+    def find_material(self, signature, limit: int = None) -> list:
+        if isinstance(signature, str):
+            signature = parse_material(signature)
+        elif isinstance(signature, Position):
+            signature = material_key(signature)
+        return self.__find("material", signature, limit)
+
+    def find_pawns(self, position, limit: int = None) -> list:
+        return self.__find("pawns", pawn_key(self.__position(position)), limit)
+
+    def close(self):
+        for segments in self._segments.values():
+            for segment in segments:
+                segment.close()
+        self._segments = {kind: [] for kind in KINDS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __find(self, kind: str, key: int, limit: int) -> list:
+        found = []
+        for segment in self._segments[kind]:
+            found.extend(segment.find(key))
+        found.sort()
+        return found[:limit] if limit is not None else found
+
+    @staticmethod
+    def __position(position) -> Position:
+        return position if isinstance(position, Position) else Position(position)
+
+    @staticmethod
+    def __index_game(game_id: int, fen: str, moves, entries: dict):
+        pos = Position(fen) if fen else Position()
+        seen = ({}, {}, {})
+        for ply in range(len(moves) + 1):
+            if ply:
+                pos.push(moves[ply - 1])
+            # Only the first ply a game reaches each key is kept; repeated
+            # positions and the long runs of equal material add nothing.
+            for seen_keys, key in zip(seen, (pos.key, material_key(pos), pawn_key(pos))):
+                if key not in seen_keys:
+                    seen_keys[key] = ply
+        for kind, seen_keys in zip(KINDS, seen):
+            entries[kind].extend((key, game_id, ply) for key, ply in seen_keys.items())
+
+    def __segment_path(self, number: int, kind: str) -> str:
+        return os.path.join(self.index_dir, f"{number:06d}.{kind}")
+
+    @staticmethod
+    def __write_segment(path: str, items):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            batch = []
+            for item in items:
+                batch.append(ENTRY.pack(*item))
+                if len(batch) >= 65536:
+                    f.write(b"".join(batch))
+                    batch = []
+            f.write(b"".join(batch))
+        os.replace(tmp_path, path)
+
+    def __save(self, games: int, segments: list):
+        # The manifest is replaced atomically after the segments are on disk,
+        # so a crash leaves either the old index or the new one.
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "games": games, "segments": segments}, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.close()
+        self.__load()
+
+    def __load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {"games": 0, "segments": []}
+        if manifest.get("version", 1) != INDEX_VERSION:
+            # Keys from an older version would miss, so the next update
+            # indexes every game again.
+            for number in manifest["segments"]:
+                for kind in KINDS:
+                    try:
+                        os.remove(self.__segment_path(number, kind))
+                    except FileNotFoundError:
+                        pass
+            manifest = {"games": 0, "segments": []}
+        self.games = manifest["games"]
+        self.segments = manifest["segments"]
+        self._segments = {
+            kind: [_Segment(self.__segment_path(number, kind)) for number in self.segments]
+            for kind in KINDS
+        }
+
+
+def add_arguments(parser):
+    parser.add_argument("store", help="game store (.pcg) to search, indexed in <store>.pidx")
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument("--fen", help="games that reached this exact position")
+    query.add_argument("--material", help="games that reached this material, e.g. KRPvKR")
+    query.add_argument("--pawns", metavar="FEN",
+                       help="games that reached the pawn structure of this position")
+    parser.add_argument("--limit", type=int, help="print at most this many hits")
+    parser.add_argument("--no-update", action="store_true",
+                        help="do not index games appended since the last search")
+
+
+def run(args) -> int:
+    if not os.path.isfile(args.store):
+        print(f"No such file: {args.store}", file=sys.stderr)
+        return 1
+
+    with PositionIndex(args.store) as index:
+        if not args.no_update:
+            start = time.perf_counter()
+            added = index.update()
+            if added:
+                print(f"Indexed {added} new games in {time.perf_counter() - start:.1f} s",
+                      file=sys.stderr)
+
+        start = time.perf_counter()
+        try:
+            if args.fen:
+                hits = index.find_position(args.fen, args.limit)
+            elif args.material:
+                hits = index.find_material(args.material, args.limit)
+            elif args.pawns:
+                hits = index.find_pawns(args.pawns, args.limit)
+            else:
+                print(f"{index.games} games indexed in {len(index.segments)} segments")
+                return 0
+        except (InvalidFenError, SignatureError) as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        elapsed = time.perf_counter() - start
+
+    for game_id, ply in hits:
+        print(game_id, ply)
+    print(f"{len(hits)} hits in {elapsed * 1000:.1f} ms", file=sys.stderr)
+    return 0
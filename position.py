@@ -0,0 +1,681 @@
+import re
+import bitboard
+import metrics
+from bitboard import (
+    WHITE, BLACK, ALL_PIECES, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING,
+    FULL, FILE_A, FILE_H, RANK_1, RANK_3, RANK_6, RANK_8,
+    PAWN_ATTACKS, KNIGHT_ATTACKS, KING_ATTACKS,
+    ROOK_MASKS, BISHOP_MASKS, ROOK_TABLE, BISHOP_TABLE, ROOK_PSEUDO, BISHOP_PSEUDO,
+    BETWEEN, LINE, SQUARE_NAMES,
+    A1, C1, D1, E1, F1, G1, H1, A8, C8, D8, E8, F8, G8, H8
+)
+
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+NO_PIECE = 0
+PIECE_SYMBOLS = " PNBRQK  pnbrqk"
+
+WHITE_OO, WHITE_OOO, BLACK_OO, BLACK_OOO = 1, 2, 4, 8
+CASTLING_SYMBOLS = ((WHITE_OO, "K"), (WHITE_OOO, "Q"),
+                    (BLACK_OO, "k"), (BLACK_OOO, "q"))
+
+# Moves are 16 bit integers laid out like Stockfish's Move class:
+# bits 0-5 destination, 6-11 origin, 12-13 promotion piece type - KNIGHT,
+# 14-15 special move flag. Castling is encoded as the king's two-square step.
+NORMAL = 0
+PROMOTION = 1 << 14
+EN_PASSANT = 2 << 14
+CASTLING = 3 << 14
+MOVE_NONE = 0
+
+# (king from, king to, rook from, rook to, squares that must be empty,
+#  squares the king crosses that must not be attacked)
+CASTLING_PATHS = {
+    WHITE_OO: (E1, G1, H1, F1, (1 << F1) | (1 << G1), (F1, G1)),
+    WHITE_OOO: (E1, C1, A1, D1, (1 << D1) | (1 << C1) | (1 << 1), (D1, C1)),
+    BLACK_OO: (E8, G8, H8, F8, (1 << F8) | (1 << G8), (F8, G8)),
+    BLACK_OOO: (E8, C8, A8, D8, (1 << D8) | (1 << C8) | (1 << 57), (D8, C8))
+}
+CASTLING_ROOKS = {king_to: (rook_from, rook_to)
+                  for _, king_to, rook_from, rook_to, _, _ in CASTLING_PATHS.values()}
+
+# Rights lost when a piece leaves or arrives on a square.
+CASTLING_RIGHTS_LOST = [0] * 64
+CASTLING_RIGHTS_LOST[E1] = WHITE_OO | WHITE_OOO
+CASTLING_RIGHTS_LOST[H1] = WHITE_OO
+CASTLING_RIGHTS_LOST[A1] = WHITE_OOO
+CASTLING_RIGHTS_LOST[E8] = BLACK_OO | BLACK_OOO
+CASTLING_RIGHTS_LOST[H8] = BLACK_OO
+CASTLING_RIGHTS_LOST[A8] = BLACK_OOO
+
+
+def _zobrist_keys():
+    # Same xorshift64* generator and seed as Stockfish's Position::init, so
+    # keys come out in the same order: pieces, en passant files, castling
+    # right combinations, then side to move.
+    s = 1070372
+
+    def rand64():
+        nonlocal s
+        s ^= s >> 12
+        s ^= (s << 25) & FULL
+        s ^= s >> 27
+        return (s * 2685821657736338717) & FULL
+
+    psq = [[0] * 64 for _ in range(16)]
+    for piece in (1, 2, 3, 4, 5, 6, 9, 10, 11, 12, 13, 14):
+        for sq in range(64):
+            psq[piece][sq] = rand64()
+    ep = [rand64() for _ in range(8)]
+    castling = [rand64() for _ in range(16)]
+    side = rand64()
+    return psq, ep, castling, side
+
+
+ZOBRIST_PSQ, ZOBRIST_EP, ZOBRIST_CASTLING, ZOBRIST_SIDE = _zobrist_keys()
+
+
+_SAN_PATTERN = re.compile(
+    r"^([NBRQK])?([a-h])?([1-8])?x?-?([a-h][1-8])(?:=?([NBRQnbrq]))?$")
+
+
+class InvalidFenError(ValueError):
+    pass
+
+
+class IllegalMoveError(ValueError):
+    pass
+
+
+def make_piece(color: int, piece_type: int) -> int:
+    return (color << 3) | piece_type
+
+
+def type_of(piece: int) -> int:
+    return piece & 7
+
+
+def color_of(piece: int) -> int:
+    return piece >> 3
+
+
+def make_move(from_sq: int, to_sq: int, flag: int = NORMAL, promotion: int = KNIGHT) -> int:
+    return flag | ((promotion - KNIGHT) << 12) | (from_sq << 6) | to_sq
+
+
+def move_from(move: int) -> int:
+    return (move >> 6) & 63
+
+
+def move_to(move: int) -> int:
+    return move & 63
+
+
+def move_flag(move: int) -> int:
+    return move & (3 << 14)
+
+
+def promotion_type(move: int) -> int:
+    return ((move >> 12) & 3) + KNIGHT
+
+
+def move_to_uci(move: int) -> str:
+    uci = SQUARE_NAMES[(move >> 6) & 63] + SQUARE_NAMES[move & 63]
+    if move & (3 << 14) == PROMOTION:
+        uci += PIECE_SYMBOLS[8 + ((move >> 12) & 3) + KNIGHT]
+    return uci
+
+
+class Position:
+    def __init__(self, fen: str = START_FEN):
+        bitboard.init()
+        self.set_fen(fen)
+
+    def set_fen(self, fen: str):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise InvalidFenError(f"{fen!r} is not a valid FEN")
+
+        self.board = [NO_PIECE] * 64
+        self.by_type = [0] * 7
+        self.by_color = [0, 0]
+
+        ranks = fields[0].split("/")
+        if len(ranks) != 8:
+            raise InvalidFenError(f"{fen!r} does not describe 8 ranks")
+        for rank, line in zip(range(7, -1, -1), ranks):
+            file = 0
+            for char in line:
+                if char.isdigit():
+                    file += int(char)
+                    continue
+                piece = PIECE_SYMBOLS.find(char)
+                if piece < 1 or file > 7:
+                    raise InvalidFenError(
+                        f"{fen!r} has an invalid rank {line!r}")
+                self.put_piece(piece, rank * 8 + file)
+                file += 1
+            if file != 8:
+                raise InvalidFenError(f"{fen!r} has an invalid rank {line!r}")
+
+        for color in (WHITE, BLACK):
+            if bitboard.popcount(self.pieces(color, KING)) != 1:
+                raise InvalidFenError(f"{fen!r} needs exactly one king per side")
+
+        if fields[1] not in ("w", "b"):
+            raise InvalidFenError(f"{fen!r} has an invalid side to move")
+        self.side_to_move = WHITE if fields[1] == "w" else BLACK
+
+        self.castling_rights = 0
+        for right, symbol in CASTLING_SYMBOLS:
+            if symbol in fields[2]:
+                self.castling_rights |= right
+
+        self.ep_square = None
+        if fields[3] != "-":
+            if fields[3] not in SQUARE_NAMES:
+                raise InvalidFenError(
+                    f"{fen!r} has an invalid en passant square")
+            ep = SQUARE_NAMES.index(fields[3])
+            # Kept only when a pawn can take on it, as push() does, so a
+            # position has the same key however it was reached.
+            us = self.side_to_move
+            if PAWN_ATTACKS[us ^ 1][ep] & self.pieces(us, PAWN):
+                self.ep_square = ep
+
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+
+        self.stack = []
+        self.key = self.compute_key()
+
+    def fen(self) -> str:
+        ranks = []
+        for rank in range(7, -1, -1):
+            line = ""
+            empty = 0
+            for file in range(8):
+                piece = self.board[rank * 8 + file]
+                if piece == NO_PIECE:
+                    empty += 1
+                    continue
+                if empty:
+                    line += str(empty)
+                    empty = 0
+                line += PIECE_SYMBOLS[piece]
+            if empty:
+                line += str(empty)
+            ranks.append(line)
+
+        castling = "".join(symbol for right, symbol in CASTLING_SYMBOLS
+                           if self.castling_rights & right) or "-"
+        ep = SQUARE_NAMES[self.ep_square] if self.ep_square is not None else "-"
+        side = "w" if self.side_to_move == WHITE else "b"
+
+        return f"{'/'.join(ranks)} {side} {castling} {ep} {self.halfmove_clock} {self.fullmove_number}"
+
+    def compute_key(self) -> int:
+        key = ZOBRIST_CASTLING[self.castling_rights]
+        for sq, piece in enumerate(self.board):
+            if piece:
+                key ^= ZOBRIST_PSQ[piece][sq]
+        if self.ep_square is not None:
+            key ^= ZOBRIST_EP[self.ep_square & 7]
+        if self.side_to_move == BLACK:
+            key ^= ZOBRIST_SIDE
+        return key
+
+    def copy(self) -> "Position":
+        other = Position.__new__(Position)
+        other.board = self.board[:]
+        other.by_type = self.by_type[:]
+        other.by_color = self.by_color[:]
+        other.side_to_move = self.side_to_move
+        other.castling_rights = self.castling_rights
+        other.ep_square = self.ep_square
+        other.halfmove_clock = self.halfmove_clock
+        other.fullmove_number = self.fullmove_number
+        other.stack = self.stack[:]
+        other.key = self.key
+        return other
+
+    def put_piece(self, piece: int, sq: int):
+        b = 1 << sq
+        self.board[sq] = piece
+        self.by_type[ALL_PIECES] |= b
+        self.by_type[piece & 7] |= b
+        self.by_color[piece >> 3] |= b
+
+    def remove_piece(self, sq: int):
+        piece = self.board[sq]
+        b = 1 << sq
+        self.board[sq] = NO_PIECE
+        self.by_type[ALL_PIECES] ^= b
+        self.by_type[piece & 7] ^= b
+        self.by_color[piece >> 3] ^= b
+
+    def push(self, move: int):
+        board = self.board
+        by_type = self.by_type
+        by_color = self.by_color
+        us = self.side_to_move
+        them = us ^ 1
+
+        frm = (move >> 6) & 63
+        to = move & 63
+        flag = move & (3 << 14)
+        piece = board[frm]
+        captured = board[to]
+
+        # Undo records are plain tuples: (move, captured piece, castling
+        # rights, en passant square, halfmove clock, zobrist key).
+        self.stack.append((move, captured, self.castling_rights,
+                          self.ep_square, self.halfmove_clock, self.key))
+
+        psq = ZOBRIST_PSQ
+        key = self.key ^ ZOBRIST_SIDE
+        if self.ep_square is not None:
+            key ^= ZOBRIST_EP[self.ep_square & 7]
+
+        self.halfmove_clock += 1
+        self.ep_square = None
+
+        if flag == EN_PASSANT:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            key ^= psq[(them << 3) | PAWN][cap_sq]
+            b = 1 << cap_sq
+            board[cap_sq] = NO_PIECE
+            by_type[ALL_PIECES] ^= b
+            by_type[PAWN] ^= b
+            by_color[them] ^= b
+        elif captured:
+            key ^= psq[captured][to]
+            b = 1 << to
+            by_type[ALL_PIECES] ^= b
+            by_type[captured & 7] ^= b
+            by_color[them] ^= b
+            self.halfmove_clock = 0
+
+        from_to = (1 << frm) | (1 << to)
+        board[frm] = NO_PIECE
+        by_type[ALL_PIECES] ^= from_to
+        by_color[us] ^= from_to
+        if flag == PROMOTION:
+            promoted = ((move >> 12) & 3) + KNIGHT
+            by_type[PAWN] ^= 1 << frm
+            by_type[promoted] ^= 1 << to
+            board[to] = (us << 3) | promoted
+        else:
+            by_type[piece & 7] ^= from_to
+            board[to] = piece
+        key ^= psq[piece][frm] ^ psq[board[to]][to]
+
+        if flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOKS[to]
+            rook_from_to = (1 << rook_from) | (1 << rook_to)
+            rook = board[rook_from]
+            key ^= psq[rook][rook_from] ^ psq[rook][rook_to]
+            board[rook_to] = rook
+            board[rook_from] = NO_PIECE
+            by_type[ALL_PIECES] ^= rook_from_to
+            by_type[ROOK] ^= rook_from_to
+            by_color[us] ^= rook_from_to
+
+        if piece & 7 == PAWN:
+            self.halfmove_clock = 0
+            if to - frm == 16 or frm - to == 16:
+                ep = (frm + to) >> 1
+                if PAWN_ATTACKS[us][ep] & by_type[PAWN] & by_color[them]:
+                    self.ep_square = ep
+                    key ^= ZOBRIST_EP[ep & 7]
+
+        if self.castling_rights:
+            rights = self.castling_rights & ~(CASTLING_RIGHTS_LOST[frm] | CASTLING_RIGHTS_LOST[to])
+            key ^= ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_CASTLING[rights]
+            self.castling_rights = rights
+
+        if us == BLACK:
+            self.fullmove_number += 1
+        self.side_to_move = them
+        self.key = key
+
+    def pop(self) -> int:
+        move, captured, self.castling_rights, self.ep_square, self.halfmove_clock, self.key = self.stack.pop()
+
+        board = self.board
+        by_type = self.by_type
+        by_color = self.by_color
+        them = self.side_to_move
+        us = them ^ 1
+        self.side_to_move = us
+        if us == BLACK:
+            self.fullmove_number -= 1
+
+        frm = (move >> 6) & 63
+        to = move & 63
+        flag = move & (3 << 14)
+
+        if flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOKS[to]
+            rook_from_to = (1 << rook_from) | (1 << rook_to)
+            board[rook_from] = board[rook_to]
+            board[rook_to] = NO_PIECE
+            by_type[ALL_PIECES] ^= rook_from_to
+            by_type[ROOK] ^= rook_from_to
+            by_color[us] ^= rook_from_to
+
+        piece = board[to]
+        from_to = (1 << frm) | (1 << to)
+        by_type[ALL_PIECES] ^= from_to
+        by_color[us] ^= from_to
+        if flag == PROMOTION:
+            by_type[piece & 7] ^= 1 << to
+            by_type[PAWN] ^= 1 << frm
+            piece = (us << 3) | PAWN
+        else:
+            by_type[piece & 7] ^= from_to
+        board[frm] = piece
+        board[to] = captured
+
+        if flag == EN_PASSANT:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            b = 1 << cap_sq
+            board[cap_sq] = (them << 3) | PAWN
+            by_type[ALL_PIECES] ^= b
+            by_type[PAWN] ^= b
+            by_color[them] ^= b
+        elif captured:
+            b = 1 << to
+            by_type[ALL_PIECES] ^= b
+            by_type[captured & 7] ^= b
+            by_color[them] ^= b
+
+        return move
+
+    def piece_at(self, sq: int) -> int:
+        return self.board[sq]
+
+    def pieces(self, color: int, piece_type: int = ALL_PIECES) -> int:
+        return self.by_color[color] & self.by_type[piece_type]
+
+    def king_square(self, color: int) -> int:
+        return bitboard.lsb(self.by_color[color] & self.by_type[KING])
+
+    def attackers_to(self, sq: int, occupied: int = None) -> int:
+        if occupied is None:
+            occupied = self.by_type[ALL_PIECES]
+        by_type = self.by_type
+        return ((PAWN_ATTACKS[BLACK][sq] & self.by_color[WHITE] & by_type[PAWN])
+                | (PAWN_ATTACKS[WHITE][sq] & self.by_color[BLACK] & by_type[PAWN])
+                | (KNIGHT_ATTACKS[sq] & by_type[KNIGHT])
+                | (KING_ATTACKS[sq] & by_type[KING])
+                | (ROOK_TABLE[sq][occupied & ROOK_MASKS[sq]] & (by_type[ROOK] | by_type[QUEEN]))
+                | (BISHOP_TABLE[sq][occupied & BISHOP_MASKS[sq]] & (by_type[BISHOP] | by_type[QUEEN])))
+
+    def is_attacked(self, sq: int, by: int, occupied: int = None) -> bool:
+        if occupied is None:
+            occupied = self.by_type[ALL_PIECES]
+        by_type = self.by_type
+        them = self.by_color[by]
+        return bool(
+            (PAWN_ATTACKS[by ^ 1][sq] & by_type[PAWN] & them)
+            or (KNIGHT_ATTACKS[sq] & by_type[KNIGHT] & them)
+            or (KING_ATTACKS[sq] & by_type[KING] & them)
+            or (ROOK_TABLE[sq][occupied & ROOK_MASKS[sq]] & (by_type[ROOK] | by_type[QUEEN]) & them)
+            or (BISHOP_TABLE[sq][occupied & BISHOP_MASKS[sq]] & (by_type[BISHOP] | by_type[QUEEN]) & them))
+
+    def checkers(self) -> int:
+        us = self.side_to_move
+        return self.attackers_to(self.king_square(us)) & self.by_color[us ^ 1]
+
+    def in_check(self) -> bool:
+        return self.checkers() != 0
+
+    def pinned(self, color: int) -> int:
+        ksq = self.king_square(color)
+        by_type = self.by_type
+        theirs = self.by_color[color ^ 1]
+        snipers = theirs & ((ROOK_PSEUDO[ksq] & (by_type[ROOK] | by_type[QUEEN]))
+                            | (BISHOP_PSEUDO[ksq] & (by_type[BISHOP] | by_type[QUEEN])))
+        occupied = by_type[ALL_PIECES] ^ snipers
+        between = BETWEEN[ksq]
+        pinned = 0
+        while snipers:
+            s = (snipers & -snipers).bit_length() - 1
+            snipers &= snipers - 1
+            b = between[s] & occupied
+            if b and not b & (b - 1):
+                pinned |= b
+        return pinned & self.by_color[color]
+
+    @metrics.timed("movegen.legal_moves")
+    def legal_moves(self) -> list:
+        return self.generate_legal()
+
+    @metrics.timed("movegen.legal_moves_from")
+    def legal_moves_from(self, sq: int) -> list:
+        return self.generate_legal(1 << sq)
+
+    def generate_legal(self, from_mask: int = FULL) -> list:
+        moves = []
+        append = moves.append
+
+        us = self.side_to_move
+        them = us ^ 1
+        by_type = self.by_type
+        occupied = by_type[ALL_PIECES]
+        ours = self.by_color[us]
+        theirs = self.by_color[them]
+        ksq = (by_type[KING] & ours).bit_length() - 1
+
+        checkers = self.attackers_to(ksq, occupied) & theirs
+
+        if from_mask >> ksq & 1:
+            occupied_no_king = occupied ^ (1 << ksq)
+            b = KING_ATTACKS[ksq] & ~ours
+            while b:
+                to = (b & -b).bit_length() - 1
+                b &= b - 1
+                if not self.is_attacked(to, them, occupied_no_king):
+                    append((ksq << 6) | to)
+
+            if not checkers:
+                self.__generate_castling(us, them, occupied, append)
+
+        if checkers & (checkers - 1):
+            return moves
+
+        if checkers:
+            target = BETWEEN[ksq][(checkers & -checkers).bit_length() - 1] | checkers
+        else:
+            target = ~ours & FULL
+
+        pinned = self.pinned(us)
+        line = LINE[ksq]
+        movable = ours & from_mask
+
+        b = by_type[KNIGHT] & movable & ~pinned
+        while b:
+            frm = (b & -b).bit_length() - 1
+            b &= b - 1
+            att = KNIGHT_ATTACKS[frm] & target
+            while att:
+                to = (att & -att).bit_length() - 1
+                att &= att - 1
+                append((frm << 6) | to)
+
+        b = (by_type[BISHOP] | by_type[QUEEN]) & movable
+        while b:
+            frm = (b & -b).bit_length() - 1
+            b &= b - 1
+            att = BISHOP_TABLE[frm][occupied & BISHOP_MASKS[frm]] & target
+            if pinned >> frm & 1:
+                att &= line[frm]
+            while att:
+                to = (att & -att).bit_length() - 1
+                att &= att - 1
+                append((frm << 6) | to)
+
+        b = (by_type[ROOK] | by_type[QUEEN]) & movable
+        while b:
+            frm = (b & -b).bit_length() - 1
+            b &= b - 1
+            att = ROOK_TABLE[frm][occupied & ROOK_MASKS[frm]] & target
+            if pinned >> frm & 1:
+                att &= line[frm]
+            while att:
+                to = (att & -att).bit_length() - 1
+                att &= att - 1
+                append((frm << 6) | to)
+
+        pawns = by_type[PAWN] & movable
+        if pawns:
+            self.__generate_pawn_moves(
+                us, pawns, occupied, theirs, target, pinned, ksq, append)
+
+        return moves
+
+    def __generate_pawn_moves(self, us, pawns, occupied, theirs, target, pinned, ksq, append):
+        empty = ~occupied & FULL
+        if us == WHITE:
+            up = 8
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & theirs
+            right = ((pawns & ~FILE_H) << 9) & theirs
+            promotion_rank = RANK_8
+        else:
+            up = -8
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            left = ((pawns & ~FILE_H) >> 7) & theirs
+            right = ((pawns & ~FILE_A) >> 9) & theirs
+            promotion_rank = RANK_1
+
+        line = LINE[ksq]
+        for targets, delta in ((single & target, up), (double & target, 2 * up),
+                               (left & target, up - 1 if us == WHITE else up + 1),
+                               (right & target, up + 1 if us == WHITE else up - 1)):
+            while targets:
+                to = (targets & -targets).bit_length() - 1
+                targets &= targets - 1
+                frm = to - delta
+                if pinned >> frm & 1 and not line[frm] >> to & 1:
+                    continue
+                if (1 << to) & promotion_rank:
+                    for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        append(PROMOTION | ((promotion - KNIGHT) << 12) | (frm << 6) | to)
+                else:
+                    append((frm << 6) | to)
+
+        ep = self.ep_square
+        if ep is None:
+            return
+        captured = ep - up
+        # Taking en passant clears two squares on the same rank at once, which
+        # pin detection cannot see, so test the resulting occupancy directly.
+        b = PAWN_ATTACKS[us ^ 1][ep] & pawns
+        while b:
+            frm = (b & -b).bit_length() - 1
+            b &= b - 1
+            occ = (occupied ^ (1 << frm) ^ (1 << captured)) | (1 << ep)
+            if not self.attackers_to(ksq, occ) & theirs & ~(1 << captured):
+                append(EN_PASSANT | (frm << 6) | ep)
+
+    def __generate_castling(self, us, them, occupied, append):
+        rights = self.castling_rights & ((WHITE_OO | WHITE_OOO) if us == WHITE else (BLACK_OO | BLACK_OOO))
+        rooks = self.by_color[us] & self.by_type[ROOK]
+        while rights:
+            right = rights & -rights
+            rights &= rights - 1
+            king_from, king_to, rook_from, _, empty, path = CASTLING_PATHS[right]
+            if self.board[king_from] != make_piece(us, KING) or not rooks >> rook_from & 1:
+                continue
+            if occupied & empty:
+                continue
+            if any(self.is_attacked(s, them, occupied) for s in path):
+                continue
+            append(CASTLING | (king_from << 6) | king_to)
+
+    @metrics.timed("movegen.parse_uci")
+    def parse_uci(self, uci: str) -> int:
+        uci = uci.lower()
+        if uci[:2] in SQUARE_NAMES:
+            for move in self.generate_legal(1 << SQUARE_NAMES.index(uci[:2])):
+                if move_to_uci(move) == uci:
+                    return move
+        raise IllegalMoveError(f"{uci} is not a legal move in {self.fen()}")
+
+    def san(self, move: int) -> str:
+        frm = (move >> 6) & 63
+        to = move & 63
+        flag = move & (3 << 14)
+        piece_type = self.board[frm] & 7
+
+        if flag == CASTLING:
+            san = "O-O" if to & 7 == 6 else "O-O-O"
+        elif piece_type == PAWN:
+            san = SQUARE_NAMES[to]
+            if frm & 7 != to & 7:
+                san = SQUARE_NAMES[frm][0] + "x" + san
+            if flag == PROMOTION:
+                san += "=" + PIECE_SYMBOLS[((move >> 12) & 3) + KNIGHT]
+        else:
+            san = PIECE_SYMBOLS[piece_type]
+            others = [m for m in self.generate_legal(self.by_color[self.side_to_move] & self.by_type[piece_type])
+                      if m & 63 == to and (m >> 6) & 63 != frm]
+            if others:
+                if all(((m >> 6) & 7) != frm & 7 for m in others):
+                    san += SQUARE_NAMES[frm][0]
+                elif all(((m >> 9) & 7) != frm >> 3 for m in others):
+                    san += SQUARE_NAMES[frm][1]
+                else:
+                    san += SQUARE_NAMES[frm]
+            if self.board[to]:
+                san += "x"
+            san += SQUARE_NAMES[to]
+
+        self.push(move)
+        if self.in_check():
+            san += "+" if self.legal_moves() else "#"
+        self.pop()
+        return san
+
+    def parse_san(self, san: str) -> int:
+        text = san.rstrip("+#!?")
+        if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            for move in self.generate_legal(self.by_color[self.side_to_move] & self.by_type[KING]):
+                if move & (3 << 14) == CASTLING and (move & 7 == 6) == (len(text) == 3):
+                    return move
+            raise IllegalMoveError(f"{san} is not a legal move in {self.fen()}")
+
+        match = _SAN_PATTERN.match(text)
+        if match is None:
+            raise IllegalMoveError(f"{san} is not valid SAN")
+        piece, from_file, from_rank, to_name, promotion = match.groups()
+
+        piece_type = PIECE_SYMBOLS.index(piece) if piece else PAWN
+        to = SQUARE_NAMES.index(to_name)
+        promotion_type = PIECE_SYMBOLS.index(promotion.upper()) if promotion else None
+
+        candidates = []
+        for move in self.generate_legal(self.by_color[self.side_to_move] & self.by_type[piece_type]):
+            if move & 63 != to or move & (3 << 14) == CASTLING:
+                continue
+            frm = (move >> 6) & 63
+            if from_file and frm & 7 != ord(from_file) - 97:
+                continue
+            if from_rank and frm >> 3 != int(from_rank) - 1:
+                continue
+            if move & (3 << 14) == PROMOTION:
+                if ((move >> 12) & 3) + KNIGHT != promotion_type:
+                    continue
+            elif promotion_type is not None:
+                continue
+            candidates.append(move)
+
+        if len(candidates) != 1:
+            problem = "ambiguous" if candidates else "not a legal move"
+            raise IllegalMoveError(f"{san} is {problem} in {self.fen()}")
+        return candidates[0]
@@ -1,12 +1,29 @@
 import os
-import stockfish
-import tkinter as tk
+import sys
+import queue
+import argparse
+import importlib
+import metrics
 from itertools import product
-from PIL import Image, ImageTk
+from typing import TYPE_CHECKING
+from bitboard import WHITE, square, file_of, rank_of
+from position import Position, START_FEN, NO_PIECE, PIECE_SYMBOLS, EN_PASSANT, CASTLING, IllegalMoveError, color_of, move_from, move_to, move_flag, move_to_uci
+from tt import TranspositionTable, get_transposition_table
+from pgn import Game, PgnDatabase
+from syzygy import Tablebase, TB_DEPTH, WDL_NAMES, get_tablebase
+
+# Tk, PIL and the engine wrapper are imported where a window or an engine is
+# first needed, so headless commands never load them.
+if TYPE_CHECKING:
+    import tkinter as tk
+    from PIL import ImageTk
+    from engine import EnginePool
+    from book import PolyglotBook
+    from scheduler import EngineScheduler
+    from replay import ReplayController
+    from speculate import Speculator
 
 
-stockfish_path = os.path.join(os.path.dirname(
-    __file__), "stockfish", "stockfish.exe")
 assets_dir = os.path.join(os.path.dirname(__file__), "assets")
 save_dir = os.path.join(os.path.dirname(__file__), "games")
 icon_path = os.path.join(assets_dir, "icon.ico")
@@ -22,25 +39,42 @@ class UnknownCoordinatesError(Exception):
         super.__init__(message=msg, **kwargs)
 
 
-class ChessEngine(stockfish.Stockfish):
-    def __init__(self):
-        super.__init__(path=stockfish_path)
-
-
 class ChessBoard:
     def __init__(
         self,
-        root: tk.Tk,
+        root: "tk.Tk",
         asset_location: os.PathLike,
         tile_size: int = 60,
         start_flipped: bool = False,
         white_color_code: str = "#ffcf9f",
         black_color_code: str = "#d28c45",
         select_color_code: str = "#cad549",
-        mark_color_code: str = "#ff3232"
+        mark_color_code: str = "#ff3232",
+        engine_pool: "EnginePool" = None,
+        cache: TranspositionTable = None,
+        tablebase: Tablebase = None,
+        scheduler: "EngineScheduler" = None,
+        speculator: "Speculator" = None
     ):
+        import tkinter as tk
+        from engine import get_engine_pool
+        from sprites import get_sprite_cache
+
         self.root = root
 
+        self.engine_pool = engine_pool if engine_pool is not None else get_engine_pool()
+        self.cache = cache if cache is not None else get_transposition_table()
+        self.tablebase = tablebase if tablebase is not None else get_tablebase()
+        self.analysis = None
+        self.__analysis_job = None
+        # Boards that share engines with many others search through a
+        # scheduler instead of taking an engine from the pool themselves.
+        self.scheduler = scheduler if scheduler is not None or speculator is None else speculator.scheduler
+        # With a speculator, replies to the user's likely moves are searched
+        # while they think, and request_move() takes them when it guessed.
+        self.speculator = speculator
+        self.__search = None
+
         self.assets_path = asset_location
 
         self.canvas = tk.Canvas(root, width=8*tile_size, height=8*tile_size)
@@ -60,18 +94,14 @@ class ChessBoard:
 
         self._flipped = False
 
-        self.board = [
-            ["BR", "BN", "BB", "BQ", "BK", "BB", "BN", "BR"],
-            ["BP", "BP", "BP", "BP", "BP", "BP", "BP", "BP"],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["WP", "WP", "WP", "WP", "WP", "WP", "WP", "WP"],
-            ["WR", "WN", "WB", "WQ", "WK", "WB", "WN", "WR"]
-        ]
+        self.position = Position()
 
         self.board_rects = {}
+        self.__file_labels = []
+        self.__rank_labels = []
+        self.__piece_items = {}
+        self.__shown = [["  "] * 8 for _ in range(8)]
+        self.__pending_draw = None
 
         self.__moves = []
 
@@ -84,130 +114,250 @@ class ChessBoard:
 
         self.coords = ["".join(x) for x in product(self.cols, self.rows)]
 
-        self.__piece_images = self.__fetch_assets()
+        self.__sync_board()
+
+        self.sprites = get_sprite_cache(asset_location)
+        self.__piece_images = {}
+        self.__layout_size = None
 
         self.__board_is_shown = True
 
         if start_flipped:
             self.flip()
 
-    def __fetch_assets(self) -> dict:
-        piece_files = {}
-        pieces = ["wk", "wq", "wr", "wn", "wb",
-                  "wp", "bk", "bq", "br", "bn", "bb", "bp"]
-
-        for path, _, files in os.walk(self.assets_path):
-            for file in files:
-                filename = file.split(".")[0]
-                if filename.lower() in pieces:
-                    piece_files.update(
-                        {filename.lower(): os.path.join(path, file)})
-        piece_images = {}
-
-        for name, path in piece_files.items():
-            img = Image.open(path)
-            img_rszd = img.resize(
-                (self.tile_size, self.tile_size), Image.Resampling.LANCZOS)
-            img_tk = ImageTk.PhotoImage(img_rszd)
-            piece_images.update({name.upper(): img_tk})
-
-        self.root.piece_images = piece_images
-
-        return piece_images
+    def __piece_image(self, cell: str) -> "ImageTk.PhotoImage":
+        image = self.__piece_images.get(cell)
+        if image is None:
+            image = self.__piece_images[cell] = self.sprites.get(
+                cell, self.tile_size)
+        return image
+
+    @metrics.timed("render.resize")
+    def resize(self, tile_size: int):
+        if tile_size == self.tile_size:
+            return
+        self.tile_size = tile_size
+        self.__piece_images = {}
+        self.canvas.config(width=8*tile_size, height=8*tile_size)
+        self.schedule_draw()
 
     def change_colors(self, new_white: str = "#ffcf9f", new_black: str = "#d28c45") -> bool:
         if new_white.startswith("#") and new_black.startswith("#") and new_white != new_black and len(new_white) == 7 and len(new_black) == 7:
             self._white = new_white
             self._black = new_black
+            self._colors = (self._white, self._black)
+            if self.board_rects:
+                self.__color_static_items()
             return True
         else:
             return False
 
     def flip(self, draw_immediate: bool = False):
+        # Flipping only changes where squares land on the canvas. The board
+        # grid, and every index into it, keeps rank 8 first and file A first.
         self._flipped = not self._flipped
-        self.board.reverse()
-        self.rows.reverse()
-        self.cols.reverse()
+        self.__layout_size = None
         if draw_immediate:
-            self.draw()
+            self.schedule_draw()
 
-    def reset(self):
-        if self._flipped:
-            self.flip()
-        self.board = [
-            ["BR", "BN", "BB", "BQ", "BK", "BB", "BN", "BR"],
-            ["BP", "BP", "BP", "BP", "BP", "BP", "BP", "BP"],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["  ", "  ", "  ", "  ", "  ", "  ", "  ", "  "],
-            ["WP", "WP", "WP", "WP", "WP", "WP", "WP", "WP"],
-            ["WR", "WN", "WB", "WQ", "WK", "WB", "WN", "WR"]
-        ]
+    def set_fen(self, fen: str):
+        self.position = Position(fen)
+        self.__sync_board()
         self.__moves = []
+        self.schedule_draw()
+
+    @metrics.timed("board.push")
+    def push(self, move) -> int:
+        if isinstance(move, str):
+            move = self.position.parse_uci(move)
+        elif move not in self.position.legal_moves():
+            raise IllegalMoveError(f"{move_to_uci(move)} is not legal in {self.position.fen()}")
+        self.position.push(move)
+        self.__moves.append(move_to_uci(move))
+        self.__sync_squares(move)
+        self.schedule_draw()
+        return move
+
+    @metrics.timed("board.pop")
+    def pop(self) -> int:
+        if not self.position.stack:
+            raise IndexError("pop from a board with no moves")
+        move = self.position.pop()
+        if self.__moves:
+            self.__moves.pop()
+        self.__sync_squares(move)
+        self.schedule_draw()
+        return move
+
+    def show_position(self, position: Position, moves=()):
+        # Switches to an unrelated position, such as another ply of a game
+        # being replayed, touching only the squares that differ.
+        old = self.position.board
+        self.position = position
+        self.__moves = list(moves)
+        for sq, piece in enumerate(position.board):
+            if piece != old[sq]:
+                self.board[7 - rank_of(sq)][file_of(sq)] = self.__cell_name(piece)
+        self.turn = "White" if position.side_to_move == WHITE else "Black"
+        self.schedule_draw()
+
+    def load_game(self, game: Game, ply: int = None):
+        self.load_moves(game.start_fen, game.moves, ply)
+
+    def load_moves(self, start_fen: str, moves, ply: int = None):
+        # moves is any sequence of encoded moves, such as a game store's view
+        # of its file; it is only read, never kept.
+        self.position = Position(start_fen)
+        moves = moves if ply is None else moves[:ply]
+        for move in moves:
+            self.position.push(move)
+        self.__moves = [move_to_uci(move) for move in moves]
+        self.__sync_board()
+        self.schedule_draw()
+
+    def save_game(self, path: os.PathLike = None, headers: dict = None) -> int:
+        # Games are appended to one PGN file in the save directory, indexed so
+        # any of them can be loaded again without reading the whole file.
+        if path is None:
+            os.makedirs(save_dir, exist_ok=True)
+            path = os.path.join(save_dir, "games.pgn")
+
+        start = self.position.copy()
+        while start.stack:
+            start.pop()
+        start_fen = start.fen()
+        game_headers = dict(headers or {})
+        if start_fen != START_FEN:
+            game_headers.update({"SetUp": "1", "FEN": start_fen})
+        game = Game(game_headers, [move for move, *_ in self.position.stack])
+        return PgnDatabase(path).append(game)
 
-        self.canvas.delete("all")
-
-        for row in range(8):
-            for col in range(8):
-                color = self._colors[(row + col) % 2]
-                x1, y1 = col * self.tile_size, row * self.tile_size
-                x2, y2 = x1 + self.tile_size, y1 + self.tile_size
-                rect = self.canvas.create_rectangle(
-                    x1, y1, x2, y2, fill=color, outline="")
-                self.board_rects[f"{row},{col}"] = rect
+    def reset(self):
+        if self._flipped:
+            self._flipped = False
+            self.__layout_size = None
+        self.set_fen(START_FEN)
 
-                text_color = self._white if color == self._black else self._black
+    def update(self):
+        self.__render_pieces()
 
-                if row == 7:
-                    self.canvas.create_text(x1 + self.tile_size - 1, y1 + self.tile_size - 1, text=chr(
-                        97 + col).upper(), anchor="se", font=("Arial", 8, "bold"), fill=text_color)
-                if col == 0:
-                    self.canvas.create_text(
-                        x1 + 3, y1 + 3, text=str(8 - row), anchor="nw", font=("Arial", 8, "bold"), fill=text_color)
+    @metrics.timed("render.draw")
+    def draw(self):
+        if self.__pending_draw is not None:
+            self.canvas.after_cancel(self.__pending_draw)
+            self.__pending_draw = None
 
-        for row, line in enumerate(self.board):
-            for col, cell in enumerate(line):
-                if cell != "  ":
-                    self.canvas.create_image(
-                        30 + col * self.tile_size, 30 + row * self.tile_size, image=self.__piece_images[cell], tags="piece")
+        if not self.board_rects:
+            self.__create_static_items()
+        else:
+            self.__label_static_items()
+        if self.__layout_size != self.tile_size:
+            self.__layout()
+        self.__render_pieces()
 
-    def update(self):
-        self.canvas.delete("piece")
-        for row, line in enumerate(self.board):
-            for col, cell in enumerate(line):
-                if cell != "  ":
-                    self.canvas.create_image(
-                        30 + col * self.tile_size, 30 + row * self.tile_size, image=self.__piece_images[cell], tags="piece")
+    def schedule_draw(self):
+        if self.__pending_draw is None:
+            self.__pending_draw = self.canvas.after_idle(self.__flush_draw)
 
-    def draw(self):
-        self.canvas.delete("all")
+    @metrics.timed("render.flush")
+    def __flush_draw(self):
+        self.__pending_draw = None
+        self.draw()
 
+    def __create_static_items(self):
         for row in range(8):
             for col in range(8):
-                color = self._colors[(row + col) % 2]
-                x1, y1 = col * self.tile_size, row * self.tile_size
-                x2, y2 = x1 + self.tile_size, y1 + self.tile_size
-                rect = self.canvas.create_rectangle(
-                    x1, y1, x2, y2, fill=color, outline="")
-                self.board_rects[f"{row},{col}"] = rect
-
-                text_color = self._white if color == self._black else self._black
+                self.board_rects[f"{row},{col}"] = self.canvas.create_rectangle(
+                    0, 0, 0, 0, outline="", tags="square")
 
                 if row == 7:
-                    self.canvas.create_text(x1 + self.tile_size - 1, y1 + self.tile_size - 1, text=chr(
-                        97 + col).upper(), anchor="se", font=("Arial", 8, "bold"), fill=text_color)
+                    self.__file_labels.append(self.canvas.create_text(
+                        0, 0, anchor="se", font=("Arial", 8, "bold"), tags="label"))
                 if col == 0:
-                    self.canvas.create_text(
-                        x1 + 3, y1 + 3, text=str(8 - row), anchor="nw", font=("Arial", 8, "bold"), fill=text_color)
+                    self.__rank_labels.append(self.canvas.create_text(
+                        0, 0, anchor="nw", font=("Arial", 8, "bold"), tags="label"))
+
+        self.__color_static_items()
+        self.__label_static_items()
 
+    def __layout(self):
+        size = self.tile_size
+        for row in range(8):
+            for col in range(8):
+                self.canvas.coords(self.board_rects[f"{row},{col}"],
+                                   col * size, row * size, (col + 1) * size, (row + 1) * size)
+        for col, item in enumerate(self.__file_labels):
+            self.canvas.coords(item, (col + 1) * size - 1, 8 * size - 1)
+        for row, item in enumerate(self.__rank_labels):
+            self.canvas.coords(item, 3, row * size + 3)
+
+        for (row, col), item in self.__piece_items.items():
+            x, y = self.__screen(row, col)
+            self.canvas.coords(item, (0.5 + x) * size, (0.5 + y) * size)
+            self.canvas.itemconfigure(
+                item, image=self.__piece_image(self.__shown[row][col]))
+
+        self.__layout_size = size
+
+    def __color_static_items(self):
+        for row in range(8):
+            for col in range(8):
+                self.canvas.itemconfigure(
+                    self.board_rects[f"{row},{col}"], fill=self._colors[(row + col) % 2])
+
+        # Labels sit on the bottom row and the left column, so their square
+        # colors alternate starting from the corner square.
+        for col, item in enumerate(self.__file_labels):
+            self.canvas.itemconfigure(item, fill=self._colors[col % 2])
+        for row, item in enumerate(self.__rank_labels):
+            self.canvas.itemconfigure(item, fill=self._colors[(row + 1) % 2])
+
+    def __label_static_items(self):
+        for col, item in enumerate(self.__file_labels):
+            self.canvas.itemconfigure(
+                item, text=self.cols[7 - col if self._flipped else col])
+        for row, item in enumerate(self.__rank_labels):
+            self.canvas.itemconfigure(
+                item, text=self.rows[7 - row if self._flipped else row])
+
+    @metrics.timed("render.pieces")
+    def __render_pieces(self):
+        # Diff the grid against what is on the canvas and touch only the
+        # squares that changed. Items leaving a square are moved to a square
+        # that needs the same piece where possible, so a plain move costs one
+        # coords call instead of a delete and a create.
+        vacated = []
+        needed = []
         for row, line in enumerate(self.board):
             for col, cell in enumerate(line):
+                if self.__shown[row][col] == cell:
+                    continue
+                if self.__shown[row][col] != "  ":
+                    vacated.append(
+                        (self.__shown[row][col], self.__piece_items.pop((row, col))))
                 if cell != "  ":
-                    piece_x = (0.5 * self.tile_size) + col * self.tile_size
-                    piece_y = (0.5 * self.tile_size) + row * self.tile_size
-                    self.canvas.create_image(
-                        piece_x, piece_y, image=self.__piece_images[cell], tags="piece")
+                    needed.append((row, col, cell))
+                self.__shown[row][col] = cell
+
+        for row, col, cell in needed:
+            x, y = self.__screen(row, col)
+            x = (0.5 + x) * self.tile_size
+            y = (0.5 + y) * self.tile_size
+            reuse = next((i for i, (name, _) in enumerate(vacated) if name == cell), None)
+            if reuse is None and vacated:
+                reuse = 0
+            if reuse is None:
+                item = self.canvas.create_image(
+                    x, y, image=self.__piece_image(cell), tags="piece")
+            else:
+                name, item = vacated.pop(reuse)
+                self.canvas.coords(item, x, y)
+                if name != cell:
+                    self.canvas.itemconfigure(item, image=self.__piece_image(cell))
+            self.__piece_items[(row, col)] = item
+
+        for _, item in vacated:
+            self.canvas.delete(item)
 
     def hide(self):
         if self.__board_is_shown:
@@ -222,415 +372,478 @@ class ChessBoard:
     def get_moves(self) -> tuple:
         return tuple(self.__moves)
 
+    @metrics.timed("board.legal_moves")
     def get_legal_moves(self, cell: str) -> list:
         if cell.upper() not in self.coords:
             raise UnknownCoordinatesError(
                 f"{cell} is not a valid coordinate pair. Please use any from A1 to H8")
 
-        moves = []
-
-        row_idx = self.rows.index(cell[1].upper())
-        col_idx = self.cols.index(cell[0].upper())
-        row = cell[1]
-        col = cell[0].lower()
-        piece = self.board[row_idx][col_idx].lower()
-        piece_color = piece[0].lower()
-        piece_type = piece[1]
-        print(piece, cell, str(col_idx) + str(row_idx), end=": ")
-
-        match piece_type:
-            case " ":
-                return None
-            case "p":
-                if piece_color == "w":
-                    if self.__is_empty(row_idx - 1, col_idx):
-                        moves.append(
-                            col + row + col + self.rows[row_idx - 1])
-
-                        if row_idx == 6:
-                            if self.__is_empty(row_idx - 2, col_idx):
-                                moves.append(
-                                    col + row + col + self.rows[row_idx - 2])
-
-                    if col_idx > 0:
-                        if not self.__is_empty(row_idx - 1, col_idx - 1) and self.__get_color(row_idx - 1, col_idx - 1) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - 1] + row)
-
-                    if col_idx < 7:
-                        if not self.__is_empty(row_idx - 1, col_idx + 1) and self.__get_color(row_idx - 1, col_idx - 1) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + 1] + self.rows[row_idx - 1])
+        sq = square(cell)
+        if self.position.piece_at(sq) == NO_PIECE:
+            return None
+
+        key = self.position.key
+        moves = self.cache.probe_moves(key)
+        if moves is None:
+            # In a tablebase position the moves come best first.
+            ranked = self.__tablebase_moves()
+            moves = [entry[0] for entry in ranked] if ranked else self.position.legal_moves()
+            self.cache.store_moves(key, moves)
+
+        return [move_to_uci(move) for move in moves if (move >> 6) & 63 == sq]
+
+    @metrics.timed("board.evaluate")
+    def evaluate(self, depth: int = 15) -> dict:
+        key = self.position.key
+        cached = self.cache.probe_evaluation(key, depth)
+        if cached is not None:
+            evaluation, cached_depth, pv = cached
+            return {"score": evaluation, "depth": cached_depth, "pv": list(pv)}
+
+        line = self.__tablebase_line()
+        if line is not None:
+            score, pv = line
+            if self.position.side_to_move != WHITE:
+                score["value"] = -score["value"]
+            self.cache.store_evaluation(key, score, TB_DEPTH, pv)
+            return {"score": score, "depth": TB_DEPTH, "pv": pv}
+
+        self.cache.new_search()
+        with self.engine_pool.engine() as engine:
+            result = engine.analyse(self.position.fen(), depth)
+        self.cache.store_evaluation(
+            key, result["score"], result["depth"], result["pv"])
+        return {"score": result["score"], "depth": result["depth"], "pv": result["pv"]}
+
+    def start_analysis(
+        self,
+        depth: int = None,
+        movetime: int = None,
+        infinite: bool = False,
+        on_info=None,
+        on_bestmove=None,
+        poll_interval: int = 50,
+        on_error=None
+    ) -> int:
+        line = self.__tablebase_line()
+        if line is not None:
+            # The result is known, so no engine is started. The callbacks
+            # still run from the Tk loop like those of a real search.
+            self.stop_analysis()
+            self.__analysis_id = None
+            score, pv = line
+            info = {"depth": TB_DEPTH, "score": score, "pv": pv}
+
+            def report():
+                if on_info is not None:
+                    on_info(info)
+                if on_bestmove is not None:
+                    on_bestmove({"bestmove": pv[0] if pv else None,
+                                 "ponder": pv[1] if len(pv) > 1 else None})
+            self.canvas.after_idle(report)
+            return None
+
+        if self.analysis is None:
+            from engine import AnalysisDriver
+            self.analysis = AnalysisDriver(self.engine_pool)
+
+        self.cache.new_search()
+        self.__analysis_key = self.position.key
+        self.__analysis_fen = self.position.fen()
+        self.__analysis_info = None
+        self.__analysis_callbacks = (on_info, on_bestmove, on_error)
+        self.__analysis_poll_interval = poll_interval
+        self.__analysis_id = self.analysis.start(
+            self.__analysis_fen, depth, movetime, infinite)
+
+        if self.__analysis_job is None:
+            self.__analysis_job = self.canvas.after(
+                poll_interval, self.__poll_analysis)
+        return self.__analysis_id
+
+    def stop_analysis(self):
+        if self.analysis is not None:
+            self.analysis.stop()
+
+    def __poll_analysis(self):
+        # Runs on the Tk thread. Drain everything the worker produced since
+        # the last tick but only hand the newest line to the UI, so a fast
+        # engine never queues up more redraws than the poll rate allows.
+        self.__analysis_job = None
+        if self.__analysis_id is None:
+            return
+        on_info, on_bestmove, on_error = self.__analysis_callbacks
+        latest = None
+        finished = None
+        while True:
+            try:
+                search_id, kind, payload = self.analysis.results.get_nowait()
+            except queue.Empty:
+                break
+            if search_id != self.__analysis_id:
+                continue
+            if kind == "error":
+                # Raising here would only reach Tk's error printer and leave
+                # the analysis looking alive, so it ends and is reported.
+                self.__analysis_id = None
+                if on_error is not None:
+                    on_error(payload)
                 else:
-                    if self.__is_empty(row_idx + 1, col_idx):
-                        moves.append(
-                            col + row + col + self.rows[row_idx + 1])
-
-                        if row_idx == 1:
-                            if self.__is_empty(row_idx + 2, col_idx):
-                                moves.append(
-                                    col + row + col + self.rows[row_idx + 2])
-
-                    if col_idx > 0:
-                        if not self.__is_empty(row_idx + 1, col_idx - 1) and self.__get_color(row_idx + 1, col_idx - 1) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - 1] + self.rows[row_idx + 1])
-
-                    if col_idx < 7:
-                        if not self.__is_empty(row_idx + 1, col_idx + 1) and self.__get_color(row_idx + 1, col_idx - 1) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + 1] + self.rows[row_idx + 1])
-
-            case "r":
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx):
-                            moves.append(col + row + col +
-                                         self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx) != piece_color:
-                            moves.append(moves.append(
-                                col + row + col + self.rows[row_idx + m]))
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx):
-                            moves.append(col + row + col +
-                                         self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx) != piece_color:
-                            moves.append(moves.append(
-                                col + row + col + self.rows[row_idx - m]))
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + row)
-                        elif self.__get_color(row_idx, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + row)
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + row)
-                        elif self.__get_color(row_idx, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + row)
-                            break
-                    except IndexError:
-                        break
-
-            case "b":
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx + m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx - m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx + m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx - m])
-                            break
-                    except IndexError:
-                        break
-
-            case "q":
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx + m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + self.rows[row_idx - m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx + m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + self.rows[row_idx - m])
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx + m, col_idx):
-                            moves.append(col + row + col +
-                                         self.rows[row_idx + m])
-                        elif self.__get_color(row_idx + m, col_idx) != piece_color:
-                            moves.append(moves.append(
-                                col + row + col + self.rows[row_idx + m]))
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx - m, col_idx):
-                            moves.append(col + row + col +
-                                         self.rows[row_idx - m])
-                        elif self.__get_color(row_idx - m, col_idx) != piece_color:
-                            moves.append(moves.append(
-                                col + row + col + self.rows[row_idx - m]))
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx, col_idx + m):
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + row)
-                        elif self.__get_color(row_idx, col_idx + m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx + m] + row)
-                            break
-                    except IndexError:
-                        break
-
-                for m in range(8):
-                    try:
-                        if self.__is_empty(row_idx, col_idx - m):
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + row)
-                        elif self.__get_color(row_idx, col_idx - m) != piece_color:
-                            moves.append(
-                                col + row + self.cols[col_idx - m] + row)
-                            break
-                    except IndexError:
-                        break
-
-            case "k":
-                try:
-                    if self.__is_empty(row_idx + 1, col_idx) or self.__get_color(row_idx + 1, col_idx):
-                        moves.append(col + row + col + self.rows[row_idx + 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 1, col_idx + 1) or self.__get_color(row_idx + 1, col_idx + 1):
-                        moves.append(
-                            col + row + self.cols[col_idx + 1] + self.rows[row_idx + 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx, col_idx + 1) or self.__get_color(row_idx, col_idx + 1):
-                        moves.append(col + row + self.cols[col_idx + 1] + row)
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 1, col_idx + 1) or self.__get_color(row_idx - 1, col_idx + 1):
-                        moves.append(
-                            col + row + self.cols[col_idx + 1] + self.rows[row_idx - 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 1, col_idx) or self.__get_color(row_idx - 1, col_idx):
-                        moves.append(col + row + col + self.rows[row_idx - 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 1, col_idx - 1) or self.__get_color(row_idx - 1, col_idx - 1):
-                        moves.append(
-                            col + row + self.cols[col_idx - 1] + self.rows[row_idx + 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx, col_idx - 1) or self.__get_color(row_idx, col_idx - 1):
-                        moves.append(col + row + self.cols[col_idx - 1] + row)
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 1, col_idx - 1) or self.__get_color(row_idx + 1, col_idx - 1):
-                        moves.append(
-                            col + row + self.cols[col_idx - 1] + self.row[row_idx + 1])
-                except IndexError:
-                    pass
-
-            case "n":
-                try:
-                    if self.__is_empty(row_idx - 2, col_idx + 1) or self.__get_color(row_idx - 2, col_idx + 1) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx + 1] + self.rows[row_idx - 2])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 1, col_idx + 2) or self.__get_color(row_idx - 1, col_idx + 2) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx + 2] + self.rows[row_idx - 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 1, col_idx + 2) or self.__get_color(row_idx + 1, col_idx + 2) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx + 2] + self.rows[row_idx + 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 2, col_idx + 1) or self.__get_color(row_idx + 2, col_idx + 1) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx + 1] + self.rows[row_idx + 2])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 2, col_idx - 1) or self.__get_color(row_idx + 2, col_idx - 1) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx - 1] + self.rows[row_idx + 2])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx + 1, col_idx - 2) or self.__get_color(row_idx + 1, col_idx - 2) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx - 2] + self.rows[row_idx + 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 1, col_idx - 2) or self.__get_color(row_idx - 1, col_idx - 2) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx - 2] + self.rows[row_idx - 1])
-                except IndexError:
-                    pass
-
-                try:
-                    if self.__is_empty(row_idx - 2, col_idx - 1) or self.__get_color(row_idx - 2, col_idx - 1) != piece_color:
-                        moves.append(
-                            col + row + self.cols[col_idx - 1] + self.rows[row_idx - 2])
-                except IndexError:
-                    pass
-
-            case _:
-                return None
-
-        moves = [x.lower() for x in moves]
-        moves += ["O-O", "O-O-O"]
-
-        engine = stockfish.Stockfish(path=stockfish_path)
-        legal_moves = []
-        for move in moves:
-            if engine.is_move_correct(move):
-                legal_moves.append(move)
-
-        return legal_moves
+                    print(f"Analysis failed: {payload!r}", file=sys.stderr)
+                return
+            if kind == "info":
+                latest = payload
+            else:
+                finished = payload
+
+        if latest is not None:
+            if "score" in latest and "bound" not in latest["score"]:
+                self.__analysis_info = latest
+            if on_info is not None:
+                on_info(latest)
+
+        if finished is None:
+            self.__analysis_job = self.canvas.after(
+                self.__analysis_poll_interval, self.__poll_analysis)
+            return
+
+        info = self.__analysis_info
+        if info is not None and "depth" in info:
+            score = dict(info["score"])
+            if self.__analysis_fen.split()[1] == "b":
+                score["value"] = -score["value"]
+            self.cache.store_evaluation(
+                self.__analysis_key, score, info["depth"], info.get("pv", []))
+        if on_bestmove is not None:
+            on_bestmove(finished)
+
+    def request_move(self, on_bestmove, movetime: int = None, depth: int = None,
+                     background: bool = False, poll_interval: int = 50):
+        """Ask the board's scheduler for a move in the current position.
+
+        on_bestmove gets the move in UCI notation, or None, from the Tk loop.
+        A request replaces any the board still has outstanding.
+        """
+        from scheduler import INTERACTIVE, BACKGROUND
+
+        if self.scheduler is None:
+            raise ValueError("This board has no engine scheduler")
+        if self.__search is not None:
+            self.scheduler.cancel(self.__search)
+        job = None
+        if self.speculator is not None and not background:
+            job = self.speculator.take(self, self.position)
+        if job is None:
+            start = self.position.copy()
+            while start.stack:
+                start.pop()
+            job = self.scheduler.submit(
+                self, start.fen(), self.__moves, BACKGROUND if background else INTERACTIVE,
+                movetime=movetime, depth=depth)
+        self.__search = job
+
+        def poll():
+            if job is not self.__search:
+                return
+            if not job.done():
+                self.canvas.after(poll_interval, poll)
+                return
+            self.__search = None
+            if job.cancelled:
+                return
+            bestmove = job.result["bestmove"] if job.result else None
+            on_bestmove(bestmove)
+            # Once the reply is on the board it is the user's turn to think.
+            if self.speculator is not None and not background and bestmove is not None \
+                    and self.__moves[-1:] == [bestmove]:
+                self.speculator.start(self, self.position.copy(), job.result.get("ponder"))
+        # A reply found while the user thought needs no waiting for.
+        self.canvas.after(0 if job.done() else poll_interval, poll)
+        return job
+
+    def cancel_move_request(self):
+        if self.__search is not None:
+            self.scheduler.cancel(self.__search)
+            self.__search = None
+        if self.speculator is not None:
+            self.speculator.cancel(self)
+
+    def __tablebase_moves(self) -> list:
+        if self.tablebase is None or not self.tablebase.covers(self.position):
+            return None
+        return self.tablebase.root_moves(self.position)
+
+    def __tablebase_line(self) -> tuple:
+        # (side to move relative score, [best move]) when the position is in
+        # the tablebases, else None.
+        ranked = self.__tablebase_moves()
+        if not ranked:
+            return None
+        score = self.tablebase.score(self.position)
+        if score is None:
+            return None
+        return score, [move_to_uci(ranked[0][0])]
+
+    def __screen(self, row: int, col: int) -> tuple:
+        if self._flipped:
+            return 7 - col, 7 - row
+        return col, row
 
-    def __is_empty(self, row: int, col: int):
-        if self.board[row][col] == "  ":
-            return True
+    def __sync_board(self):
+        self.board = [
+            [self.__cell_name(self.position.piece_at(square(col + row)))
+             for col in self.cols]
+            for row in self.rows
+        ]
+        self.turn = "White" if self.position.side_to_move == WHITE else "Black"
+
+    def __sync_squares(self, move: int):
+        # Only the squares a move touches change: both ends of the move, the
+        # pawn taken en passant, or the king's whole rank when castling.
+        origin, target = move_from(move), move_to(move)
+        flag = move_flag(move)
+        if flag == CASTLING:
+            touched = range(origin & 56, (origin & 56) + 8)
+        elif flag == EN_PASSANT:
+            touched = (origin, target, target ^ 8)
         else:
-            return False
+            touched = (origin, target)
+        for sq in touched:
+            self.board[7 - rank_of(sq)][file_of(sq)] = self.__cell_name(
+                self.position.piece_at(sq))
+        self.turn = "White" if self.position.side_to_move == WHITE else "Black"
+
+    @staticmethod
+    def __cell_name(piece: int) -> str:
+        if piece == NO_PIECE:
+            return "  "
+        return ("W" if color_of(piece) == WHITE else "B") + PIECE_SYMBOLS[piece].upper()
+
 
-    def __get_color(self, row: int, col: int):
-        if self.board[row][col].startswith("W"):
-            return "w"
-        elif self.board[row][col].startswith("B"):
-            return "b"
+class BookPanel:
+    def __init__(self, root: "tk.Tk", board: ChessBoard, book: "PolyglotBook", poll_interval: int = 200):
+        import tkinter as tk
 
+        self.board = board
+        self.book = book
 
-def main():
-    root = tk.Tk()
+        self.frame = tk.Frame(root)
+        self.frame.pack(side="left", fill="both", expand=True)
+        tk.Label(self.frame, text="Book", anchor="w").pack(fill="x")
+        self.listbox = tk.Listbox(self.frame, width=16, activestyle="none")
+        self.listbox.pack(fill="both", expand=True)
+        self.listbox.bind("<Double-Button-1>", self.__play_selected)
+
+        self.__moves = []
+        self.__key = None
+        self.__poll_interval = poll_interval
+        self.__poll()
+
+    def refresh(self):
+        pos = self.board.position
+        self.__key = pos.key
+        entries = sorted(self.book.entries(pos), key=lambda entry: -entry[1])
+        total = sum(weight for _, weight, _ in entries) or 1
+
+        self.__moves = [move for move, _, _ in entries]
+        self.listbox.delete(0, "end")
+        for move, weight, _ in entries:
+            self.listbox.insert("end", f"{pos.san(move):8}{100 * weight / total:5.1f}%")
+
+    def __play_selected(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self.board.push(self.__moves[selection[0]])
+            self.refresh()
+
+    def __poll(self):
+        # The board can change from anywhere (keys, loading a game), so the
+        # panel watches the position key instead of being told.
+        if self.board.position.key != self.__key:
+            self.refresh()
+        self.listbox.after(self.__poll_interval, self.__poll)
+
+
+class ReplayPanel:
+    def __init__(self, root: "tk.Tk", controller: "ReplayController"):
+        import tkinter as tk
+
+        self.controller = controller
+
+        self.frame = tk.Frame(root)
+        self.frame.pack(side="bottom", fill="x")
+        self.label = tk.Label(self.frame, width=14, anchor="w")
+        self.label.pack(side="left")
+        self.slider = tk.Scale(self.frame, from_=0, to=len(controller), orient="horizontal",
+                               showvalue=False, command=self.__scrub)
+        self.slider.pack(side="left", fill="x", expand=True)
+
+        root.bind("<Left>", lambda event: self.__go(controller.step(-1)))
+        root.bind("<Right>", lambda event: self.__go(controller.step(1)))
+        root.bind("<Prior>", lambda event: self.__go(controller.step(-10)))
+        root.bind("<Next>", lambda event: self.__go(controller.step(10)))
+        root.bind("<Home>", lambda event: self.__go(controller.first()))
+        root.bind("<End>", lambda event: self.__go(controller.last()))
+        self.__go(controller.ply)
+
+    def __scrub(self, value: str):
+        # Dragging fires for every pixel; seeks are cheap enough to follow
+        # each one, and the board redraws at most once per idle.
+        ply = int(float(value))
+        if ply != self.controller.ply:
+            self.controller.seek(ply)
+        self.__show(ply)
+
+    def __go(self, ply: int):
+        self.slider.set(ply)
+        self.__show(ply)
+
+    def __show(self, ply: int):
+        self.label.config(text=f"Ply {ply}/{len(self.controller)}")
+
+
+def _warm_up(pool: "EnginePool"):
+    # Starting Stockfish takes a while, so do it off the Tk thread. A missing
+    # binary is reported when the first analysis is requested instead.
+    try:
+        pool.warm_up()
+    except OSError:
+        pass
+
+
+def _set_icon(root: "tk.Tk"):
+    import tkinter as tk
+    # iconbitmap only understands .ico files on Windows; elsewhere the icon
+    # goes through PIL as a photo image.
+    try:
+        if sys.platform == "win32":
+            root.iconbitmap(icon_path)
+        else:
+            from PIL import Image, ImageTk
+            with Image.open(icon_path) as icon:
+                root.iconphoto(True, ImageTk.PhotoImage(icon))
+    except (tk.TclError, OSError):
+        pass
+
+
+def run_gui() -> int:
+    import threading
+    import tkinter as tk
+    from engine import get_engine_pool, shutdown_engine_pool
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as exc:
+        print(f"Cannot open a window: {exc}. Run a subcommand for headless use, see --help.",
+              file=sys.stderr)
+        return 1
     root.title("PyChess")
-    root.iconbitmap(icon_path)
+    _set_icon(root)
     root.geometry("600x485")
     root.minsize(485, 485)
 
-    board = ChessBoard(root, assets_dir)
+    pool = get_engine_pool()
+    threading.Thread(target=_warm_up, args=(pool,), daemon=True).start()
+
+    board = ChessBoard(root, assets_dir, engine_pool=pool)
     board.draw()
-    eng = stockfish.Stockfish(path=stockfish_path)
-    legal = eng.is_move_correct(input("Enter move\n> "))
-    if legal:
-        print("Move is legal")
-    else:
-        print("Move is illegal")
 
-    root.mainloop()
+    analysis_text = tk.StringVar(root, "Press A to analyse")
+    tk.Label(root, textvariable=analysis_text, justify="left",
+             anchor="nw", wraplength=110).pack(side="left", fill="both", expand=True)
+
+    def show_info(info: dict):
+        score = info.get("score")
+        if score is None:
+            return
+        if "wdl" in score:
+            value = f"Tablebase {WDL_NAMES[score['wdl']]}"
+        elif score["type"] == "mate":
+            value = f"#{score['value']}"
+        else:
+            value = f"{score['value'] / 100:+.2f}"
+        pv = " ".join(info.get("pv", [])[:6])
+        analysis_text.set(f"Depth {info.get('depth', 0)}\n{value}\n{pv}")
+
+    def toggle_analysis(event=None):
+        if board.analysis is not None and board.analysis.is_searching():
+            board.stop_analysis()
+        else:
+            board.start_analysis(infinite=True, on_info=show_info,
+                                 on_error=lambda exc: analysis_text.set(f"Engine error\n{exc}"))
+
+    root.bind("<a>", toggle_analysis)
+
+    book_path = os.environ.get("PYCHESS_BOOK", os.path.join(save_dir, "book.bin"))
+    if os.path.isfile(book_path):
+        from book import PolyglotBook
+        BookPanel(root, board, PolyglotBook(book_path))
+
+    try:
+        root.mainloop()
+    finally:
+        shutdown_engine_pool()
+    return 0
+
+
+# Subcommand name -> (module providing add_arguments/run, help text).
+COMMANDS = {
+    "perft": ("perft", "count move generator leaf nodes and measure speed"),
+    "analyze": ("analyze", "evaluate every position of a FEN/EPD file with a pool of engines"),
+    "pgn": ("pgn", "index a PGN file and print games from it"),
+    "convert": ("gamestore", "convert games between PGN and the binary game store"),
+    "search": ("posindex", "find stored games by position, material or pawn structure"),
+    "match": ("match", "play games between two engine configurations and estimate the Elo difference"),
+    "startup": ("startup", "measure cold start import time against a budget"),
+    "book": ("book", "build a Polyglot opening book from stored games or probe one"),
+    "syzygy": ("syzygy", "probe Syzygy endgame tablebases for a position"),
+    "bench": ("alphabeta", "measure the built-in engine's speed and depth under a per-move budget"),
+    "encode": ("features", "encode the positions of stored games as NumPy training batches"),
+    "simul": ("scheduler", "play many boards at once against a shared set of engines and report latency"),
+    "serve": ("server", "serve legal moves, evaluations and best moves for FENs over HTTP"),
+    "loadgen": ("loadgen", "load test a running analysis server and report latency and throughput"),
+    "tune": ("tune", "benchmark engine Threads, Hash and process counts and save the best for this host"),
+    "replay": ("replay", "step and scrub through a stored game with keyframed seeking"),
+    "ponder": ("speculate", "play a simulated player and measure how much speculative search saves")
+}
+
+
+def _add_global_arguments(parser):
+    parser.add_argument("--metrics", metavar="TARGET",
+                        help="record timings and counters and export them to a file "
+                             "(.json for JSON, else Prometheus text) or serve them on host:port")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="seconds between metrics file snapshots (default: 10)")
+
+
+def main(argv: list = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="pychess")
+    _add_global_arguments(parser)
+
+    # Only the module of the command being run is imported; the others just
+    # contribute their name and help line. The global options are read
+    # first, so an option's value is never taken for the command.
+    options = argparse.ArgumentParser(prog="pychess", add_help=False)
+    _add_global_arguments(options)
+    _, rest = options.parse_known_args(argv)
+    chosen = rest[0] if rest and rest[0] in COMMANDS else None
+
+    commands = parser.add_subparsers(dest="command")
+    for name, (module, help_text) in COMMANDS.items():
+        command_parser = commands.add_parser(name, help=help_text)
+        if name == chosen:
+            importlib.import_module(module).add_arguments(command_parser)
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enable(args.metrics, args.metrics_interval)
+    if args.command is None:
+        return run_gui()
+    return importlib.import_module(COMMANDS[args.command][0]).run(args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import os
+import sys
+import time
+import random
+from collections import OrderedDict
+from pgn import Game
+from position import Position, move_to_uci
+
+
+DEFAULT_KEYFRAME_INTERVAL = 16
+# Positions kept around the current ply, so stepping and slow scrubbing
+# hit the cache instead of replaying from a keyframe.
+DEFAULT_PREFETCH = 4
+DEFAULT_CACHE_SIZE = 128
+
+
+class Keyframe:
+    # Everything Position.copy() copies except the move stack, which every
+    # keyframe shares with the game's final position.
+    __slots__ = ("board", "by_type", "by_color", "side_to_move", "castling_rights",
+                 "ep_square", "halfmove_clock", "fullmove_number", "key")
+
+    def __init__(self, pos: Position):
+        self.board = bytes(pos.board)
+        self.by_type = tuple(pos.by_type)
+        self.by_color = tuple(pos.by_color)
+        self.side_to_move = pos.side_to_move
+        self.castling_rights = pos.castling_rights
+        self.ep_square = pos.ep_square
+        self.halfmove_clock = pos.halfmove_clock
+        self.fullmove_number = pos.fullmove_number
+        self.key = pos.key
+
+    def restore(self, stack: list) -> Position:
+        pos = Position.__new__(Position)
+        pos.board = list(self.board)
+        pos.by_type = list(self.by_type)
+        pos.by_color = list(self.by_color)
+        pos.side_to_move = self.side_to_move
+        pos.castling_rights = self.castling_rights
+        pos.ep_square = self.ep_square
+        pos.halfmove_clock = self.halfmove_clock
+        pos.fullmove_number = self.fullmove_number
+        pos.stack = stack
+        pos.key = self.key
+        return pos
+
+
+class ReplayController:
+    """Random access to the positions of a game, for stepping and scrubbing.
+
+    A snapshot of the position is kept every keyframe_interval plies, so
+    reaching any ply takes restoring the keyframe before it and playing at
+    most keyframe_interval - 1 moves. Positions next to the current ply are
+    prefetched from the board's idle loop. Without a board the controller
+    only answers position_at().
+    """
+
+    def __init__(self, game: Game, board=None, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL,
+                 prefetch: int = DEFAULT_PREFETCH, cache_size: int = DEFAULT_CACHE_SIZE):
+        if keyframe_interval < 1:
+            raise ValueError("Keyframes must be at least one ply apart")
+        self.game = game
+        self.board = board
+        self.keyframe_interval = keyframe_interval
+        self.prefetch = prefetch
+        self.cache_size = max(cache_size, 2 * prefetch + 1)
+        self.moves = list(game.moves)
+        self.uci_moves = [move_to_uci(move) for move in self.moves]
+        self.ply = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # One pass through the game yields the keyframes, and its final move
+        # stack holds the stack of every position before it as a prefix.
+        pos = Position(game.start_fen)
+        self._keyframes = []
+        for ply, move in enumerate(self.moves):
+            if ply % keyframe_interval == 0:
+                self._keyframes.append(Keyframe(pos))
+            pos.push(move)
+        if len(self.moves) % keyframe_interval == 0:
+            self._keyframes.append(Keyframe(pos))
+        self._stack = pos.stack
+        self._cache = OrderedDict()
+        self._cache[len(self.moves)] = pos.copy()
+        self._prefetch_job = None
+
+    def __len__(self) -> int:
+        return len(self.moves)
+
+    def position_at(self, ply: int) -> Position:
+        """The position after ply moves. It is shared with the cache, so
+        copy it before changing it."""
+        ply = self.__clamp(ply)
+        pos = self._cache.get(ply)
+        if pos is not None:
+            self._cache.move_to_end(ply)
+            self.hits += 1
+            return pos
+        self.misses += 1
+        pos = self.__build(ply)
+        self.__remember(ply, pos)
+        return pos
+
+    def seek(self, ply: int) -> int:
+        ply = self.__clamp(ply)
+        self.ply = ply
+        if self.board is not None:
+            self.board.show_position(self.position_at(ply).copy(), self.uci_moves[:ply])
+            self.__schedule_prefetch()
+        return ply
+
+    def step(self, plies: int = 1) -> int:
+        return self.seek(self.ply + plies)
+
+    def first(self) -> int:
+        return self.seek(0)
+
+    def last(self) -> int:
+        return self.seek(len(self.moves))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "plies": len(self.moves),
+            "keyframes": len(self._keyframes),
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def __clamp(self, ply: int) -> int:
+        return max(0, min(len(self.moves), ply))
+
+    def __build(self, ply: int) -> Position:
+        index = ply // self.keyframe_interval
+        start = index * self.keyframe_interval
+        pos = self._keyframes[index].restore(self._stack[:start])
+        for move in self.moves[start:ply]:
+            pos.push(move)
+        return pos
+
+    def __remember(self, ply: int, pos: Position):
+        self._cache[ply] = pos
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __schedule_prefetch(self):
+        # Runs once the board is idle, so a fast drag of the slider only
+        # prefetches around where it stops.
+        if self._prefetch_job is None and self.prefetch:
+            self._prefetch_job = self.board.canvas.after_idle(self.__prefetch)
+
+    def __prefetch(self):
+        self._prefetch_job = None
+        for distance in range(1, self.prefetch + 1):
+            for ply in (self.ply + distance, self.ply - distance):
+                if 0 <= ply <= len(self.moves) and ply not in self._cache:
+                    self.__remember(ply, self.__build(ply))
+
+
+def _load_game(path: os.PathLike, index: int) -> Game:
+    if path.lower().endswith(".pcg"):
+        from gamestore import GameStore
+
+        with GameStore(path) as store:
+            game = store[index]
+            game.moves = list(game.moves)
+            return game
+    from pgn import PgnDatabase
+
+    return PgnDatabase(path)[index]
+
+
+def add_arguments(parser):
+    parser.add_argument("source", help="PGN file or game store (.pcg) holding the game")
+    parser.add_argument("--game", type=int, default=0, help="index of the game in the file (default: 0)")
+    parser.add_argument("--keyframe", type=int, default=DEFAULT_KEYFRAME_INTERVAL,
+                        help=f"plies between position snapshots (default: {DEFAULT_KEYFRAME_INTERVAL})")
+    parser.add_argument("--bench", type=int, metavar="SEEKS",
+                        help="measure this many random seeks without a window and compare them "
+                             "with replaying from the start")
+
+
+def run(args) -> int:
+    try:
+        game = _load_game(args.source, args.game)
+    except (OSError, IndexError, ValueError) as exc:
+        print(f"Cannot load game {args.game} from {args.source}: {exc}", file=sys.stderr)
+        return 1
+
+    if args.bench:
+        start = time.perf_counter()
+        controller = ReplayController(game, keyframe_interval=args.keyframe, prefetch=0, cache_size=0)
+        setup = time.perf_counter() - start
+        targets = [random.randrange(len(game.moves) + 1) for _ in range(args.bench)]
+
+        start = time.perf_counter()
+        for ply in targets:
+            controller.position_at(ply)
+        seek = (time.perf_counter() - start) / len(targets)
+
+        start = time.perf_counter()
+        for ply in targets:
+            pos = Position(game.start_fen)
+            for move in game.moves[:ply]:
+                pos.push(move)
+        full = (time.perf_counter() - start) / len(targets)
+
+        print(f"{len(game.moves)} plies, {controller.stats()['keyframes']} keyframes built in {setup * 1000:.1f} ms")
+        print(f"Keyframed seek {seek * 1e6:.0f} us, replay from the start {full * 1e6:.0f} us, "
+              f"{full / seek if seek else 0:.0f}x faster")
+        return 0
+
+    import tkinter as tk
+    from pychess import ChessBoard, ReplayPanel, assets_dir
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as exc:
+        print(f"Cannot open a window: {exc}", file=sys.stderr)
+        return 1
+    root.title(f"PyChess replay - {game.headers.get('White', '?')} vs {game.headers.get('Black', '?')}")
+    board = ChessBoard(root, assets_dir)
+    controller = ReplayController(game, board, args.keyframe)
+    ReplayPanel(root, controller)
+    controller.seek(0)
+    board.draw()
+    root.mainloop()
+    return 0
@@ -0,0 +1,528 @@
+import os
+import sys
+import time
+import random
+import itertools
+import threading
+import metrics
+from metrics import Histogram
+from engine import EnginePool, EngineUnavailableError
+from position import Position, START_FEN, move_to_uci
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = ("interactive", "background")
+
+# Longest a single search may run for a board unless it is given its own
+# budget, in milliseconds. Searches without a limit of their own are run
+# for exactly this long.
+DEFAULT_BUDGET_MS = 2000
+
+# How often overdue searches are told to stop again, in seconds. The first
+# stop can reach the engine before its "go" and be ignored.
+STOP_RETRY = 0.05
+
+
+class SearchJob:
+    """One search request; wait() blocks until its result is in."""
+
+    def __init__(self, job_id: int, board, fen: str, moves, limits: dict, priority: int,
+                 on_info=None, on_done=None):
+        self.id = job_id
+        self.board = board
+        self.fen = fen
+        self.moves = list(moves)
+        self.limits = limits
+        self.priority = priority
+        self.on_info = on_info
+        self.on_done = on_done
+
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.deadline = None
+        self.result = None
+        self.error = None
+        self.preempted = False
+        self.cancelled = False
+        self._stop_sent = 0.0
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> dict:
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def latency(self) -> float:
+        return (self.finished or time.perf_counter()) - self.submitted
+
+
+class BoardState:
+    def __init__(self, name, budget_ms: int, weight: float = 1.0):
+        self.name = name
+        self.budget_ms = budget_ms
+        self.weight = weight
+        # Engine time used, scaled by weight. The board that has had the
+        # least goes next among equal priorities, so one busy board cannot
+        # starve the others.
+        self.vtime = 0.0
+        self.searches = 0
+        self.preempted = 0
+        self.engine_ms = 0.0
+        self.nodes = 0
+        # Indexed by priority: interactive latency is what a player feels,
+        # background latency only how stale the analysis gets.
+        self.wait = (Histogram(), Histogram())
+        self.latency = (Histogram(), Histogram())
+
+    def summary(self) -> dict:
+        return {
+            "searches": self.searches,
+            "preempted": self.preempted,
+            "engine_ms": round(self.engine_ms),
+            "nodes": self.nodes,
+            "wait_p50_ms": 1000 * self.wait[INTERACTIVE].quantile(0.5),
+            "wait_p99_ms": 1000 * self.wait[INTERACTIVE].quantile(0.99),
+            "latency_p50_ms": 1000 * self.latency[INTERACTIVE].quantile(0.5),
+            "latency_p99_ms": 1000 * self.latency[INTERACTIVE].quantile(0.99),
+            "latency_max_ms": 1000 * self.latency[INTERACTIVE].max,
+            "background": self.latency[BACKGROUND].count,
+            "background_p50_ms": 1000 * self.latency[BACKGROUND].quantile(0.5)
+        }
+
+
+class EngineScheduler:
+    """Shares one engine pool between many boards.
+
+    Queued searches run in priority order, interactive before background,
+    and fairly between boards of the same priority. Every search is held to
+    its board's time budget, and a background search is stopped early when
+    an interactive one is waiting for an engine.
+    """
+
+    def __init__(self, pool: EnginePool = None, budget_ms: int = DEFAULT_BUDGET_MS):
+        from engine import get_engine_pool
+
+        self.pool = pool if pool is not None else get_engine_pool()
+        self.budget_ms = budget_ms
+
+        self.completed = 0
+        self.preemptions = 0
+        self.nodes = 0
+        self.busy_ms = 0.0
+
+        self._boards = {}
+        self._queue = []
+        self._running = {}
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._started = time.perf_counter()
+
+        self._threads = [threading.Thread(target=self.__work, name=f"scheduler-{i}", daemon=True)
+                         for i in range(self.pool.size)]
+        self._threads.append(threading.Thread(target=self.__watch, name="scheduler-watch", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        metrics.register_source("scheduler", self.stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def register(self, board, budget_ms: int = None, weight: float = 1.0):
+        with self._cond:
+            state = self._boards.get(board)
+            if state is None:
+                state = self._boards[board] = BoardState(board, budget_ms or self.budget_ms, weight)
+                # A newcomer starts level with the boards already waiting
+                # rather than owed all the time they have used.
+                state.vtime = min((job_board.vtime for job_board in self.__waiting_boards()), default=0.0)
+            else:
+                state.budget_ms = budget_ms or state.budget_ms
+                state.weight = weight
+        return state
+
+    def submit(self, board, fen: str, moves=(), priority: int = INTERACTIVE,
+               on_info=None, on_done=None, **limits) -> SearchJob:
+        """Queue a search of fen plus moves for board under UCI limits.
+
+        on_info and on_done run on a scheduler thread; GUI callers poll
+        job.done() from their own loop instead.
+        """
+        if priority not in (INTERACTIVE, BACKGROUND):
+            raise ValueError(f"Unknown priority {priority!r}")
+        state = self._boards.get(board) or self.register(board)
+        limits = {name: value for name, value in limits.items() if value is not None}
+        # A search with no limit runs for the whole budget, and a longer
+        # movetime is cut down to it.
+        if not limits or limits.get("infinite"):
+            limits = {"movetime": state.budget_ms}
+        elif "movetime" in limits:
+            limits["movetime"] = min(limits["movetime"], state.budget_ms)
+
+        with self._cond:
+            if self._closed:
+                raise EngineUnavailableError("The scheduler has been closed")
+            job = SearchJob(next(self._ids), board, fen, moves, limits, priority, on_info, on_done)
+            self._queue.append(job)
+            if priority == INTERACTIVE and len(self._running) >= len(self._threads) - 1:
+                self.__preempt_background()
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job: SearchJob):
+        with self._cond:
+            job.cancelled = True
+            if job in self._queue:
+                self._queue.remove(job)
+                self.__finish(job)
+            elif job.id in self._running:
+                self.__stop(job)
+
+    def promote(self, job: SearchJob) -> bool:
+        """Make job interactive, so no other search preempts it.
+
+        False, and the job is left alone, when it has already been
+        preempted or cancelled.
+        """
+        with self._cond:
+            if job.preempted or job.cancelled:
+                return False
+            job.priority = INTERACTIVE
+            return True
+
+    def cancel_board(self, board):
+        with self._cond:
+            jobs = [job for job in self._queue if job.board == board]
+            jobs += [job for job, _ in self._running.values() if job.board == board]
+        for job in jobs:
+            self.cancel(job)
+
+    def drain(self, timeout: float = None) -> bool:
+        """Wait until nothing is queued or running; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._running, timeout)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            for job in self._queue:
+                job.cancelled = True
+                self.__finish(job)
+            self._queue.clear()
+            for job, _ in self._running.values():
+                job.cancelled = True
+                self.__stop(job)
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(5)
+
+    def stats(self) -> dict:
+        with self._cond:
+            elapsed = time.perf_counter() - self._started
+            return {
+                "engines": len(self._threads) - 1,
+                "boards": len(self._boards),
+                "queued": len(self._queue),
+                "running": len(self._running),
+                "completed": self.completed,
+                "preemptions": self.preemptions,
+                "searches_per_second": self.completed / elapsed if elapsed > 0 else 0.0,
+                "nodes_per_second": self.nodes / elapsed if elapsed > 0 else 0.0,
+                "utilization": self.busy_ms / (1000 * elapsed * (len(self._threads) - 1)) if elapsed > 0 else 0.0
+            }
+
+    def board_stats(self) -> dict:
+        with self._cond:
+            return {state.name: state.summary() for state in self._boards.values()}
+
+    def __waiting_boards(self):
+        return [self._boards[job.board] for job in self._queue if job.board in self._boards]
+
+    def __next_job(self) -> SearchJob:
+        # Called with the lock held.
+        best = min(self._queue, key=lambda job: (job.priority, self._boards[job.board].vtime, job.id))
+        self._queue.remove(best)
+        return best
+
+    def __preempt_background(self):
+        running = [job for job, engine in self._running.values()
+                   if engine is not None and job.priority == BACKGROUND and not job.preempted]
+        if running:
+            victim = min(running, key=lambda job: job.started)
+            victim.preempted = True
+            self.preemptions += 1
+            metrics.count("scheduler_preemptions")
+            self.__stop(victim)
+
+    def __stop(self, job: SearchJob):
+        # Called with the lock held, so the stop reaches the engine before
+        # the worker can send it another search. A job still waiting for an
+        # engine checks for cancellation itself before it starts.
+        entry = self._running.get(job.id)
+        if entry is None or entry[1] is None:
+            return
+        job._stop_sent = time.perf_counter()
+        try:
+            entry[1].send("stop")
+        except (BrokenPipeError, OSError):
+            pass
+
+    def __finish(self, job: SearchJob):
+        job.finished = time.perf_counter()
+        job._done.set()
+        if job.on_done is not None:
+            try:
+                job.on_done(job)
+            except Exception as exc:
+                print(f"Search callback failed: {exc!r}", file=sys.stderr)
+
+    def __work(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = self.__next_job()
+                # Claimed jobs count as running from here on, so drain()
+                # never sees a job that is in neither place.
+                self._running[job.id] = (job, None)
+            try:
+                with self.pool.engine() as engine:
+                    self.__run(job, engine)
+            except Exception as exc:
+                job.error = exc
+            finally:
+                with self._cond:
+                    self._running.pop(job.id, None)
+                    self._cond.notify_all()
+            self.__finish(job)
+
+    def __run(self, job: SearchJob, engine):
+        state = self._boards[job.board]
+        with self._cond:
+            if job.cancelled:
+                return
+            job.started = time.perf_counter()
+            job.deadline = job.started + state.budget_ms / 1000
+            self._running[job.id] = (job, engine)
+            self._cond.notify_all()
+        try:
+            result = engine.go(job.fen, job.moves, on_info=job.on_info, **job.limits)
+        finally:
+            with self._cond:
+                # Nothing may stop this engine once it is back in the pool.
+                self._running[job.id] = (job, None)
+        elapsed_ms = 1000 * (time.perf_counter() - job.started)
+
+        result["preempted"] = job.preempted
+        job.result = result
+        with self._cond:
+            state.vtime += elapsed_ms / state.weight
+            state.searches += 1
+            state.preempted += job.preempted
+            state.engine_ms += elapsed_ms
+            state.nodes += result.get("nodes", 0)
+            state.wait[job.priority].observe(job.started - job.submitted)
+            state.latency[job.priority].observe(time.perf_counter() - job.submitted)
+            self.completed += 1
+            self.nodes += result.get("nodes", 0)
+            self.busy_ms += elapsed_ms
+        metrics.observe(f"scheduler.{PRIORITY_NAMES[job.priority]}", time.perf_counter() - job.submitted)
+
+    def __watch(self):
+        # Stops searches that outrun their board's budget.
+        while True:
+            with self._cond:
+                if self._closed and not self._running:
+                    return
+                now = time.perf_counter()
+                wake = now + 0.5
+                for job, engine in list(self._running.values()):
+                    if engine is None:
+                        continue
+                    if now >= job.deadline:
+                        if now - job._stop_sent >= STOP_RETRY:
+                            self.__stop(job)
+                        wake = min(wake, now + STOP_RETRY)
+                    else:
+                        wake = min(wake, job.deadline)
+                self._cond.wait(max(0.001, wake - now))
+
+
+class SimulBoard:
+    """A board in a simul: the engine answers every move it is asked for.
+
+    The opponent's moves are random and take think_ms to find, which is
+    enough to load the scheduler the way a room of players would.
+    """
+
+    def __init__(self, name: str, scheduler: EngineScheduler, plies: int, movetime: int,
+                 analysis_depth: int = None, think_ms: int = 0, seed: int = None):
+        self.name = name
+        self.scheduler = scheduler
+        self.plies = plies
+        self.movetime = movetime
+        self.analysis_depth = analysis_depth
+        self.think_ms = think_ms
+        self.random = random.Random(seed)
+        self.pos = Position(START_FEN)
+        self.played = []
+        self.finished = threading.Event()
+
+    def start(self):
+        self.__opponent_move()
+
+    def __opponent_think(self):
+        # The analysis of the engine's move runs while the player thinks.
+        if self.analysis_depth:
+            self.scheduler.submit(self.name, START_FEN, self.played, BACKGROUND,
+                                  depth=self.analysis_depth)
+        if self.think_ms:
+            timer = threading.Timer(self.random.uniform(0.5, 1.5) * self.think_ms / 1000,
+                                    self.__opponent_move)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.__opponent_move()
+
+    def __opponent_move(self):
+        moves = self.pos.legal_moves()
+        if not moves or len(self.played) >= self.plies:
+            self.finished.set()
+            return
+        move = self.random.choice(moves)
+        self.pos.push(move)
+        self.played.append(move_to_uci(move))
+        self.scheduler.submit(self.name, START_FEN, self.played, INTERACTIVE,
+                              on_done=self.__engine_move, movetime=self.movetime)
+
+    def __engine_move(self, job: SearchJob):
+        bestmove = job.result["bestmove"] if job.result else None
+        if bestmove is None:
+            self.finished.set()
+            return
+        self.pos.push(self.pos.parse_uci(bestmove))
+        self.played.append(bestmove)
+        self.__opponent_think()
+
+
+def add_arguments(parser):
+    parser.add_argument("--boards", type=int, default=16, help="boards sharing the engines (default: 16)")
+    parser.add_argument("--engines", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="engine processes (default: half the CPU count)")
+    parser.add_argument("--engine", help="path to the UCI engine binary (default: auto-detected)")
+    parser.add_argument("--plies", type=int, default=20, help="plies to play on every board (default: 20)")
+    parser.add_argument("--movetime", type=int, default=100,
+                        help="milliseconds for each engine reply (default: 100)")
+    parser.add_argument("--think", type=int, default=200,
+                        help="average milliseconds the simulated players take per move (default: 200)")
+    parser.add_argument("--analysis-depth", type=int,
+                        help="also analyse every engine move in the background to this depth")
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET_MS,
+                        help=f"longest search per board in milliseconds (default: {DEFAULT_BUDGET_MS})")
+    parser.add_argument("--seed", type=int, help="seed for the simulated players' moves")
+    parser.add_argument("--gui", action="store_true", help="show the boards in a window while they play")
+    parser.add_argument("--tile-size", type=int, default=24, help="square size of the boards in the window")
+
+
+def _run_gui(args, pool: EnginePool, scheduler: EngineScheduler) -> int:
+    import math
+    import tkinter as tk
+    from pychess import ChessBoard, assets_dir
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as exc:
+        print(f"Cannot open a window: {exc}", file=sys.stderr)
+        return 1
+    root.title("PyChess simul")
+    columns = math.ceil(math.sqrt(args.boards))
+    status = tk.StringVar(root)
+    tk.Label(root, textvariable=status, anchor="w").grid(row=0, column=0, columnspan=columns, sticky="we")
+
+    players = random.Random(args.seed)
+
+    def opponent_move(board: ChessBoard):
+        moves = board.position.legal_moves()
+        if not moves or len(board.get_moves()) >= args.plies:
+            return
+        board.push(players.choice(moves))
+        board.request_move(lambda move: engine_move(board, move), movetime=args.movetime)
+
+    def engine_move(board: ChessBoard, move: str):
+        if move is None:
+            return
+        board.push(move)
+        if args.analysis_depth:
+            scheduler.submit(board, START_FEN, board.get_moves(), BACKGROUND, depth=args.analysis_depth)
+        root.after(int(players.uniform(0.5, 1.5) * args.think), opponent_move, board)
+
+    for i in range(args.boards):
+        frame = tk.Frame(root, padx=2, pady=2)
+        frame.grid(row=1 + i // columns, column=i % columns)
+        board = ChessBoard(frame, assets_dir, tile_size=args.tile_size, engine_pool=pool, scheduler=scheduler)
+        scheduler.register(board)
+        board.draw()
+        root.after(0, opponent_move, board)
+
+    def show_stats():
+        totals = scheduler.stats()
+        status.set(f"{totals['completed']} searches, {totals['searches_per_second']:.1f}/s, "
+                   f"{totals['utilization']:.0%} busy, {totals['queued']} queued, "
+                   f"{totals['preemptions']} preemptions")
+        root.after(500, show_stats)
+
+    show_stats()
+    root.mainloop()
+    return 0
+
+
+def run(args) -> int:
+    pool = EnginePool(size=args.engines, path=args.engine, prewarm=True)
+    scheduler = EngineScheduler(pool, args.budget)
+    if args.gui:
+        try:
+            return _run_gui(args, pool, scheduler)
+        finally:
+            scheduler.close()
+            pool.close()
+    boards = [SimulBoard(f"board-{i + 1}", scheduler, args.plies, args.movetime, args.analysis_depth,
+                         args.think, None if args.seed is None else args.seed + i)
+              for i in range(args.boards)]
+    start = time.perf_counter()
+    try:
+        for board in boards:
+            scheduler.register(board.name)
+            board.start()
+        for board in boards:
+            board.finished.wait()
+        scheduler.drain()
+        elapsed = time.perf_counter() - start
+        totals = scheduler.stats()
+        per_board = scheduler.board_stats()
+    finally:
+        scheduler.close()
+        pool.close()
+
+    for name, summary in per_board.items():
+        print(f"{name:<10} {summary['searches']:>4} searches  {summary['preempted']:>3} preempted  "
+              f"latency p50 {summary['latency_p50_ms']:7.1f} ms  p99 {summary['latency_p99_ms']:7.1f} ms  "
+              f"wait p50 {summary['wait_p50_ms']:7.1f} ms  "
+              f"{summary['background']:>3} analyses p50 {summary['background_p50_ms']:7.1f} ms")
+    print(f"\n{totals['completed']} searches on {args.boards} boards with {totals['engines']} engines "
+          f"in {elapsed:.1f} s: {totals['searches_per_second']:.1f} searches/s, "
+          f"{totals['nodes_per_second']:.0f} nodes/s, {totals['utilization']:.0%} engine utilization, "
+          f"{totals['preemptions']} preemptions")
+    return 0
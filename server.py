@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import metrics
+from analyze import analyse_position
+from engine import EnginePool, EngineUnavailableError, find_engine
+from position import Position, InvalidFenError, IllegalMoveError, move_to_uci
+from syzygy import Tablebase
+from tt import TranspositionTable
+from tune import get_profile
+
+
+DEFAULT_PORT = 8765
+DEFAULT_DEPTH = 12
+# Requests cannot ask for more than this, so one client cannot tie up an
+# engine for minutes.
+MAX_DEPTH = 30
+MAX_MOVETIME = 10000
+MAX_BATCH = 256
+# Engine searches waiting or running, per engine, before new ones are
+# turned away with a 503.
+QUEUE_PER_ENGINE = 4
+
+QUERY_TYPES = ("legal", "evaluate", "bestmove")
+
+
+class BadRequestError(ValueError):
+    pass
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class AnalysisServer:
+    """Legal moves, evaluations and best moves for FENs, over HTTP.
+
+    Engine searches run on a pool of warm engines. A request for a search
+    that is already running waits for that search instead of starting
+    another, and once the queue of searches is full new ones are refused
+    rather than left to wait without bound.
+    """
+
+    def __init__(self, pool: EnginePool, depth: int = DEFAULT_DEPTH, max_pending: int = None,
+                 tablebase: Tablebase = None, cache: TranspositionTable = None):
+        self.pool = pool
+        self.depth = depth
+        self.max_pending = max_pending or QUEUE_PER_ENGINE * pool.size
+        self.tablebase = tablebase
+        self.cache = cache if cache is not None else TranspositionTable()
+
+        self.requests = 0
+        self.searches = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latency = metrics.Histogram()
+
+        self._executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="server")
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.http = None
+
+        metrics.register_source("server", self.stats)
+
+    def close(self):
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+            self.http = None
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def legal_moves(self, fen: str, moves=()) -> dict:
+        pos = self.__position(fen, moves)
+        with self._lock:
+            legal = self.cache.probe_moves(pos.key)
+            if legal is None:
+                legal = pos.legal_moves()
+                self.cache.store_moves(pos.key, legal)
+        return {"fen": pos.fen(), "moves": [move_to_uci(move) for move in legal]}
+
+    def evaluate(self, fen: str, depth: int = None) -> Future:
+        # The score is from white's point of view, as in the analyze command.
+        depth = self.__limit(depth, self.depth, MAX_DEPTH, "depth")
+        pos = self.__position(fen)
+        fen = pos.fen()
+        return self.__search(("evaluate", pos.key, depth), self.__evaluate, fen, depth)
+
+    def best_move(self, fen: str, moves=(), depth: int = None, movetime: int = None) -> Future:
+        # The score is from the side to move's point of view, as in UCI.
+        # Searches are keyed on the normalised FEN, so the same position
+        # written differently still shares one search.
+        pos = self.__position(fen, moves)
+        while pos.stack:
+            pos.pop()
+        fen = pos.fen()
+        moves = tuple(moves)
+        if movetime is not None:
+            limits = {"movetime": self.__limit(movetime, None, MAX_MOVETIME, "movetime")}
+        else:
+            limits = {"depth": self.__limit(depth, self.depth, MAX_DEPTH, "depth")}
+        key = ("bestmove", fen, moves, tuple(limits.items()))
+        return self.__search(key, self.__best_move, fen, moves, limits)
+
+    def handle(self, query: dict) -> Future:
+        """Start one query, {"type": ..., "fen": ..., ...}, and return its future."""
+        if not isinstance(query, dict):
+            raise BadRequestError("A query must be a JSON object")
+        kind = query.get("type")
+        fen = query.get("fen")
+        if not isinstance(fen, str):
+            raise BadRequestError("A query needs a fen")
+        moves = query.get("moves") or ()
+        if isinstance(moves, str):
+            moves = moves.replace(",", " ").split()
+        if not isinstance(moves, (list, tuple)) or not all(isinstance(move, str) for move in moves):
+            raise BadRequestError("moves must be a list of UCI moves")
+        if kind == "legal":
+            future = Future()
+            future.set_result(self.legal_moves(fen, moves))
+            return future
+        if kind == "evaluate":
+            if moves:
+                fen = self.__position(fen, moves).fen()
+            return self.evaluate(fen, self.__int(query, "depth"))
+        if kind == "bestmove":
+            return self.best_move(fen, moves, self.__int(query, "depth"), self.__int(query, "movetime"))
+        raise BadRequestError(f"Unknown query type {kind!r}, use one of {', '.join(QUERY_TYPES)}")
+
+    def handle_batch(self, queries: list) -> list:
+        # Every search is started before any is waited for, so a batch
+        # takes about as long as its slowest search. Cheap queries are
+        # answered as they are read. A query that fails, for whatever
+        # reason, gets an error entry and does not fail the others.
+        if not isinstance(queries, list):
+            raise BadRequestError("A batch must be a JSON list of queries")
+        if len(queries) > MAX_BATCH:
+            raise BadRequestError(f"A batch holds at most {MAX_BATCH} queries")
+        started = []
+        for query in queries:
+            try:
+                started.append(self.handle(query))
+            except Exception as exc:
+                started.append(exc)
+        results = []
+        for future in started:
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                results.append(future.result())
+            except ServerBusyError as exc:
+                results.append({"error": str(exc), "busy": True})
+            except Exception as exc:
+                if not isinstance(exc, (BadRequestError, EngineUnavailableError)):
+                    with self._lock:
+                        self.errors += 1
+                results.append({"error": str(exc) or type(exc).__name__})
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {
+                "requests": self.requests,
+                "searches": self.searches,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "inflight": len(self._inflight)
+            }
+        return dict(counts,
+                    max_pending=self.max_pending,
+                    latency_p50_ms=1000 * self.latency.quantile(0.5),
+                    latency_p99_ms=1000 * self.latency.quantile(0.99),
+                    engines=self.pool.stats())
+
+    def serve(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        """Serve until shutdown() on a background thread; returns the address."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so clients pay for a connection once, not per request.
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; with Nagle on, the
+            # body waits for the client's delayed ACK of the headers.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                self.__answer(url.path, query)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self.__send(400, {"error": "The body is not valid JSON"})
+                    return
+                self.__answer(url.path, body)
+
+            def __answer(self, path: str, body):
+                start = time.perf_counter()
+                path = path.rstrip("/")
+                status = 200
+                try:
+                    if path == "/stats":
+                        result = server.stats()
+                    elif path == "/batch":
+                        result = server.handle_batch(body)
+                    elif path.lstrip("/") in QUERY_TYPES:
+                        if not isinstance(body, dict):
+                            raise BadRequestError("A query must be a JSON object")
+                        result = server.handle(dict(body, type=path.lstrip("/"))).result()
+                    else:
+                        status, result = 404, {"error": f"No such endpoint {path or '/'}"}
+                except BadRequestError as exc:
+                    status, result = 400, {"error": str(exc)}
+                except ServerBusyError as exc:
+                    status, result = 503, {"error": str(exc)}
+                except EngineUnavailableError as exc:
+                    status, result = 503, {"error": str(exc)}
+                except Exception as exc:
+                    # Anything else, such as an engine that crashed mid
+                    # search, still gets an answer and keeps the connection.
+                    status, result = 500, {"error": f"Internal error: {str(exc) or type(exc).__name__}"}
+                with server._lock:
+                    if status >= 400 and status != 503:
+                        server.errors += 1
+                    server.requests += 1
+                server.latency.observe(time.perf_counter() - start)
+                metrics.observe("server.request", time.perf_counter() - start)
+                self.__send(status, result)
+
+            def __send(self, status: int, result):
+                data = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 503:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.http = ThreadingHTTPServer((host, port), Handler)
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self.http.server_address
+
+    def __search(self, key, func, *args) -> Future:
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                metrics.count("server_coalesced")
+                return future
+            if len(self._inflight) >= self.max_pending:
+                self.rejected += 1
+                metrics.count("server_rejected")
+                raise ServerBusyError(f"All {self.pool.size} engines are busy with "
+                                      f"{len(self._inflight)} searches queued, try again later")
+            future = self._inflight[key] = self._executor.submit(func, *args)
+            self.searches += 1
+        future.add_done_callback(lambda _: self.__forget(key))
+        return future
+
+    def __forget(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def __evaluate(self, fen: str, depth: int) -> dict:
+        record = analyse_position(self.pool, 0, fen, {}, depth, self.tablebase)
+        del record["index"]
+        return record
+
+    def __best_move(self, fen: str, moves: tuple, limits: dict) -> dict:
+        with self.pool.engine() as engine:
+            result = engine.go(fen, moves, **limits)
+        return dict(result, fen=fen, moves=list(moves))
+
+    @staticmethod
+    def __position(fen: str, moves=()) -> Position:
+        try:
+            pos = Position(fen)
+            for move in moves:
+                pos.push(pos.parse_uci(move))
+        except (InvalidFenError, IllegalMoveError) as exc:
+            raise BadRequestError(str(exc)) from None
+        return pos
+
+    @staticmethod
+    def __int(query: dict, name: str) -> int:
+        value = query.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise BadRequestError(f"{name} must be a whole number") from None
+
+    @staticmethod
+    def __limit(value: int, default: int, maximum: int, name: str) -> int:
+        value = default if value is None else value
+        if not 0 < value <= maximum:
+            raise BadRequestError(f"{name} must be between 1 and {maximum}")
+        return value
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--engines", type=int,
+                        help="engine processes (default: the tuned profile, else CPU count)")
+    parser.add_argument("--engine", help="path to the UCI engine binary (default: auto-detected)")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH,
+                        help=f"search depth when a request gives none (default: {DEFAULT_DEPTH})")
+    parser.add_argument("--threads", type=int,
+                        help="Threads option for every engine (default: the tuned profile, else 1)")
+    parser.add_argument("--hash", type=int,
+                        help="Hash option in MB for every engine (default: the tuned profile, else 16)")
+    parser.add_argument("--max-pending", type=int,
+                        help=f"searches queued before requests are refused (default: {QUEUE_PER_ENGINE} per engine)")
+    parser.add_argument("--syzygy", default=os.environ.get("PYCHESS_SYZYGY"),
+                        help="evaluate positions found in these Syzygy tablebase directories "
+                             "without an engine (default: $PYCHESS_SYZYGY)")
+
+
+def run(args) -> int:
+    if args.engines is None:
+        profile = get_profile(args.engine or find_engine())
+        args.engines = profile["workers"] if profile else os.cpu_count() or 1
+    parameters = {name: value for name, value in (("Threads", args.threads), ("Hash", args.hash))
+                  if value is not None}
+    pool = EnginePool(size=args.engines, path=args.engine, depth=args.depth, parameters=parameters)
+    tablebase = Tablebase(args.syzygy) if args.syzygy else None
+    server = AnalysisServer(pool, args.depth, args.max_pending, tablebase)
+    try:
+        pool.warm_up()
+        host, port = server.serve(args.host, args.port)
+        print(f"Serving on http://{host}:{port} with {pool.size} engines", file=sys.stderr)
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    except OSError as exc:
+        print(f"Cannot serve on {args.host}:{args.port}: {exc}", file=sys.stderr)
+        return 1
+    finally:
+        server.close()
+        pool.close()
+    return 0
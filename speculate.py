@@ -0,0 +1,268 @@
+import sys
+import time
+import threading
+import metrics
+from bitboard import PAWN
+from position import Position, NO_PIECE, EN_PASSANT, move_from, move_to, move_flag, move_to_uci
+from scheduler import EngineScheduler, SearchJob, INTERACTIVE, BACKGROUND
+from tt import TranspositionTable, get_transposition_table
+
+
+DEFAULT_WIDTH = 3
+# Rough piece values for guessing which captures a player looks at first.
+_VALUES = (0, 1, 3, 3, 5, 9, 0)
+
+
+def likely_moves(pos: Position, ponder: str = None, width: int = DEFAULT_WIDTH) -> list:
+    """Up to width moves the side to move is most likely to play.
+
+    The engine's expected move comes first. After it, recaptures on the
+    square the last move landed on, then other captures by the value
+    gained, then checks: forcing moves are what players find first.
+    """
+    legal = pos.legal_moves()
+    ranked = []
+    if ponder is not None:
+        try:
+            expected = pos.parse_uci(ponder)
+        except ValueError:
+            expected = None
+        if expected in legal:
+            ranked.append(expected)
+
+    last_to = move_to(pos.stack[-1][0]) if pos.stack else None
+    scored = []
+    for move in legal:
+        if move in ranked:
+            continue
+        victim = pos.piece_at(move_to(move))
+        if move_flag(move) == EN_PASSANT:
+            victim = PAWN
+        attacker = pos.piece_at(move_from(move)) & 7
+        if victim != NO_PIECE:
+            score = 100 + 10 * _VALUES[victim & 7] - _VALUES[attacker]
+            if move_to(move) == last_to:
+                score += 1000
+        else:
+            pos.push(move)
+            score = 50 if pos.in_check() else 0
+            pos.pop()
+        scored.append((score, move))
+    scored.sort(key=lambda entry: -entry[0])
+    ranked += [move for _, move in scored]
+    return ranked[:width]
+
+
+def _history(pos: Position) -> tuple:
+    # The game's start FEN and its moves, so engines see the repetitions.
+    start = pos.copy()
+    while start.stack:
+        start.pop()
+    return start.fen(), [move_to_uci(move) for move, *_ in pos.stack]
+
+
+class Speculator:
+    """Searches the replies to the user's likely moves while they think.
+
+    The searches run as background jobs on a scheduler, so any real search
+    stops them. When the user plays a predicted move its reply is already
+    found, or has been searching since the user started thinking; any other
+    move cancels the speculative searches with a stop each. Legal moves of
+    the position the user is thinking about, and of the positions after
+    each predicted reply, go into the move cache the board reads from.
+    """
+
+    def __init__(self, scheduler: EngineScheduler = None, movetime: int = 1000, depth: int = None,
+                 width: int = DEFAULT_WIDTH, cache: TranspositionTable = None):
+        self.scheduler = scheduler if scheduler is not None else EngineScheduler()
+        self.limits = {"depth": depth} if depth else {"movetime": movetime}
+        self.width = width
+        self.cache = cache if cache is not None else get_transposition_table()
+
+        self.predictions = 0
+        self.searched = 0
+        self.hits = 0
+        self.misses = 0
+        self.late = 0
+        self.saved_ms = 0.0
+        self.wasted_ms = 0.0
+
+        self._jobs = {}
+        self._lock = threading.Lock()
+        metrics.register_source("speculation", self.stats)
+
+    def start(self, owner, pos: Position, ponder: str = None):
+        """Speculate for owner, the user being to move in pos."""
+        self.cancel(owner)
+        self.__store_moves(pos)
+        fen, moves = _history(pos)
+        jobs = {}
+        for move in likely_moves(pos, ponder, self.width):
+            pos.push(move)
+            key = pos.key
+            pos.pop()
+            jobs[key] = self.scheduler.submit(owner, fen, moves + [move_to_uci(move)], BACKGROUND,
+                                              on_done=self.__searched, **self.limits)
+        with self._lock:
+            self._jobs[owner] = jobs
+            self.predictions += 1
+            self.searched += len(jobs)
+
+    def take(self, owner, pos: Position) -> SearchJob:
+        """The speculative search of pos, the position after the user's move.
+
+        The job is finished, or running and worth waiting for; None means
+        the move was not predicted, or its search never started or was
+        preempted, and a real search is needed. The other speculative
+        searches are cancelled.
+        """
+        with self._lock:
+            jobs = self._jobs.pop(owner, None)
+        if jobs is None:
+            return None
+        job = jobs.pop(pos.key, None)
+        for other in jobs.values():
+            self.__discard(other)
+
+        if job is None:
+            with self._lock:
+                self.misses += 1
+            metrics.count("speculation_misses")
+            return None
+        # A preempted search stopped early with a shallow move. One that is
+        # taken becomes interactive, since the user now waits for it.
+        if job.started is None or not self.scheduler.promote(job):
+            self.scheduler.cancel(job)
+            with self._lock:
+                self.late += 1
+            return None
+        # Everything the search did before the user moved is time the user
+        # does not wait for.
+        now = time.perf_counter()
+        saved = (min(now, job.finished) if job.finished else now) - job.started
+        with self._lock:
+            self.hits += 1
+            self.saved_ms += 1000 * saved
+        metrics.count("speculation_hits")
+        return job
+
+    def cancel(self, owner):
+        with self._lock:
+            jobs = self._jobs.pop(owner, {})
+        for job in jobs.values():
+            self.__discard(job)
+
+    def stats(self) -> dict:
+        with self._lock:
+            guesses = self.hits + self.misses + self.late
+            return {
+                "predictions": self.predictions,
+                "searched": self.searched,
+                "hits": self.hits,
+                "misses": self.misses,
+                "late": self.late,
+                "hit_rate": self.hits / guesses if guesses else 0.0,
+                "saved_ms": round(self.saved_ms),
+                "wasted_ms": round(self.wasted_ms)
+            }
+
+    def __discard(self, job: SearchJob):
+        if job.started is not None:
+            end = job.finished or time.perf_counter()
+            with self._lock:
+                self.wasted_ms += 1000 * (end - job.started)
+        self.scheduler.cancel(job)
+
+    def __searched(self, job: SearchJob):
+        # The user's turn after the predicted reply gets its legal moves
+        # ready too.
+        if job.cancelled or not job.result or not job.result.get("bestmove"):
+            return
+        pos = Position(job.fen)
+        try:
+            for move in (*job.moves, job.result["bestmove"]):
+                pos.push(pos.parse_uci(move))
+        except ValueError:
+            return
+        self.__store_moves(pos)
+
+    def __store_moves(self, pos: Position):
+        with self._lock:
+            if self.cache.probe_moves(pos.key) is None:
+                self.cache.store_moves(pos.key, pos.legal_moves())
+
+
+def add_arguments(parser):
+    parser.add_argument("--engine", help="path to the UCI engine binary (default: auto-detected)")
+    parser.add_argument("--engines", type=int, default=1, help="engine processes (default: 1)")
+    parser.add_argument("--plies", type=int, default=30, help="plies to play (default: 30)")
+    parser.add_argument("--movetime", type=int, default=500,
+                        help="milliseconds per engine reply (default: 500)")
+    parser.add_argument("--think", type=int, default=1500,
+                        help="milliseconds the simulated player thinks per move (default: 1500)")
+    parser.add_argument("--player-depth", type=int, default=6,
+                        help="search depth of the simulated player (default: 6)")
+    parser.add_argument("--width", type=int, default=DEFAULT_WIDTH,
+                        help=f"user moves to search replies for (default: {DEFAULT_WIDTH})")
+    parser.add_argument("--off", action="store_true", help="play without speculating, for comparison")
+
+
+def run(args) -> int:
+    from engine import EnginePool, ChessEngine
+
+    pool = EnginePool(size=args.engines, path=args.engine, prewarm=True)
+    scheduler = EngineScheduler(pool, budget_ms=max(args.movetime, 1000))
+    speculator = Speculator(scheduler, args.movetime, width=args.width, cache=TranspositionTable())
+    # The simulated player has an engine of its own, weaker and slower to
+    # move, as a person would be.
+    player = ChessEngine(pool.path, depth=args.player_depth, cache=False)
+    pos = Position()
+    latencies = []
+    searches = []
+    try:
+        while len(pos.stack) < args.plies:
+            # The player's move.
+            fen, moves = _history(pos)
+            start = time.perf_counter()
+            result = player.go(fen, moves, depth=args.player_depth)
+            if result["bestmove"] is None:
+                break
+            time.sleep(max(0.0, args.think / 1000 - (time.perf_counter() - start)))
+            pos.push(pos.parse_uci(result["bestmove"]))
+
+            # The engine's reply, taken from the speculation when it guessed.
+            start = time.perf_counter()
+            job = None if args.off else speculator.take("game", pos)
+            if job is None:
+                fen, moves = _history(pos)
+                job = scheduler.submit("game", fen, moves, INTERACTIVE, movetime=args.movetime)
+            reply = job.wait()
+            # A search cancelled before it started, as when the scheduler
+            # closes, has no reply and no time to report.
+            if job.cancelled or job.started is None:
+                break
+            latencies.append(time.perf_counter() - start)
+            searches.append(job.finished - job.started)
+            if reply is None or reply["bestmove"] is None:
+                break
+            pos.push(pos.parse_uci(reply["bestmove"]))
+            if not args.off:
+                speculator.start("game", pos, reply.get("ponder"))
+    finally:
+        speculator.cancel("game")
+        player.close()
+        scheduler.close()
+        pool.close()
+
+    if not latencies:
+        print("The game ended before the engine moved", file=sys.stderr)
+        return 1
+    stats = speculator.stats()
+    mean = 1000 * sum(latencies) / len(latencies)
+    print(f"{len(latencies)} engine replies, mean wait {mean:.0f} ms, "
+          f"mean search {1000 * sum(searches) / len(searches):.0f} ms")
+    if not args.off:
+        print(f"Speculation: {stats['hits']} hits, {stats['misses']} misses, {stats['late']} late, "
+              f"hit rate {stats['hit_rate']:.0%}, {stats['saved_ms'] / 1000:.1f} s of waiting saved, "
+              f"{stats['wasted_ms'] / 1000:.1f} s of engine time on unused searches")
+    return 0
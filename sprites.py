@@ -0,0 +1,119 @@
+import os
+from collections import OrderedDict
+from PIL import Image, ImageTk
+import metrics
+
+
+PIECE_NAMES = ("WK", "WQ", "WR", "WN", "WB", "WP",
+               "BK", "BQ", "BR", "BN", "BB", "BP")
+
+
+class UnknownSpriteError(KeyError):
+    pass
+
+
+class SpriteCache:
+    def __init__(self, asset_location: os.PathLike, max_entries: int = 96, disk_cache_dir: os.PathLike = None):
+        self.assets_path = asset_location
+        self.max_entries = max_entries
+        self.disk_cache_dir = disk_cache_dir
+
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+
+        self._files = None
+        self._sources = {}
+        self._images = OrderedDict()
+
+    def get(self, name: str, tile_size: int) -> ImageTk.PhotoImage:
+        key = (name.upper(), tile_size)
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = ImageTk.PhotoImage(self.__resized(*key))
+        self._images[key] = image
+        # Evicting only drops the cache's reference. Boards keep their own
+        # references to the images they display, so Tk never loses a sprite
+        # that is still on a canvas.
+        while len(self._images) > self.max_entries:
+            self._images.popitem(last=False)
+        return image
+
+    def images(self, tile_size: int) -> dict:
+        return {name: self.get(name, tile_size) for name in PIECE_NAMES}
+
+    def clear(self):
+        self._images.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._images),
+            "hits": self.hits,
+            "misses": self.misses,
+            "decoded": self.decoded
+        }
+
+    @metrics.timed("sprites.resize")
+    def __resized(self, name: str, tile_size: int) -> Image.Image:
+        disk_path = None
+        if self.disk_cache_dir is not None:
+            disk_path = os.path.join(
+                self.disk_cache_dir, f"{name.lower()}_{tile_size}.png")
+            if os.path.isfile(disk_path) and os.path.getmtime(disk_path) >= os.path.getmtime(self.__files()[name]):
+                with Image.open(disk_path) as img:
+                    img.load()
+                    return img.copy()
+
+        resized = self.__source(name).resize(
+            (tile_size, tile_size), Image.Resampling.LANCZOS)
+
+        if disk_path is not None:
+            os.makedirs(self.disk_cache_dir, exist_ok=True)
+            tmp_path = f"{disk_path}.{os.getpid()}.tmp"
+            resized.save(tmp_path, "PNG")
+            os.replace(tmp_path, disk_path)
+        return resized
+
+    def __source(self, name: str) -> Image.Image:
+        source = self._sources.get(name)
+        if source is None:
+            with Image.open(self.__files()[name]) as img:
+                img.load()
+                source = img.copy()
+            self._sources[name] = source
+            self.decoded += 1
+        return source
+
+    def __files(self) -> dict:
+        if self._files is None:
+            self._files = {}
+            for path, _, files in os.walk(self.assets_path):
+                for file in files:
+                    filename = file.split(".")[0].upper()
+                    if filename in PIECE_NAMES and file.lower().endswith(".png"):
+                        self._files[filename] = os.path.join(path, file)
+        if len(self._files) < len(PIECE_NAMES):
+            missing = ", ".join(sorted(set(PIECE_NAMES) - set(self._files)))
+            raise UnknownSpriteError(
+                f"No images for {missing} in {self.assets_path}")
+        return self._files
+
+
+_caches = {}
+
+
+def get_sprite_cache(asset_location: os.PathLike, disk_cache_dir: os.PathLike = None) -> SpriteCache:
+    key = os.path.abspath(asset_location)
+    cache = _caches.get(key)
+    if cache is None:
+        if disk_cache_dir is None:
+            disk_cache_dir = os.environ.get("PYCHESS_SPRITE_CACHE")
+        cache = _caches[key] = SpriteCache(
+            asset_location, disk_cache_dir=disk_cache_dir)
+        metrics.register_source("sprites", cache.stats)
+    return cache
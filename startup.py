@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+
+CORE_MODULES = ("pychess", "position", "engine", "pgn", "gamestore", "posindex")
+GUI_MODULES = ("tkinter", "PIL", "PIL.Image", "PIL.ImageTk")
+
+# Run in a fresh interpreter so nothing is already imported or cached.
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+elapsed = time.perf_counter() - start
+gui = [name for name in {gui!r} if name in sys.modules]
+print(json.dumps({{"import_ms": elapsed * 1000, "gui_modules": gui}}))
+"""
+
+
+def measure(modules=CORE_MODULES) -> dict:
+    probe = _PROBE.format(gui=GUI_MODULES)
+    process = subprocess.run(
+        [sys.executable, "-X", "frozen_modules=on", "-c", probe, *modules],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def add_arguments(parser):
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to start (default: 5)")
+    parser.add_argument("--budget", type=float, default=100.0,
+                        help="median import time allowed in milliseconds (default: 100)")
+    parser.add_argument("--modules", nargs="*", default=list(CORE_MODULES),
+                        help="modules to import (default: the headless core)")
+
+
+def run(args) -> int:
+    timings = []
+    gui = set()
+    for _ in range(args.runs):
+        result = measure(args.modules)
+        timings.append(result["import_ms"])
+        gui.update(result["gui_modules"])
+
+    median = statistics.median(timings)
+    print(f"Importing {', '.join(args.modules)}: median {median:.1f} ms, "
+          f"min {min(timings):.1f} ms, max {max(timings):.1f} ms over {args.runs} runs "
+          f"(budget {args.budget:g} ms)")
+
+    failed = False
+    if gui:
+        print(f"GUI modules were imported: {', '.join(sorted(gui))}", file=sys.stderr)
+        failed = True
+    if median > args.budget:
+        print(f"Over budget by {median - args.budget:.1f} ms", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
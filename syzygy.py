@@ -0,0 +1,830 @@
+import os
+import sys
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+import bitboard
+import metrics
+from bitboard import (WHITE, BLACK, ALL_PIECES, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, KING_ATTACKS,
+                      popcount, squares, file_of, rank_of)
+from position import Position, START_FEN, NO_PIECE, EN_PASSANT, InvalidFenError, move_to_uci
+
+
+# A port of Stockfish's src/syzygy/tbprobe.cpp. Function names and the order
+# of operations follow the C++ so the two can be read side by side.
+
+WDL_MAGIC = b"\x71\xe8\x23\x5d"
+DTZ_MAGIC = b"\xd7\x66\x0c\xa5"
+WDL_SUFFIX = ".rtbw"
+DTZ_SUFFIX = ".rtbz"
+TB_PIECES = 7
+MAX_DTZ = 1 << 18
+# Depth reported and cached for tablebase results: deeper than any search,
+# so an engine evaluation never replaces them.
+TB_DEPTH = 255
+
+WDL_LOSS, WDL_BLESSED_LOSS, WDL_DRAW, WDL_CURSED_WIN, WDL_WIN = -2, -1, 0, 1, 2
+WDL_NAMES = {WDL_LOSS: "loss", WDL_BLESSED_LOSS: "blessed loss", WDL_DRAW: "draw",
+             WDL_CURSED_WIN: "cursed win", WDL_WIN: "win"}
+
+# Probe states; a failed probe raises _ProbeFailed instead.
+_OK, _CHANGE_STM, _ZEROING_BEST_MOVE = 1, -1, 2
+
+# PairsData flags
+_STM, _MAPPED, _WIN_PLIES, _LOSS_PLIES, _WIDE, _SINGLE_VALUE = 1, 2, 4, 8, 16, 128
+
+_PIECE_ORDER = "KQRBNP"
+_PIECE_TYPES = ((KING, "K"), (QUEEN, "Q"), (ROOK, "R"), (BISHOP, "B"), (KNIGHT, "N"), (PAWN, "P"))
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+_MAP_PAWNS = [0] * 64
+_MAP_B1H1H7 = [0] * 64
+_MAP_A1D1D4 = [0] * 64
+_MAP_KK = [[0] * 64 for _ in range(10)]
+_BINOMIAL = [[0] * 64 for _ in range(6)]
+_LEAD_PAWN_IDX = [[0] * 64 for _ in range(6)]
+_LEAD_PAWNS_SIZE = [[0] * 4 for _ in range(6)]
+_initialized = False
+
+
+class TablebaseError(ValueError):
+    pass
+
+
+def _off_a1h8(sq: int) -> int:
+    return (sq >> 3) - (sq & 7)
+
+
+def _init_tables():
+    global _initialized
+    if _initialized:
+        return
+    bitboard.init()
+
+    code = 0
+    for s in range(64):
+        if _off_a1h8(s) < 0:
+            _MAP_B1H1H7[s] = code
+            code += 1
+
+    diagonal = []
+    code = 0
+    for s in range(28):
+        if _off_a1h8(s) < 0 and file_of(s) <= 3:
+            _MAP_A1D1D4[s] = code
+            code += 1
+        elif not _off_a1h8(s) and file_of(s) <= 3:
+            diagonal.append(s)
+    for s in diagonal:
+        _MAP_A1D1D4[s] = code
+        code += 1
+
+    both_on_diagonal = []
+    code = 0
+    for idx in range(10):
+        for s1 in range(28):
+            if _MAP_A1D1D4[s1] != idx or not (idx or s1 == 1):
+                continue
+            for s2 in range(64):
+                if (KING_ATTACKS[s1] | 1 << s1) & 1 << s2:
+                    continue
+                if not _off_a1h8(s1) and _off_a1h8(s2) > 0:
+                    continue
+                if not _off_a1h8(s1) and not _off_a1h8(s2):
+                    both_on_diagonal.append((idx, s2))
+                else:
+                    _MAP_KK[idx][s2] = code
+                    code += 1
+    for idx, s2 in both_on_diagonal:
+        _MAP_KK[idx][s2] = code
+        code += 1
+
+    _BINOMIAL[0][0] = 1
+    for n in range(1, 64):
+        for k in range(min(6, n + 1)):
+            _BINOMIAL[k][n] = ((_BINOMIAL[k - 1][n - 1] if k > 0 else 0)
+                               + (_BINOMIAL[k][n - 1] if k < n else 0))
+
+    available = 47
+    for lead_pawns in range(1, 6):
+        for f in range(4):
+            idx = 0
+            for r in range(1, 7):
+                sq = r * 8 + f
+                if lead_pawns == 1:
+                    _MAP_PAWNS[sq] = available
+                    _MAP_PAWNS[sq ^ 7] = available - 1
+                    available -= 2
+                _LEAD_PAWN_IDX[lead_pawns][sq] = idx
+                idx += _BINOMIAL[lead_pawns - 1][_MAP_PAWNS[sq]]
+            _LEAD_PAWNS_SIZE[lead_pawns][f] = idx
+    _initialized = True
+
+
+def material_signature(pos: Position, color: int = WHITE) -> str:
+    # "KRPvKR" with the given color's pieces first, the way tables are named.
+    return "v".join("".join(symbol * popcount(pos.pieces(c, piece_type)) for piece_type, symbol in _PIECE_TYPES)
+                    for c in (color, color ^ 1))
+
+
+def dtz_before_zeroing(wdl: int) -> int:
+    return {WDL_WIN: 1, WDL_CURSED_WIN: 101, WDL_BLESSED_LOSS: -101, WDL_LOSS: -1}.get(wdl, 0)
+
+
+def _sign(value: int) -> int:
+    return (value > 0) - (value < 0)
+
+
+class _PairsData:
+    __slots__ = ("flags", "max_sym_len", "min_sym_len", "blocks_num", "sizeof_block", "span",
+                 "lowest_sym", "btree", "block_length", "block_length_size", "sparse_index",
+                 "sparse_index_size", "data", "base64", "symlen", "pieces", "group_idx",
+                 "group_len", "map_idx")
+
+    def __init__(self):
+        self.flags = self.max_sym_len = self.min_sym_len = self.blocks_num = self.sizeof_block = 0
+        self.span = self.block_length_size = self.sparse_index_size = 0
+        self.lowest_sym = self.btree = self.block_length = self.sparse_index = self.data = 0
+        self.base64 = self.symlen = ()
+        self.pieces = [0] * TB_PIECES
+        self.group_idx = [0] * (TB_PIECES + 1)
+        self.group_len = [0] * (TB_PIECES + 1)
+        self.map_idx = [0] * 4
+
+
+class _Table:
+    def __init__(self, name: str, path: str, dtz: bool):
+        white, black = name.split("v")
+        self.name = name
+        self.path = path
+        self.dtz = dtz
+        # key is the signature with white as the first side of the file name,
+        # key2 the same material with the colors swapped.
+        self.key = name
+        self.key2 = f"{black}v{white}"
+        self.piece_count = len(white) + len(black)
+        self.has_pawns = "P" in name
+        self.has_unique_pieces = any(
+            side.count(symbol) == 1 for side in (white, black) for symbol in "QRBNP")
+        lead_white = not black.count("P") or (white.count("P") and black.count("P") >= white.count("P"))
+        pawns = (white.count("P"), black.count("P"))
+        self.pawn_count = pawns if lead_white else pawns[::-1]
+        self.sides = 1 if dtz or self.key == self.key2 else 2
+        self.items = [[None] * 4 for _ in range(2)]
+        self.map = 0
+        self.ready = False
+        self._mmap = None
+
+    def get(self, stm: int, f: int) -> _PairsData:
+        return self.items[stm % self.sides][f if self.has_pawns else 0]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.ready = False
+
+    def mapped(self) -> bool:
+        if self.ready:
+            return self._mmap is not None
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % 64 != 16:
+                raise TablebaseError(f"Corrupt tablebase file {self.path}")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.platform != "win32" and hasattr(data, "madvise"):
+            data.madvise(mmap.MADV_RANDOM)
+        if data[:4] != (DTZ_MAGIC if self.dtz else WDL_MAGIC):
+            data.close()
+            raise TablebaseError(f"Corrupted table in file {self.path}")
+        self._mmap = data
+        self.__set(4)
+        self.ready = True
+        return True
+
+    def __set(self, data: int):
+        buf = self._mmap
+        data += 1  # the first byte stores flags
+        max_file = 3 if self.has_pawns else 0
+        pp = self.has_pawns and self.pawn_count[1] > 0
+
+        for f in range(max_file + 1):
+            for i in range(self.sides):
+                self.items[i][f] = _PairsData()
+            order = ((buf[data] & 0xF, buf[data + 1] & 0xF if pp else 0xF),
+                     (buf[data] >> 4, buf[data + 1] >> 4 if pp else 0xF))
+            data += 1 + pp
+            for k in range(self.piece_count):
+                for i in range(self.sides):
+                    self.items[i][f].pieces[k] = buf[data] >> 4 if i else buf[data] & 0xF
+                data += 1
+            for i in range(self.sides):
+                self.__set_groups(self.items[i][f], order[i], f)
+
+        data += data & 1
+
+        for f in range(max_file + 1):
+            for i in range(self.sides):
+                data = self.__set_sizes(self.items[i][f], data)
+
+        if self.dtz:
+            data = self.__set_dtz_map(data, max_file)
+
+        for f in range(max_file + 1):
+            for i in range(self.sides):
+                d = self.items[i][f]
+                d.sparse_index = data
+                data += d.sparse_index_size * 6
+        for f in range(max_file + 1):
+            for i in range(self.sides):
+                d = self.items[i][f]
+                d.block_length = data
+                data += d.block_length_size * 2
+        for f in range(max_file + 1):
+            for i in range(self.sides):
+                # Offsets from the page-aligned map start align like addresses.
+                data = (data + 0x3F) & ~0x3F
+                d = self.items[i][f]
+                d.data = data
+                data += d.blocks_num * d.sizeof_block
+
+    def __set_groups(self, d: _PairsData, order: tuple, f: int):
+        n = 0
+        first_len = 0 if self.has_pawns else 3 if self.has_unique_pieces else 2
+        d.group_len[n] = 1
+        for i in range(1, self.piece_count):
+            first_len -= 1
+            if first_len > 0 or d.pieces[i] == d.pieces[i - 1]:
+                d.group_len[n] += 1
+            else:
+                n += 1
+                d.group_len[n] = 1
+        n += 1
+        d.group_len[n] = 0
+
+        pp = self.has_pawns and self.pawn_count[1] > 0
+        next_group = 2 if pp else 1
+        free_squares = 64 - d.group_len[0] - (d.group_len[1] if pp else 0)
+        idx = 1
+        k = 0
+        while next_group < n or k == order[0] or k == order[1]:
+            if k == order[0]:
+                d.group_idx[0] = idx
+                idx *= (_LEAD_PAWNS_SIZE[d.group_len[0]][f] if self.has_pawns
+                        else 31332 if self.has_unique_pieces else 462)
+            elif k == order[1]:
+                d.group_idx[1] = idx
+                idx *= _BINOMIAL[d.group_len[1]][48 - d.group_len[0]]
+            else:
+                d.group_idx[next_group] = idx
+                idx *= _BINOMIAL[d.group_len[next_group]][free_squares]
+                free_squares -= d.group_len[next_group]
+                next_group += 1
+            k += 1
+        d.group_idx[n] = idx
+
+    def __set_sizes(self, d: _PairsData, data: int) -> int:
+        buf = self._mmap
+        d.flags = buf[data]
+        data += 1
+        if d.flags & _SINGLE_VALUE:
+            d.blocks_num = d.block_length_size = 0
+            d.span = d.sparse_index_size = 0
+            d.min_sym_len = buf[data]  # the single value
+            return data + 1
+
+        tb_size = d.group_idx[d.group_len.index(0)]
+        d.sizeof_block = 1 << buf[data]
+        d.span = 1 << buf[data + 1]
+        d.sparse_index_size = (tb_size + d.span - 1) // d.span
+        padding = buf[data + 2]
+        d.blocks_num = struct.unpack_from("<I", buf, data + 3)[0]
+        d.block_length_size = d.blocks_num + padding
+        d.max_sym_len = buf[data + 7]
+        d.min_sym_len = buf[data + 8]
+        data += 9
+        d.lowest_sym = data
+
+        size = d.max_sym_len - d.min_sym_len + 1
+        lowest = struct.unpack_from(f"<{size}H", buf, data)
+        base64 = [0] * size
+        for i in range(size - 2, -1, -1):
+            base64[i] = (base64[i + 1] + lowest[i] - lowest[i + 1]) // 2
+        d.base64 = [(base64[i] << (64 - i - d.min_sym_len)) & _MASK64 for i in range(size)]
+        data += size * 2
+
+        count = struct.unpack_from("<H", buf, data)[0]
+        data += 2
+        d.btree = data
+        d.symlen = self.__symlen(d.btree, count)
+        return data + count * 3 + (count & 1)
+
+    def __symlen(self, btree: int, count: int) -> list:
+        # set_symlen() without recursion: symbols deep in the pairing tree
+        # would overflow Python's stack.
+        buf = self._mmap
+        symlen = [0] * count
+        visited = [False] * count
+        for root in range(count):
+            if visited[root]:
+                continue
+            stack = [root]
+            while stack:
+                s = stack[-1]
+                visited[s] = True
+                b0, b1, b2 = buf[btree + 3 * s], buf[btree + 3 * s + 1], buf[btree + 3 * s + 2]
+                right = b2 << 4 | b1 >> 4
+                if right == 0xFFF:
+                    stack.pop()
+                    continue
+                left = (b1 & 0xF) << 8 | b0
+                pending = [child for child in (left, right) if not visited[child]]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                symlen[s] = (symlen[left] + symlen[right] + 1) & 0xFF
+                stack.pop()
+        return symlen
+
+    def __set_dtz_map(self, data: int, max_file: int) -> int:
+        buf = self._mmap
+        self.map = data
+        for f in range(max_file + 1):
+            d = self.get(0, f)
+            if not d.flags & _MAPPED:
+                continue
+            if d.flags & _WIDE:
+                data += data & 1
+                for i in range(4):
+                    d.map_idx[i] = (data - self.map) // 2 + 1
+                    data += 2 * struct.unpack_from("<H", buf, data)[0] + 2
+            else:
+                for i in range(4):
+                    d.map_idx[i] = data - self.map + 1
+                    data += buf[data] + 1
+        return data + (data & 1)
+
+    def decompress_pairs(self, d: _PairsData, idx: int) -> int:
+        if d.flags & _SINGLE_VALUE:
+            return d.min_sym_len
+
+        buf = self._mmap
+        k = idx // d.span
+        block, offset = struct.unpack_from("<IH", buf, d.sparse_index + 6 * k)
+        offset += idx % d.span - d.span // 2
+
+        def block_length(n):
+            return struct.unpack_from("<H", buf, d.block_length + 2 * n)[0]
+
+        while offset < 0:
+            block -= 1
+            offset += block_length(block) + 1
+        while offset > block_length(block):
+            offset -= block_length(block) + 1
+            block += 1
+
+        ptr = d.data + block * d.sizeof_block
+        buf64 = struct.unpack_from(">Q", buf, ptr)[0]
+        ptr += 8
+        buf64_size = 64
+        base64, symlen, min_sym_len = d.base64, d.symlen, d.min_sym_len
+        while True:
+            length = 0
+            while buf64 < base64[length]:
+                length += 1
+            sym = (buf64 - base64[length]) >> (64 - length - min_sym_len)
+            sym = (sym + struct.unpack_from("<H", buf, d.lowest_sym + 2 * length)[0]) & 0xFFFF
+            if offset < symlen[sym] + 1:
+                break
+            offset -= symlen[sym] + 1
+            length += min_sym_len
+            buf64 = (buf64 << length) & _MASK64
+            buf64_size -= length
+            if buf64_size <= 32:
+                buf64_size += 32
+                buf64 |= struct.unpack_from(">I", buf, ptr)[0] << (64 - buf64_size)
+                ptr += 4
+
+        btree = d.btree
+        while symlen[sym]:
+            b0, b1 = buf[btree + 3 * sym], buf[btree + 3 * sym + 1]
+            left = (b1 & 0xF) << 8 | b0
+            if offset < symlen[left] + 1:
+                sym = left
+            else:
+                offset -= symlen[left] + 1
+                sym = buf[btree + 3 * sym + 2] << 4 | b1 >> 4
+        return (buf[btree + 3 * sym + 1] & 0xF) << 8 | buf[btree + 3 * sym]
+
+    def map_score(self, f: int, value: int, wdl: int) -> int:
+        if not self.dtz:
+            return value - 2
+        d = self.get(0, f)
+        flags = d.flags
+        if flags & _MAPPED:
+            index = d.map_idx[(1, 3, 0, 2, 0)[wdl + 2]] + value
+            if flags & _WIDE:
+                value = struct.unpack_from("<H", self._mmap, self.map + 2 * index)[0]
+            else:
+                value = self._mmap[self.map + index]
+        if ((wdl == WDL_WIN and not flags & _WIN_PLIES) or (wdl == WDL_LOSS and not flags & _LOSS_PLIES)
+                or wdl in (WDL_CURSED_WIN, WDL_BLESSED_LOSS)):
+            value *= 2
+        return value + 1
+
+    def probe(self, pos: Position, signature: str, wdl: int = WDL_DRAW) -> tuple:
+        # do_probe_table(): returns (value, state).
+        flip = (self.key == self.key2 and pos.side_to_move == BLACK) or signature != self.key
+        flip_color = 8 if flip else 0
+        flip_squares = 56 if flip else 0
+        stm = flip ^ pos.side_to_move
+
+        sqs = []
+        pieces = []
+        lead_pawns = 0
+        lead_pawns_count = 0
+        tb_file = 0
+        if self.has_pawns:
+            pc = self.get(0, 0).pieces[0] ^ flip_color
+            lead_pawns = pos.pieces(pc >> 3, PAWN)
+            sqs = [sq ^ flip_squares for sq in squares(lead_pawns)]
+            lead_pawns_count = len(sqs)
+            pieces = [NO_PIECE] * lead_pawns_count
+            best = max(range(lead_pawns_count), key=lambda i: (_MAP_PAWNS[sqs[i]], -i))
+            sqs[0], sqs[best] = sqs[best], sqs[0]
+            tb_file = min(file_of(sqs[0]), 7 - file_of(sqs[0]))
+
+        if self.dtz:
+            flags = self.get(stm, tb_file).flags
+            if (flags & _STM) != stm and not (self.key == self.key2 and not self.has_pawns):
+                return 0, _CHANGE_STM
+
+        board = pos.board
+        for s in squares(pos.by_type[ALL_PIECES] ^ lead_pawns):
+            sqs.append(s ^ flip_squares)
+            pieces.append(board[s] ^ flip_color)
+
+        d = self.get(stm, tb_file)
+        size = len(sqs)
+        for i in range(lead_pawns_count, size - 1):
+            for j in range(i + 1, size):
+                if d.pieces[i] == pieces[j]:
+                    pieces[i], pieces[j] = pieces[j], pieces[i]
+                    sqs[i], sqs[j] = sqs[j], sqs[i]
+                    break
+
+        if file_of(sqs[0]) > 3:
+            sqs = [s ^ 7 for s in sqs]
+
+        if self.has_pawns:
+            idx = _LEAD_PAWN_IDX[lead_pawns_count][sqs[0]]
+            sqs[1:lead_pawns_count] = sorted(sqs[1:lead_pawns_count], key=_MAP_PAWNS.__getitem__)
+            for i in range(1, lead_pawns_count):
+                idx += _BINOMIAL[i][_MAP_PAWNS[sqs[i]]]
+        else:
+            if rank_of(sqs[0]) > 3:
+                sqs = [s ^ 56 for s in sqs]
+            for i in range(d.group_len[0]):
+                off = _off_a1h8(sqs[i])
+                if not off:
+                    continue
+                if off > 0:
+                    for j in range(i, size):
+                        sqs[j] = ((sqs[j] >> 3) | (sqs[j] << 3)) & 63
+                break
+
+            if self.has_unique_pieces:
+                adjust1 = sqs[1] > sqs[0]
+                adjust2 = (sqs[2] > sqs[0]) + (sqs[2] > sqs[1])
+                if _off_a1h8(sqs[0]):
+                    idx = (_MAP_A1D1D4[sqs[0]] * 63 + (sqs[1] - adjust1)) * 62 + sqs[2] - adjust2
+                elif _off_a1h8(sqs[1]):
+                    idx = (6 * 63 + rank_of(sqs[0]) * 28 + _MAP_B1H1H7[sqs[1]]) * 62 + sqs[2] - adjust2
+                elif _off_a1h8(sqs[2]):
+                    idx = (6 * 63 * 62 + 4 * 28 * 62 + rank_of(sqs[0]) * 7 * 28
+                           + (rank_of(sqs[1]) - adjust1) * 28 + _MAP_B1H1H7[sqs[2]])
+                else:
+                    idx = (6 * 63 * 62 + 4 * 28 * 62 + 4 * 7 * 28 + rank_of(sqs[0]) * 7 * 6
+                           + (rank_of(sqs[1]) - adjust1) * 6 + (rank_of(sqs[2]) - adjust2))
+            else:
+                idx = _MAP_KK[_MAP_A1D1D4[sqs[0]]][sqs[1]]
+
+        # encode_remaining
+        idx *= d.group_idx[0]
+        group_sq = d.group_len[0]
+        remaining_pawns = self.has_pawns and self.pawn_count[1] > 0
+        next_group = 0
+        while d.group_len[next_group + 1]:
+            next_group += 1
+            length = d.group_len[next_group]
+            sqs[group_sq:group_sq + length] = sorted(sqs[group_sq:group_sq + length])
+            n = 0
+            for i in range(length):
+                sq = sqs[group_sq + i]
+                adjust = sum(1 for s in sqs[:group_sq] if sq > s)
+                n += _BINOMIAL[i + 1][sq - adjust - 8 * remaining_pawns]
+            remaining_pawns = False
+            idx += n * d.group_idx[next_group]
+            group_sq += length
+
+        return self.map_score(tb_file, self.decompress_pairs(d, idx), wdl), _OK
+
+
+class Tablebase:
+    """Syzygy WDL/DTZ tablebases found in one or more directories.
+
+    Files are mapped on first use. Results are from the side to move's point
+    of view and cached by position key, so repeated probes during analysis
+    or a match cost a dictionary lookup.
+    """
+
+    def __init__(self, paths, cache_size: int = 1 << 16):
+        _init_tables()
+        if isinstance(paths, (str, os.PathLike)):
+            paths = str(paths).split(os.pathsep)
+        self.paths = [path for path in paths if path]
+        self.cache_size = cache_size
+        self.max_pieces = 0
+        self._wdl = {}
+        self._dtz = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        for directory in self.paths:
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                name, suffix = os.path.splitext(filename)
+                if suffix not in (WDL_SUFFIX, DTZ_SUFFIX) or name.count("v") != 1:
+                    continue
+                if any(symbol not in _PIECE_ORDER + "v" for symbol in name) or len(name) - 1 > TB_PIECES:
+                    continue
+                tables = self._wdl if suffix == WDL_SUFFIX else self._dtz
+                if name in tables:
+                    continue
+                table = _Table(name, os.path.join(directory, filename), suffix == DTZ_SUFFIX)
+                tables[table.key] = tables[table.key2] = table
+                if suffix == WDL_SUFFIX:
+                    self.max_pieces = max(self.max_pieces, table.piece_count)
+
+    def __len__(self) -> int:
+        return len(set(self._wdl.values()))
+
+    def close(self):
+        for table in (*self._wdl.values(), *self._dtz.values()):
+            table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def covers(self, pos: Position) -> bool:
+        # Tables hold no positions with castling rights.
+        return (not pos.castling_rights and popcount(pos.by_type[ALL_PIECES]) <= self.max_pieces
+                and material_signature(pos) in self._wdl)
+
+    def probe_wdl(self, pos: Position):
+        """-2 loss, -1 blessed loss, 0 draw, 1 cursed win, 2 win, or None."""
+        if popcount(pos.by_type[ALL_PIECES]) > 2 and not self.covers(pos):
+            return None
+        return self.__cached("wdl", pos)
+
+    def probe_dtz(self, pos: Position):
+        """Plies to the next zeroing move with the sign of the result, or None."""
+        if popcount(pos.by_type[ALL_PIECES]) > 2 and not self.covers(pos):
+            return None
+        return self.__cached("dtz", pos)
+
+    def root_moves(self, pos: Position) -> list:
+        """(move, wdl, dtz, rank) for every legal move, best first.
+
+        Ranked like Stockfish's root_probe(): certain wins first and the
+        shortest of them first, then cursed wins, draws and losses, respecting
+        the fifty move counter of the position. Without DTZ tables the moves
+        are ranked by WDL alone and dtz is None, as in root_probe_wdl().
+        """
+        if not self.covers(pos):
+            return None
+        pos = pos.copy()
+        counter = pos.halfmove_clock
+        probes = []
+        for move in pos.legal_moves():
+            pos.push(move)
+            wdl = self.probe_wdl(pos)
+            zeroing = pos.halfmove_clock == 0
+            dtz = None if zeroing else self.probe_dtz(pos)
+            mated = pos.in_check() and not pos.legal_moves()
+            pos.pop()
+            if wdl is None:
+                return None
+            probes.append((move, -wdl, zeroing, dtz, mated))
+
+        ranked = []
+        with_dtz = all(zeroing or dtz is not None for _, _, zeroing, dtz, _ in probes)
+        for move, wdl, zeroing, dtz, mated in probes:
+            if not with_dtz:
+                rank = (-MAX_DTZ, -MAX_DTZ + 101, 0, MAX_DTZ - 101, MAX_DTZ)[wdl + 2]
+                ranked.append((move, wdl, None, rank))
+                continue
+            if zeroing:
+                dtz = dtz_before_zeroing(wdl)
+            else:
+                dtz = -dtz
+                dtz += _sign(dtz)
+            if dtz == 2 and mated:
+                dtz = 1
+
+            if dtz > 0:
+                rank = MAX_DTZ - dtz if dtz + counter <= 99 else MAX_DTZ // 2 - (dtz + counter)
+            elif dtz < 0:
+                rank = -MAX_DTZ - dtz if -dtz * 2 + counter < 100 else -MAX_DTZ // 2 + (-dtz + counter)
+            else:
+                rank = 0
+            ranked.append((move, wdl, dtz, rank))
+        ranked.sort(key=lambda entry: -entry[3])
+        return ranked
+
+    def best_move(self, pos: Position):
+        ranked = self.root_moves(pos)
+        return ranked[0][0] if ranked else None
+
+    def score(self, pos: Position):
+        """An engine-style score dict for the side to move, or None.
+
+        Wins score like Stockfish's tablebase wins, 20000 centipawns less the
+        plies to zeroing; cursed wins and blessed losses count as draws.
+        """
+        wdl = self.probe_wdl(pos)
+        if wdl is None:
+            return None
+        if wdl in (WDL_WIN, WDL_LOSS):
+            dtz = self.probe_dtz(pos) or 0
+            value = _sign(wdl) * (20000 - min(abs(dtz), 1000))
+        else:
+            value = 0
+        return {"type": "cp", "value": value, "wdl": wdl}
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "tables": len(self),
+            "max_pieces": self.max_pieces,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+    def __cached(self, kind: str, pos: Position):
+        key = (kind, pos.key)
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            work = pos.copy()
+            try:
+                value = self.__probe_wdl(work) if kind == "wdl" else self.__probe_dtz(work)
+            except _ProbeFailed:
+                return None
+            self._cache[key] = value
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return value
+
+    def __probe_table(self, pos: Position, dtz: bool, wdl: int = WDL_DRAW) -> tuple:
+        if popcount(pos.by_type[ALL_PIECES]) == 2:
+            return WDL_DRAW, _OK
+        signature = material_signature(pos)
+        table = (self._dtz if dtz else self._wdl).get(signature)
+        if table is None or not table.mapped():
+            raise _ProbeFailed
+        return table.probe(pos, signature, wdl)
+
+    def __search(self, pos: Position, check_zeroing: bool) -> tuple:
+        best = WDL_LOSS
+        moves = pos.legal_moves()
+        count = 0
+        board = pos.board
+        for move in moves:
+            capture = board[move & 63] != NO_PIECE or (move & 0xC000) == EN_PASSANT
+            if not capture and (not check_zeroing or board[(move >> 6) & 63] & 7 != PAWN):
+                continue
+            count += 1
+            pos.push(move)
+            value = -self.__search(pos, False)[0]
+            pos.pop()
+            if value > best:
+                best = value
+                if value >= WDL_WIN:
+                    return value, _ZEROING_BEST_MOVE
+
+        no_more_moves = count and count == len(moves)
+        if no_more_moves:
+            value = best
+        else:
+            value = self.__probe_table(pos, False)[0]
+
+        if best >= value:
+            return best, _ZEROING_BEST_MOVE if best > WDL_DRAW or no_more_moves else _OK
+        return value, _OK
+
+    def __probe_wdl(self, pos: Position) -> int:
+        return self.__search(pos, False)[0]
+
+    def __probe_dtz(self, pos: Position) -> int:
+        wdl, state = self.__search(pos, True)
+        if wdl == WDL_DRAW:
+            return 0
+        if state == _ZEROING_BEST_MOVE:
+            return dtz_before_zeroing(wdl)
+
+        dtz, state = self.__probe_table(pos, True, wdl)
+        if state != _CHANGE_STM:
+            return (dtz + 100 * (wdl in (WDL_BLESSED_LOSS, WDL_CURSED_WIN))) * _sign(wdl)
+
+        # DTZ stores results for the other side, so take the best reply.
+        board = pos.board
+        min_dtz = 0xFFFF
+        for move in pos.legal_moves():
+            zeroing = (board[move & 63] != NO_PIECE or (move & 0xC000) == EN_PASSANT
+                       or board[(move >> 6) & 63] & 7 == PAWN)
+            pos.push(move)
+            if zeroing:
+                dtz = -dtz_before_zeroing(self.__search(pos, False)[0])
+            else:
+                dtz = -self.__probe_dtz(pos)
+            if dtz == 1 and pos.in_check() and not pos.legal_moves():
+                min_dtz = 1
+            if not zeroing:
+                dtz += _sign(dtz)
+            if dtz < min_dtz and _sign(dtz) == _sign(wdl):
+                min_dtz = dtz
+            pos.pop()
+        return -1 if min_dtz == 0xFFFF else min_dtz
+
+
+class _ProbeFailed(Exception):
+    pass
+
+
+_tablebase = None
+
+
+def get_tablebase():
+    # Shared tablebase for PYCHESS_SYZYGY, or None when it is not set.
+    global _tablebase
+    paths = os.environ.get("PYCHESS_SYZYGY")
+    if not paths:
+        return None
+    if _tablebase is None:
+        _tablebase = Tablebase(paths)
+        metrics.register_source("syzygy", _tablebase.stats)
+    return _tablebase
+
+
+def add_arguments(parser):
+    parser.add_argument("path", help=f"tablebase directories separated by {os.pathsep!r}")
+    parser.add_argument("--fen", default=START_FEN, help="position to probe (default: start)")
+    parser.add_argument("--moves", action="store_true", help="rank every legal move")
+
+
+def run(args) -> int:
+    try:
+        pos = Position(args.fen)
+    except InvalidFenError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+
+    with Tablebase(args.path) as tablebase:
+        if not tablebase.max_pieces:
+            print(f"No Syzygy tables in {args.path}", file=sys.stderr)
+            return 1
+        try:
+            wdl = tablebase.probe_wdl(pos)
+            dtz = tablebase.probe_dtz(pos)
+            ranked = tablebase.root_moves(pos) if args.moves else None
+        except TablebaseError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+
+    if wdl is None:
+        print(f"Not in the tablebases ({material_signature(pos)}, up to {tablebase.max_pieces} pieces)",
+              file=sys.stderr)
+        return 1
+    print(f"WDL {wdl:+d} ({WDL_NAMES[wdl]})")
+    if dtz is not None:
+        print(f"DTZ {dtz:+d}")
+    for move, move_wdl, move_dtz, _ in ranked or ():
+        dtz_text = f"DTZ {move_dtz:+d}" if move_dtz is not None else ""
+        print(f"{pos.san(move):8} {move_to_uci(move):6} {WDL_NAMES[move_wdl]:13} {dtz_text}".rstrip())
+    return 0
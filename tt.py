@@ -0,0 +1,154 @@
+import threading
+import metrics
+
+
+# Rough size of one occupied slot: the entry list, a tuple of move ints and
+# a small evaluation dict. Used to turn a megabyte budget into a slot count.
+ENTRY_BYTES = 320
+CLUSTER_SIZE = 2
+
+KEY, DEPTH, GENERATION, MOVES, EVALUATION, PV = range(6)
+
+REPLACEMENT_POLICIES = ("depth", "always")
+
+
+class TranspositionTable:
+    def __init__(self, size_mb: int = 16, replacement: str = "depth"):
+        if replacement not in REPLACEMENT_POLICIES:
+            raise ValueError(
+                f"Unknown replacement policy {replacement!r}, use one of {', '.join(REPLACEMENT_POLICIES)}")
+        self.replacement = replacement
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+        self._lock = threading.Lock()
+        self.resize(size_mb)
+
+    def resize(self, size_mb: int):
+        clusters = max(1, size_mb * 1024 * 1024 // (ENTRY_BYTES * CLUSTER_SIZE))
+        # Round down to a power of two so the index is a mask of the key,
+        # the way Stockfish's TranspositionTable::first_entry works.
+        clusters = 1 << (clusters.bit_length() - 1)
+        with self._lock:
+            self.size_mb = size_mb
+            self._mask = clusters - 1
+            self._table = [None] * (clusters * CLUSTER_SIZE)
+            self._generation = 0
+
+    def clear(self):
+        with self._lock:
+            self._table = [None] * len(self._table)
+            self._generation = 0
+
+    def new_search(self):
+        # Entries stored before this call age by one generation, so the
+        # deep results of a finished search give way to the current one.
+        with self._lock:
+            self._generation = (self._generation + 1) & 0xFF
+
+    def probe_moves(self, key: int):
+        with self._lock:
+            entry = self.__find(key)
+            if entry is None or entry[MOVES] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[MOVES]
+
+    def store_moves(self, key: int, moves):
+        with self._lock:
+            self.__slot(key, 0)[MOVES] = tuple(moves)
+
+    def probe_evaluation(self, key: int, min_depth: int = 0):
+        with self._lock:
+            entry = self.__find(key)
+            if entry is None or entry[EVALUATION] is None or entry[DEPTH] < min_depth:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[EVALUATION], entry[DEPTH], entry[PV]
+
+    def store_evaluation(self, key: int, evaluation: dict, depth: int, pv=()):
+        with self._lock:
+            entry = self.__slot(key, depth)
+            # A shallower result never overwrites a deeper one for the same
+            # position, but it still refreshes the entry's age.
+            if entry[EVALUATION] is None or depth >= entry[DEPTH]:
+                entry[EVALUATION] = evaluation
+                entry[DEPTH] = depth
+                entry[PV] = tuple(pv)
+
+    def hashfull(self) -> int:
+        with self._lock:
+            sample = self._table[:1000]
+            used = sum(1 for entry in sample
+                       if entry is not None and entry[GENERATION] == self._generation)
+        return used * 1000 // max(1, len(sample))
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses, stores, replacements = self.hits, self.misses, self.stores, self.replacements
+        probes = hits + misses
+        return {
+            "size_mb": self.size_mb,
+            "slots": len(self._table),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / probes if probes else 0.0,
+            "stores": stores,
+            "replacements": replacements,
+            "hashfull": self.hashfull()
+        }
+
+    def __find(self, key: int):
+        table = self._table
+        first = (key & self._mask) * CLUSTER_SIZE
+        for i in range(first, first + CLUSTER_SIZE):
+            entry = table[i]
+            if entry is not None and entry[KEY] == key:
+                return entry
+        return None
+
+    def __slot(self, key: int, depth: int):
+        table = self._table
+        first = (key & self._mask) * CLUSTER_SIZE
+        victim = None
+        victim_worth = None
+        for i in range(first, first + CLUSTER_SIZE):
+            entry = table[i]
+            if entry is None:
+                victim = i
+                break
+            if entry[KEY] == key:
+                entry[GENERATION] = self._generation
+                self.stores += 1
+                return entry
+            # Like Stockfish, prefer to evict shallow entries from old
+            # searches: every generation of age costs eight plies of depth.
+            # The "always" policy ignores depth and evicts the oldest entry.
+            age = (self._generation - entry[GENERATION]) & 0xFF
+            worth = entry[DEPTH] - 8 * age if self.replacement == "depth" else -age
+            if victim_worth is None or worth < victim_worth:
+                victim, victim_worth = i, worth
+
+        if table[victim] is not None:
+            self.replacements += 1
+
+        entry = [key, depth, self._generation, None, None, ()]
+        table[victim] = entry
+        self.stores += 1
+        return entry
+
+
+_default_table = None
+
+
+def get_transposition_table(size_mb: int = None, replacement: str = None) -> TranspositionTable:
+    global _default_table
+    if _default_table is None:
+        _default_table = TranspositionTable(size_mb or 16, replacement or "depth")
+        metrics.register_source("tt", _default_table.stats)
+    return _default_table
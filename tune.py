@@ -0,0 +1,227 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+profile_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "engine_profile.json")
+
+DEFAULT_HASH_MB = (16, 64, 256)
+# Stockfish's own bench defaults: depth 13 over its built-in positions. The
+# built-in engine cannot reach depth 13 in Python, so it gets a time limit.
+STOCKFISH_BENCH = ("13", "default", "depth")
+BUILTIN_BENCH = ("500", "default", "movetime")
+
+_TOTAL_TIME = re.compile(r"Total time \(ms\)\s*:\s*(\d+)")
+_NODES = re.compile(r"Nodes searched\s*:\s*(\d+)")
+_POSITION = re.compile(r"^Position: \d+/\d+", re.MULTILINE)
+
+
+class BenchError(ValueError):
+    pass
+
+
+def _engine_key(path: os.PathLike) -> str:
+    from engine import BUILTIN_ENGINE
+
+    return path if path == BUILTIN_ENGINE else os.path.realpath(path)
+
+
+def load_profiles(path: os.PathLike = profile_path) -> dict:
+    # {host: {engine: profile}}; a missing or damaged file is no profiles.
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profiles if isinstance(profiles, dict) else {}
+
+
+def save_profile(engine_path: os.PathLike, profile: dict, path: os.PathLike = profile_path):
+    profiles = load_profiles(path)
+    profiles.setdefault(socket.gethostname(), {})[_engine_key(engine_path)] = profile
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+_profiles = None
+_profiles_lock = threading.Lock()
+
+
+def get_profile(engine_path: os.PathLike) -> dict:
+    # The tuned settings for engine_path on this host, or None. Profiles are
+    # read from PYCHESS_PROFILE, or next to the program by default; setting
+    # the variable to an empty string ignores them.
+    global _profiles
+    with _profiles_lock:
+        if _profiles is None:
+            path = os.environ.get("PYCHESS_PROFILE", profile_path)
+            _profiles = load_profiles(path) if path else {}
+        return _profiles.get(socket.gethostname(), {}).get(_engine_key(engine_path))
+
+
+def reload_profiles():
+    global _profiles
+    with _profiles_lock:
+        _profiles = None
+
+
+def run_bench(engine_path: os.PathLike, threads: int, hash_mb: int, bench_args=None) -> dict:
+    """Run the engine's bench command once and return what it reports."""
+    from engine import BUILTIN_ENGINE, engine_command
+
+    builtin = engine_path == BUILTIN_ENGINE
+    bench_args = bench_args or (BUILTIN_BENCH if builtin else STOCKFISH_BENCH)
+    command = engine_command(engine_path)
+    command = list(command) if isinstance(command, list) else [command]
+    # Both engines take bench with the same arguments from the UCI loop;
+    # Stockfish writes the results to stderr, so both streams are read.
+    script = f"bench {hash_mb} {threads} {' '.join(bench_args)}\nquit\n"
+    try:
+        done = subprocess.run(command, input=script, capture_output=True, text=True, timeout=3600)
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        raise BenchError(f"Cannot run bench with {engine_path}: {exc}") from None
+    output = done.stdout + done.stderr
+    total_time = _TOTAL_TIME.search(output)
+    nodes = _NODES.search(output)
+    if total_time is None or nodes is None:
+        raise BenchError(f"{engine_path} printed no bench results")
+    elapsed = max(1, int(total_time.group(1)))
+    return {
+        "time_ms": elapsed,
+        "nodes": int(nodes.group(1)),
+        "positions": len(_POSITION.findall(output))
+    }
+
+
+def measure(engine_path: os.PathLike, threads: int, hash_mb: int, workers: int, bench_args=None) -> dict:
+    # workers benches at once, as many engines as a pool of that size runs.
+    # Throughput counts the slowest of them, since that is when a batch of
+    # work spread over the pool would finish.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        runs = list(executor.map(lambda _: run_bench(engine_path, threads, hash_mb, bench_args),
+                                 range(workers)))
+    slowest = max(run["time_ms"] for run in runs) / 1000
+    nodes = sum(run["nodes"] for run in runs)
+    positions = sum(run["positions"] for run in runs)
+    return {
+        "parameters": {"Threads": threads, "Hash": hash_mb},
+        "workers": workers,
+        "nps": round(nodes / slowest),
+        "positions_per_second": round(positions / slowest, 2)
+    }
+
+
+def default_grid(cpus: int) -> tuple:
+    powers = []
+    value = 1
+    while value <= cpus:
+        powers.append(value)
+        value *= 2
+    if powers[-1] != cpus:
+        powers.append(cpus)
+    return powers, list(DEFAULT_HASH_MB), powers
+
+
+def configurations(threads: list, hashes: list, workers: list, cpus: int, oversubscribe: bool = False):
+    # More search threads than cores only makes every search slower.
+    for thread_count in threads:
+        for worker_count in workers:
+            if not oversubscribe and thread_count * worker_count > cpus:
+                continue
+            for hash_mb in hashes:
+                yield thread_count, hash_mb, worker_count
+
+
+def _int_list(text: str) -> list:
+    try:
+        return sorted({int(value) for value in text.split(",") if value.strip()})
+    except ValueError:
+        raise ValueError(f"Expected comma separated numbers, got {text!r}") from None
+
+
+def add_arguments(parser):
+    parser.add_argument("--engine", help="path to the UCI engine binary (default: auto-detected)")
+    parser.add_argument("--threads", help="Threads values to try, comma separated (default: powers of two up to the CPU count)")
+    parser.add_argument("--hash", help="Hash values in MB to try, comma separated (default: 16,64,256)")
+    parser.add_argument("--workers", help="engine process counts to try, comma separated (default: powers of two up to the CPU count)")
+    parser.add_argument("--bench", nargs=3, metavar=("LIMIT", "FENFILE", "LIMITTYPE"),
+                        help="bench arguments after hash and threads (default: 13 default depth, "
+                             "500 default movetime for the built-in engine)")
+    parser.add_argument("--oversubscribe", action="store_true",
+                        help="also try more threads in total than there are CPUs")
+    parser.add_argument("--rank-by", choices=("positions", "nps"), default="positions",
+                        help="what the best configuration has the most of (default: positions per second, "
+                             "nodes per second for time limited benches)")
+    parser.add_argument("--dry-run", action="store_true", help="measure and report without saving a profile")
+    parser.add_argument("--profile", default=os.environ.get("PYCHESS_PROFILE", profile_path),
+                        help="profile file to update (default: $PYCHESS_PROFILE or engine_profile.json)")
+
+
+def run(args) -> int:
+    from engine import BUILTIN_ENGINE, find_engine
+
+    engine_path = args.engine or find_engine()
+    cpus = os.cpu_count() or 1
+    threads, hashes, workers = default_grid(cpus)
+    try:
+        if args.threads:
+            threads = _int_list(args.threads)
+        if args.hash:
+            hashes = _int_list(args.hash)
+        if args.workers:
+            workers = _int_list(args.workers)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    if engine_path == BUILTIN_ENGINE:
+        # The Python engine searches on one thread whatever it is told.
+        threads = [1]
+
+    grid = list(configurations(threads, hashes, workers, cpus, args.oversubscribe))
+    if not grid:
+        print(f"No configuration fits {cpus} CPUs; use --oversubscribe to try them anyway", file=sys.stderr)
+        return 2
+    print(f"Tuning {engine_path} on {socket.gethostname()} ({cpus} CPUs), {len(grid)} configurations",
+          file=sys.stderr)
+
+    bench_args = args.bench or (BUILTIN_BENCH if engine_path == BUILTIN_ENGINE else STOCKFISH_BENCH)
+    # Under a time limit every configuration searches each position for
+    # the same time, so only nodes searched tell them apart.
+    timed = bench_args[2] == "movetime"
+    key = "positions_per_second" if args.rank_by == "positions" and not timed else "nps"
+    results = []
+    start = time.perf_counter()
+    for thread_count, hash_mb, worker_count in grid:
+        try:
+            result = measure(engine_path, thread_count, hash_mb, worker_count, bench_args)
+        except BenchError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        results.append(result)
+        print(f"Threads {thread_count:>3}  Hash {hash_mb:>5} MB  workers {worker_count:>3}  "
+              f"{result['nps']:>11} nps  {result['positions_per_second']:>8.2f} positions/s")
+
+    best = max(results, key=lambda result: (result[key], result["nps"]))
+    best["tuned"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    best["cpus"] = cpus
+    print(f"\nBest of {len(results)} in {time.perf_counter() - start:.0f} s: "
+          f"Threads {best['parameters']['Threads']}, Hash {best['parameters']['Hash']} MB, "
+          f"{best['workers']} workers")
+    if engine_path == BUILTIN_ENGINE:
+        del best["parameters"]["Threads"]
+    if not args.dry_run:
+        try:
+            save_profile(engine_path, best, args.profile)
+        except OSError as exc:
+            print(f"Cannot save the profile to {args.profile}: {exc}", file=sys.stderr)
+            return 1
+        print(f"Saved to {args.profile}; engines started on this host now use it")
+    return 0